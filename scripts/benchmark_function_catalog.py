@@ -0,0 +1,117 @@
+# benchmark_function_catalog.py
+#
+# Micro-benchmark of FunctionCatalog against the JSON string round-trips it replaces:
+#   PYTHONPATH=src python scripts/benchmark_function_catalog.py --version v1 --iterations 20000
+
+import argparse
+import itertools
+import json
+import random
+import time
+
+from jsonschema import validate
+
+from core.utils import shuffle_json_functions
+from dataset_generation.function_catalog import FunctionCatalog
+
+
+def timeit(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def report(name, baseline_us, catalog_us):
+    print(
+        f"{name:<28} baseline {baseline_us:9.2f} us   catalog {catalog_us:9.2f} us   x{baseline_us / catalog_us:6.1f}"
+    )
+
+
+def sample_parameters(schema):
+    # a valid value for the schema subset used by the function variants
+    if "enum" in schema:
+        return schema["enum"][0]
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {key: sample_parameters(value) for key, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [sample_parameters(schema.get("items", {}))]
+    if schema_type in ("number", "integer"):
+        return 1
+    if schema_type == "boolean":
+        return True
+    return "text"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FunctionCatalog micro-benchmark")
+    parser.add_argument("--version", type=str, default="v1")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--n_functions", type=int, default=10, help="Size of the function lists.")
+    parser.add_argument("--n_lists", type=int, default=100, help="Distinct function lists, as in a dataset.")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    catalog = FunctionCatalog.load(version=args.version)
+    functions = catalog.functions
+    n_functions = min(args.n_functions, len(functions))
+    function_lists = [json.dumps(rng.sample(functions, n_functions)) for _ in range(args.n_lists)]
+    lists = itertools.cycle(function_lists)
+    names = [function["name"] for function in functions]
+
+    # outputs must be identical before comparing timings
+    for available_functions in function_lists:
+        random.seed(1)
+        expected = shuffle_json_functions(available_functions)
+        random.seed(1)
+        assert catalog.shuffle_json(available_functions) == expected
+        for indent in (None, 3, 4):
+            assert catalog.reformat(available_functions, indent=indent) == json.dumps(
+                json.loads(available_functions), indent=indent
+            )
+    assert catalog.to_json() == json.dumps(functions)
+
+    print(f"{len(catalog)} functions ({args.version}), lists of {n_functions} functions, {args.iterations} iterations")
+
+    report(
+        "shuffle list",
+        timeit(lambda: shuffle_json_functions(next(lists)), args.iterations),
+        timeit(lambda: catalog.shuffle_json(next(lists)), args.iterations),
+    )
+    report(
+        "reformat list (indent=4)",
+        timeit(lambda: json.dumps(json.loads(next(lists)), indent=4), args.iterations),
+        timeit(lambda: catalog.reformat(next(lists), indent=4), args.iterations),
+    )
+    excluded = names[0]
+    report(
+        "list without a function",
+        timeit(
+            lambda: json.dumps([function for function in json.loads(next(lists)) if function["name"] != excluded]),
+            args.iterations,
+        ),
+        timeit(lambda: catalog.without(next(lists), excluded), args.iterations),
+    )
+    report(
+        "random subset",
+        timeit(lambda: json.dumps(rng.sample(functions, n_functions)), args.iterations),
+        timeit(lambda: catalog.sample_json(n_functions, rng=rng), args.iterations),
+    )
+    report(
+        "lookup by name",
+        timeit(lambda: next(function for function in functions if function["name"] == names[-1]), args.iterations),
+        timeit(lambda: catalog[names[-1]], args.iterations),
+    )
+    parameters = {name: sample_parameters(catalog[name].get("parameters", {})) for name in names}
+    report(
+        "validate parameters",
+        timeit(
+            lambda: validate(parameters[names[-1]], catalog[names[-1]].get("parameters", {})), args.iterations // 10
+        ),
+        timeit(lambda: catalog.validate(names[-1], parameters[names[-1]]), args.iterations // 10),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# benchmark_function_retrieval.py
+#
+# Offline recall@k of the function retrieval stage, using the use cases of gpt4_uses_cases as
+# queries and their `functions_used` as labels, to trade prompt size against recall:
+#   PYTHONPATH=src python scripts/benchmark_function_retrieval.py --version v1 --k 3 5 8 10 15 20
+#   PYTHONPATH=src python scripts/benchmark_function_retrieval.py --backend sentence-transformers
+
+import argparse
+import time
+
+from core.function_retrieval import FunctionRetriever
+from dataset_generation.function_catalog import FunctionCatalog
+from dataset_generation.function_variants.gpt4_uses_cases import all_use_cases
+
+
+def evaluate(retriever, catalog, use_cases, ks):
+    """
+    Returns:
+        dict: per k, mean recall, share of use cases with all their functions retrieved and
+            mean size in characters of the kept functions JSON.
+    """
+    results = {k: {"recall": 0.0, "full_recall": 0, "prompt_chars": 0} for k in ks}
+    for use_case in use_cases:
+        ranked = retriever.rank(use_case["description"], catalog.functions)
+        labels = set(use_case["functions_used"])
+        for k in ks:
+            kept = ranked[:k]
+            found = len(labels.intersection(kept))
+            results[k]["recall"] += found / len(labels)
+            results[k]["full_recall"] += found == len(labels)
+            results[k]["prompt_chars"] += len(catalog.to_json(kept))
+    for k in ks:
+        for metric in results[k]:
+            results[k][metric] /= len(use_cases)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Function retrieval recall@k benchmark")
+    parser.add_argument("--version", type=str, default="v1")
+    parser.add_argument("--backend", type=str, default="tfidf", choices=["tfidf", "sentence-transformers"])
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 8, 10, 15, 20])
+    args = parser.parse_args()
+
+    catalog = FunctionCatalog.load(version=args.version)
+    use_cases = [
+        use_case
+        for use_case in all_use_cases
+        if use_case["functions_used"] and all(name in catalog for name in use_case["functions_used"])
+    ]
+    ks = [k for k in args.k if k <= len(catalog)]
+    if not use_cases:
+        print(f"No use case only uses functions of {args.version}.")
+        return
+
+    start = time.perf_counter()
+    retriever = FunctionRetriever.from_config(catalog.functions, backend=args.backend)
+    index_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = evaluate(retriever, catalog, use_cases, ks)
+    query_ms = (time.perf_counter() - start) / len(use_cases) * 1000
+
+    full_chars = len(catalog.to_json())
+    print(
+        f"{len(use_cases)} use cases, {len(catalog)} functions ({args.version}), backend {args.backend}: "
+        f"index built in {index_seconds:.2f}s, {query_ms:.2f} ms per query"
+    )
+    print(f"{'k':>4} {'recall@k':>9} {'all found':>10} {'prompt chars':>13} {'of full list':>13}")
+    for k in ks:
+        print(
+            f"{k:>4} {results[k]['recall']:>9.3f} {results[k]['full_recall']:>10.3f} "
+            f"{results[k]['prompt_chars']:>13.0f} {results[k]['prompt_chars'] / full_chars:>13.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# check_api_startup.py
+#
+# Startup time budget of the serving API: importing api.main (what uvicorn does before binding) must stay
+# within --import_budget seconds, the model being loaded in the background afterwards. With --wait_ready,
+# also time the model load until /readyz answers 200:
+#   PYTHONPATH=src python scripts/check_api_startup.py --import_budget 2
+#   PYTHONPATH=src python scripts/check_api_startup.py --wait_ready --ready_budget 120
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+IMPORT_PROBE = "import time; start = time.perf_counter(); import api.main; print(time.perf_counter() - start)"
+
+
+def measure_import_seconds(repeat):
+    """
+    Import api.main in fresh interpreters, return the best wall time in seconds.
+    """
+    src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    env = {**os.environ, "PYTHONPATH": src_dir + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE], env=env, capture_output=True, text=True, check=True
+        )
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(timings)
+
+
+def measure_ready_seconds(timeout):
+    """
+    Start the app in process and poll /readyz, return the seconds until it is ready (None on timeout).
+    """
+    from fastapi.testclient import TestClient
+
+    from api.main import app
+
+    start = time.perf_counter()
+    with TestClient(app) as client:
+        while time.perf_counter() - start < timeout:
+            response = client.get("/readyz")
+            if response.status_code == 200:
+                return time.perf_counter() - start
+            if response.json()["state"] == "failed":
+                print(f"Model loading failed: {response.json()['error']}")
+                return None
+            time.sleep(0.5)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API startup time budget")
+    parser.add_argument("--import_budget", type=float, default=2.0, help="Seconds allowed to import api.main.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--wait_ready", action="store_true", help="Also time the model load until /readyz is 200.")
+    parser.add_argument("--ready_budget", type=float, default=300.0)
+    args = parser.parse_args()
+
+    within_budget = True
+    import_seconds = measure_import_seconds(args.repeat)
+    within_budget &= import_seconds <= args.import_budget
+    print(f"import api.main: {import_seconds:.2f}s (budget {args.import_budget:.2f}s)")
+
+    if args.wait_ready:
+        ready_seconds = measure_ready_seconds(timeout=args.ready_budget)
+        within_budget &= ready_seconds is not None
+        ready_text = f"{ready_seconds:.1f}s" if ready_seconds is not None else "not ready"
+        print(f"startup to ready: {ready_text} (budget {args.ready_budget:.1f}s)")
+
+    if not within_budget:
+        print("Startup time budget exceeded.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
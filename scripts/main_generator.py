@@ -4,8 +4,11 @@ from dotenv import load_dotenv
 
 import argilla as rg
 
+from core.function_retrieval import FunctionRetriever
 from core.trace_generator import GuidedTraceGenerator
-from core.utils import shuffle_json_functions
+from dataset_generation.function_catalog import FunctionCatalog
+from dataset_generation.generation_records import iter_generation_records, read_argilla_record, read_dataset_record
+from dataset_generation.run_journal import RunJournal
 
 load_dotenv()
 
@@ -37,6 +40,9 @@ def main():
         # "model_name_or_path": "/workspace/models/finetuned_models/Starling-LM-7B-alpha-irca_agent_v5-5-1.gguf/checkpoint-31",
         # "model_name_or_path": "/workspace/models/finetuned_models/TinyLlama-7B-v0.1_irca_agent_v5-5-3.gguf/checkpoint-84",
         "model_name_or_path": "/workspace/models/finetuned_models/Mistral-7B-Instruct-v0.2-with-data-augmentation_irca_agent_v5-6.gguf/checkpoint-97",
+        # "transformers", "llamacpp" (quantized GGUF on CPU) or "openai" (OpenAI-compatible server), see core.backends
+        "backend": "transformers",
+        "backend_kwargs": {},
         "min_funcs": 1,
         "max_funcs": 20,
         "user_request_satisfiable": True,
@@ -50,7 +56,15 @@ def main():
             "workspace": "irca_agent",
         },
         "use_gpt4": False,
+        # restrict calls to the available functions and their parameters to the function schema
+        "constrained_calls": True,
+        # only put the N functions most relevant to the user query in the prompt, None keeps them all
+        "max_available_functions": None,
+        "function_retrieval_backend": "tfidf",
+        "dataset_path": "/workspace/datasets/irca_user_query_dataset_v5-6",
     }
+    # finished traces are journaled next to the source dataset, restarting the script resumes the run
+    config["journal_path"] = config["dataset_path"] + "_journal.jsonl"
 
     # # Get argilla remote dataset
     # ds = rg.FeedbackDataset.from_argilla(
@@ -59,14 +73,26 @@ def main():
     # )
 
     # Initialize the PromptGenerator with the given configuration
-    trace_generator = GuidedTraceGenerator(model_name_or_path=config["model_name_or_path"])
+    function_retriever = None
+    if config["max_available_functions"]:
+        function_retriever = FunctionRetriever.from_config(
+            FunctionCatalog.load(version="v1").functions, backend=config["function_retrieval_backend"]
+        )
+    trace_generator = GuidedTraceGenerator(
+        model_name_or_path=config["model_name_or_path"],
+        backend=config["backend"],
+        backend_kwargs=config["backend_kwargs"],
+        constrained_calls=config["constrained_calls"],
+        function_retriever=function_retriever,
+        max_available_functions=config["max_available_functions"],
+    )
 
     # src_ds = rg.FeedbackDataset.from_argilla(**config["argilla_source"]).pull()
     # src_ds = rg.FeedbackDataset.from_huggingface("JeanIbarz/irca_user_query_dataset_v4")
     from datasets import load_dataset, load_from_disk
 
     # src_ds = load_dataset("JeanIbarz/irca_user_query_dataset_v4")
-    src_ds = load_from_disk("/workspace/datasets/irca_user_query_dataset_v5-6")
+    src_ds = load_from_disk(config["dataset_path"])
 
     dataset_type = "disk"  # can be 'argilla', 'huggingface', or 'disk'
     if dataset_type == "disk":
@@ -76,31 +102,19 @@ def main():
     else:
         records = src_ds.records
 
-    # for i in range(66, len(src_ds)):
+    journal = RunJournal(config["journal_path"])
+    print(f"{len(journal)} records already generated in {config['journal_path']}")
+
     start = 0
-    # need to resume at 75 !!!!
-    # n = 40
-    for i in range(start, len(records)):
-        print(f"Generation n°{i}")
-
-        # Generate a random subset of functions and print the number of functions selected
-        # available_functions_dict = prompt_generator.generate_random_subset()
-        # available_functions_json = json.dumps(available_functions_dict)
-        try:
-            if dataset_type in ["huggingface", "disk"]:
-                available_functions = records[i]["available_functions"]
-                user_query = records[i]["corrected_user_query"][0]["value"]
-            else:
-                available_functions = records[i].fields["available_functions"]
-                user_query = src_ds.records[i].responses[0].values["corrected_user_query"].value
-        except IndexError:
-            print("Skipping generation...")
-            continue
-
-        shuffled_available_functions = shuffle_json_functions(available_functions=available_functions)
-
-        # print("Selected functions:", available_functions_dict)
-        # print("Number of selected functions:", len(available_functions_dict))
+    generation_records = iter_generation_records(
+        records,
+        start=start,
+        journal=journal,
+        read_record=read_argilla_record if dataset_type == "argilla" else read_dataset_record,
+    )
+
+    for record in generation_records:
+        print(f"Generation n°{record['index']}")
 
         # traces = trace_generator.generate_traces(
         #     available_functions=available_functions,
@@ -108,12 +122,23 @@ def main():
         # )
         traces = [
             trace_generator.generate_single_trace(
-                available_functions=shuffled_available_functions,
-                user_query=user_query,
+                available_functions=record["available_functions"],
+                user_query=record["user_query"],
             )
         ]
 
+        journal.record(
+            index=record["index"],
+            content_hash=record["content_hash"],
+            available_functions=record["available_functions"],
+            user_query=record["user_query"],
+            traces=traces,
+            model_name_or_path=config["model_name_or_path"],
+        )
+
         print("trace generated")
+        if trace_generator.prefix_cache is not None:
+            print(f"prompt tokens: {trace_generator.prefix_cache.stats()}")
 
         # # Create Argilla records
         # records = [
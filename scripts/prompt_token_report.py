@@ -0,0 +1,48 @@
+# prompt_token_report.py
+#
+# Per-section token histograms (instructions, example, functions, query, scratchpad) of an agent
+# traces dataset, flagging the samples longer than max_seq_length:
+#   PYTHONPATH=src python scripts/prompt_token_report.py --tokenizer mistralai/Mistral-7B-Instruct-v0.2
+
+import argparse
+import os
+
+from core.token_budget import format_histograms, make_token_counter, section_histograms
+from defaults.v1.training_args import training_args
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt token report")
+    parser.add_argument("--dataset", type=str, default=training_args["dataset"], help="Hub id or save_to_disk path.")
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--tokenizer", type=str, default=None, help="Defaults to a 4 characters per token estimate.")
+    parser.add_argument("--max_seq_length", type=int, default=training_args["max_seq_length"])
+    parser.add_argument("--bin_size", type=int, default=256)
+    args = parser.parse_args()
+
+    import datasets
+
+    if os.path.isdir(args.dataset):
+        dataset = datasets.load_from_disk(args.dataset)
+    else:
+        dataset = datasets.load_dataset(args.dataset)
+    if isinstance(dataset, datasets.DatasetDict):
+        dataset = dataset[args.split]
+
+    tokenizer = None
+    if args.tokenizer is not None:
+        import transformers
+
+        tokenizer = transformers.AutoTokenizer.from_pretrained(args.tokenizer)
+    count_tokens = make_token_counter(tokenizer)
+
+    samples = [sample["corrected_agent_trace"][0]["value"] for sample in dataset]
+    histograms = section_histograms(samples, count_tokens, bin_size=args.bin_size)
+    print(format_histograms(histograms, max_tokens=args.max_seq_length))
+
+    too_long = sum(count_tokens(sample) > args.max_seq_length for sample in samples)
+    print(f"{too_long}/{len(samples)} samples longer than max_seq_length={args.max_seq_length}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import asyncio
+import collections
+import math
+import queue
+import threading
+import time
+
+
+class WorkerUnavailableError(Exception):
+    """The inference worker is not running (not started yet or shutting down)."""
+
+
+class QueueFullError(Exception):
+    """The inference queue is saturated."""
+
+
+class RequestCancelledError(Exception):
+    """The request was cancelled (client disconnected or timed out)."""
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of `values` (q in [0, 100]), None if empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class InferenceJob:
+    """
+    A trace generation request handed over to the inference worker.
+
+    The result (or exception) is delivered to `future`, which lives on the event loop of
+    the request. `on_step` and `on_delta` callbacks are called from the worker thread.
+    """
+
+    def __init__(self, available_functions, user_query, loop, on_step=None, on_delta=None):
+        self.available_functions = available_functions
+        self.user_query = user_query
+        self.loop = loop
+        self.future = loop.create_future()
+        self.on_step = on_step
+        self.on_delta = on_delta
+        self.submitted_at = time.perf_counter()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise RequestCancelledError("Request cancelled.")
+
+    def set_result(self, result):
+        self.loop.call_soon_threadsafe(self._resolve, result, None)
+
+    def set_exception(self, exception):
+        self.loop.call_soon_threadsafe(self._resolve, None, exception)
+
+    def _resolve(self, result, exception):
+        if self.future.done():
+            return
+        if exception is not None:
+            self.future.set_exception(exception)
+        else:
+            self.future.set_result(result)
+
+
+class InferenceWorker:
+    """
+    Runs trace generation on a dedicated thread, off the event loop.
+
+    Requests are queued with a bounded depth: `submit` raises `QueueFullError` when the
+    queue is saturated and `WorkerUnavailableError` when the worker is not running, so
+    the API can answer with 429/503. Cancelled jobs (timeout or client disconnect) are
+    skipped if still queued, or aborted at the next step boundary if already running: guidance
+    generates the step in progress on its own thread, on the engine shared by every job, so it
+    is finished (without streaming its tokens) before the next job starts.
+
+    The generator is either given directly or built by a `ModelLoader` (see `api.model_loader`),
+    in which case the first job waits on the worker thread for the model to be loaded.
+
+    Jobs run one at a time: guidance engines run one sequence per forward pass and only keep
+    the KV cache of the last one, so interleaving the steps of concurrent requests would
+    re-process each prompt at every step. `metrics()` reports the latency and queue wait
+    percentiles over the last `metrics_window` jobs, and the share of the time spent generating.
+    """
+
+    def __init__(
+        self,
+        trace_generator=None,
+        max_queue_size=8,
+        request_timeout=300.0,
+        poll_interval=0.25,
+        model_loader=None,
+        metrics_window=1000,
+    ):
+        if trace_generator is None and model_loader is None:
+            raise ValueError("Either trace_generator or model_loader is required.")
+        self._trace_generator = trace_generator
+        self.model_loader = model_loader
+        self.max_queue_size = max_queue_size
+        self.request_timeout = request_timeout
+        self.poll_interval = poll_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._running = False
+        self._latencies = collections.deque(maxlen=metrics_window)
+        self._queue_waits = collections.deque(maxlen=metrics_window)
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._in_flight = 0
+        self._busy_seconds = 0.0
+        self._started_at = None
+
+    @property
+    def trace_generator(self):
+        if self._trace_generator is None:
+            return self.model_loader.get()
+        return self._trace_generator
+
+    @property
+    def is_running(self):
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def metrics(self):
+        latencies = list(self._latencies)
+        queue_waits = list(self._queue_waits)
+        uptime = time.perf_counter() - self._started_at if self._started_at is not None else 0.0
+        return {
+            "completed": self._completed,
+            "failed": self._failed,
+            "cancelled": self._cancelled,
+            "queue_depth": self.queue_depth,
+            "in_flight": self._in_flight,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "queue_wait_p50": percentile(queue_waits, 50),
+            "queue_wait_p95": percentile(queue_waits, 95),
+            # share of the time since the worker started spent generating
+            "occupancy": min(1.0, self._busy_seconds / uptime) if uptime > 0 else 0.0,
+        }
+
+    def start(self):
+        if self.is_running:
+            return
+        self._running = True
+        self._started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._running = False
+        # Fail pending jobs, then wake the worker up
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job.set_exception(WorkerUnavailableError("Inference worker stopped."))
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def submit(self, available_functions, user_query, on_step=None, on_delta=None):
+        """
+        Queue a trace generation and return its `InferenceJob`. Must be called from the event loop.
+        """
+        if not self.is_running:
+            raise WorkerUnavailableError("Inference worker is not running.")
+        job = InferenceJob(
+            available_functions=available_functions,
+            user_query=user_query,
+            loop=asyncio.get_running_loop(),
+            on_step=on_step,
+            on_delta=on_delta,
+        )
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError(f"Inference queue is full ({self.max_queue_size} pending requests).")
+        return job
+
+    async def wait(self, job, timeout=None, is_disconnected=None):
+        """
+        Wait for a job result, cancelling it on timeout or when `is_disconnected()` returns True.
+
+        Raises:
+            asyncio.TimeoutError: if the job didn't complete within `timeout` seconds.
+            RequestCancelledError: if the client disconnected.
+        """
+        timeout = self.request_timeout if timeout is None else timeout
+        deadline = job.submitted_at + timeout
+        try:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError(f"Request timed out after {timeout}s.")
+                done, _ = await asyncio.wait({job.future}, timeout=min(self.poll_interval, remaining))
+                if done:
+                    return job.future.result()
+                if is_disconnected is not None and await is_disconnected():
+                    raise RequestCancelledError("Client disconnected.")
+        finally:
+            if not job.future.done():
+                job.cancel()
+
+    async def generate(self, available_functions, user_query, timeout=None, is_disconnected=None):
+        job = self.submit(available_functions=available_functions, user_query=user_query)
+        return await self.wait(job, timeout=timeout, is_disconnected=is_disconnected)
+
+    def _run_job(self, job):
+        on_delta = None
+        if job.on_delta is not None:
+
+            def on_delta(step_type, text):
+                # the step is still generated to its end, cancellation is checked between steps
+                if not job.cancelled:
+                    job.on_delta(step_type, text)
+
+        trace = []
+        for step in self.trace_generator.iter_trace_steps(
+            available_functions=job.available_functions,
+            user_query=job.user_query,
+            on_delta=on_delta,
+        ):
+            job.check_cancelled()
+            trace.append(step)
+            if job.on_step is not None:
+                job.on_step(step)
+        return trace
+
+    def _run(self):
+        while self._running:
+            job = self._queue.get()
+            if job is None:
+                break
+            if job.cancelled:
+                self._cancelled += 1
+                job.set_exception(RequestCancelledError("Request cancelled before it started."))
+                continue
+            started_at = time.perf_counter()
+            self._queue_waits.append(started_at - job.submitted_at)
+            self._in_flight = 1
+            try:
+                trace = self._run_job(job)
+            except RequestCancelledError as e:
+                self._cancelled += 1
+                job.set_exception(e)
+            except Exception as e:
+                self._failed += 1
+                job.set_exception(e)
+            else:
+                self._completed += 1
+                self._latencies.append(time.perf_counter() - job.submitted_at)
+                job.set_result(trace)
+            finally:
+                self._in_flight = 0
+                self._busy_seconds += time.perf_counter() - started_at
@@ -1,15 +1,30 @@
+import asyncio
+import contextlib
+import functools
+import json
 import os
+import time
+from typing import Optional
 
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-from core.trace_generator import GuidedTraceGenerator
+from api.inference_worker import InferenceWorker, QueueFullError, RequestCancelledError, WorkerUnavailableError
+from api.model_registry import ModelNotFoundError, ModelNotReadyError, ModelRegistry
+from api.streaming import TraceEventStream
+from core.output_store import OutputStore
 from dataset_generation.functions_factory import FunctionsFactory
 
-
 config = {
     "records_nbr_to_generate": 5,
+    # id of the model served by default, other checkpoints can be loaded and promoted through /models
+    "model_id": "Mistral-7B-Instruct-v0.2-irca_agent_v5-6-checkpoint-122",
     "model_name_or_path": "/workspace/models/finetuned_models/Mistral-7B-Instruct-v0.2-with-data-augmentation_irca_agent_v5-6.gguf/checkpoint-122",
+    # "transformers" (GPU), "llamacpp" (quantized GGUF, CPU unless n_gpu_layers is set) or "openai" (OpenAI-compatible
+    # server), backend_kwargs are passed to the backend, e.g. {"n_ctx": 8192} or {"base_url": "http://localhost:8000/v1"}
+    "backend": "transformers",
+    "backend_kwargs": {},
     "min_funcs": 1,
     "max_funcs": 20,
     "user_request_satisfiable": True,
@@ -22,21 +37,163 @@ config = {
         "workspace": "irca_agent",
     },
     "use_gpt4": False,
+    # inference worker backpressure
+    "max_queue_size": 8,
+    "request_timeout": 300.0,
+    # functions really executed through the robocorp action servers, the model generates the other outputs, e.g.
+    # "get_current_weather_data": {"base_url": "http://localhost:8082", "action_package": "data-and-information-service"}
+    "function_executors": {},
+    "function_timeout": 30.0,
+    # independent calls the agent can write before <|wait|>, executed concurrently
+    "max_parallel_calls": 1,
+    # restrict calls to the available functions and their parameters to the function schema
+    "constrained_calls": True,
+    # only put the N functions most relevant to the user query in the prompt, None keeps them all
+    "max_available_functions": None,
+    "function_retrieval_backend": "tfidf",
+    # prompt + trace token budget, None disables it
+    "max_prompt_tokens": 4096,
+    # older function outputs are replaced by digests once the resolution cycle is longer, None disables it
+    "max_scratchpad_tokens": 2048,
+    # full function outputs are kept out of the prompt (only a preview goes in) and resolved in the responses
+    "output_store": {"max_items": 1024, "preview_chars": 512, "spill_dir": None},
+    # load the model in the background at startup (/readyz reports when it's done), otherwise on the first request
+    "load_model_on_startup": True,
+    # traces generated once the model is loaded (CUDA kernels, grammar compilation), /readyz waits for them
+    "warmup": {"traces": 1, "user_query": "What is the weather like in Paris today?"},
 }
 
-# Initialize the PromptGenerator with the given configuration
-trace_generator = GuidedTraceGenerator(config)
+output_store = OutputStore(**config["output_store"])
+
+
+def build_trace_generator(model_name_or_path):
+    """
+    Load the model and build its trace generator. guidance, torch and the model weights are only
+    imported/loaded here, so importing this module stays fast.
+    """
+    from core.executors import ExecutorRegistry
+    from core.function_retrieval import FunctionRetriever
+    from core.scratchpad import ScratchpadCompactor
+    from core.token_budget import TokenBudget
+    from core.trace_generator import GuidedTraceGenerator
+
+    return GuidedTraceGenerator(
+        model_name_or_path=model_name_or_path,
+        backend=config["backend"],
+        backend_kwargs=config["backend_kwargs"],
+        executors=ExecutorRegistry.from_config(config["function_executors"], timeout=config["function_timeout"]),
+        max_parallel_calls=config["max_parallel_calls"],
+        constrained_calls=config["constrained_calls"],
+        function_retriever=(
+            FunctionRetriever.from_config(function_variants(), backend=config["function_retrieval_backend"])
+            if config["max_available_functions"]
+            else None
+        ),
+        max_available_functions=config["max_available_functions"],
+        token_budget=TokenBudget(config["max_prompt_tokens"]) if config["max_prompt_tokens"] else None,
+        compactor=(
+            ScratchpadCompactor(max_scratchpad_tokens=config["max_scratchpad_tokens"])
+            if config["max_scratchpad_tokens"]
+            else None
+        ),
+        output_store=output_store,
+    )
+
+
+def warm_up(trace_generator):
+    """
+    Generate `config["warmup"]["traces"]` traces with the real prompt template. The function executors
+    aren't called (readiness checks mustn't trigger actions with side effects), the model generates the
+    function outputs.
+
+    Returns:
+        list: seconds taken by each warm-up trace.
+    """
+    timings = []
+    for _ in range(config["warmup"]["traces"]):
+        start = time.perf_counter()
+        trace_generator.generate_single_trace(
+            available_functions=default_available_functions(),
+            user_query=config["warmup"]["user_query"],
+            execute_functions=False,
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@functools.lru_cache(maxsize=None)
+def function_variants():
+    # read once, by the lifespan hook rather than at import time
+    return FunctionsFactory.load_function_variants(version="v1")
+
 
-available_functions = FunctionsFactory.load_function_variants(version="v1")[0:10]
+@functools.lru_cache(maxsize=None)
+def default_available_functions():
+    # the prompt expects a single line JSON list of functions
+    return json.dumps(function_variants()[0:10])
+
+
+def build_inference_worker(model_loader):
+    # Generation is GPU-bound and synchronous, it runs on a dedicated thread to keep the event loop responsive
+    return InferenceWorker(
+        model_loader=model_loader,
+        max_queue_size=config["max_queue_size"],
+        request_timeout=config["request_timeout"],
+    )
+
+
+model_registry = ModelRegistry(
+    build_trace_generator, build_inference_worker, warmup=warm_up if config["warmup"]["traces"] else None
+)
 
 
 class CompletionInput(BaseModel):
     prompt: str
+    # model id, defaults to the promoted model
+    model: Optional[str] = None
+
+
+class ModelInput(BaseModel):
+    model_id: str
+    model_name_or_path: str
+    # switch the default model to this one once it is loaded and warmed up
+    promote: bool = False
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    default_available_functions()
+    model_registry.register(config["model_id"], config["model_name_or_path"], load=config["load_model_on_startup"])
+    yield
+    model_registry.stop(timeout=5)
 
 
 current_dir = os.path.dirname(__file__)
 router = APIRouter()
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+
+def submit_job(model_id=None, **kwargs):
+    """
+    Submit a job to the worker of `model_id` (the default model if None).
+
+    Returns:
+        tuple: (inference worker, job). The model is kept loaded until the job is over.
+    """
+    try:
+        entry = model_registry.acquire(model_id)
+    except ModelNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    try:
+        job = entry.worker.submit(available_functions=default_available_functions(), **kwargs)
+    except QueueFullError as e:
+        model_registry.release(entry)
+        raise HTTPException(status_code=429, detail=str(e))
+    except WorkerUnavailableError as e:
+        model_registry.release(entry)
+        raise HTTPException(status_code=503, detail=str(e))
+    job.future.add_done_callback(lambda _: model_registry.release(entry))
+    return entry.worker, job
 
 
 @app.get("/")
@@ -44,17 +201,115 @@ async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/healthz")
+async def healthz():
+    # the process is alive, even if the model is still loading
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # the default model is loaded and warmed up, the replica can take traffic
+    model_loader = model_registry.get().model_loader
+    status = {"ready": model_loader.ready, **model_loader.status()}
+    if not model_loader.ready:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+
+@app.get("/metrics")
+async def metrics():
+    # metrics of the default model
+    return model_registry.get().worker.metrics()
+
+
+@app.get("/models")
+async def list_models():
+    return {"default_model_id": model_registry.default_model_id, "models": model_registry.models()}
+
+
+@app.post("/models", status_code=202)
+async def load_model(input_data: ModelInput):
+    # loaded and warmed up in the background, poll GET /models for its state
+    try:
+        entry = model_registry.register(input_data.model_id, input_data.model_name_or_path)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if input_data.promote:
+        asyncio.get_running_loop().run_in_executor(None, promote_when_ready, entry.model_id)
+    return entry.status()
+
+
+def promote_when_ready(model_id):
+    entry = model_registry.get(model_id)
+    if entry.model_loader.wait():
+        model_registry.promote(model_id)
+        print(f"Model {model_id} promoted")
+
+
+@app.post("/models/{model_id}/promote")
+async def promote_model(model_id: str):
+    try:
+        entry = model_registry.promote(model_id)
+    except ModelNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ModelNotReadyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return entry.status()
+
+
+@app.delete("/models/{model_id}")
+async def unload_model(model_id: str):
+    try:
+        entry = model_registry.unload(model_id)
+    except ModelNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return entry.status()
+
+
 @router.post("/completions")
-async def generate_text(input_data: CompletionInput):
+async def generate_text(input_data: CompletionInput, request: Request):
+    inference_worker, job = submit_job(model_id=input_data.model, user_query=input_data.prompt)
+    try:
+        trace = await inference_worker.wait(job, is_disconnected=request.is_disconnected)
+    except asyncio.TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except RequestCancelledError as e:
+        # client closed the request
+        raise HTTPException(status_code=499, detail=str(e))
+    except WorkerUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    traces = [trace]
+
+    # full payloads of the Output[shortuuid] cited by the agent
+    return {"traces": traces, "outputs": output_store.resolve_trace(trace)}
+
+
+@router.get("/outputs/{shortuuid}")
+async def get_output(shortuuid: str):
+    function_output = output_store.get(shortuuid)
+    if function_output is None:
+        raise HTTPException(status_code=404, detail=f"Unknown output: Output[{shortuuid}]")
+    return {"shortuuid": shortuuid, "output": function_output}
 
-    traces = [
-        trace_generator.generate_single_trace(
-            available_functions=available_functions,
-            user_query=input_data.prompt,
-        )
-    ]
 
-    return {"traces": traces}
+@router.post("/completions/stream")
+async def stream_text(input_data: CompletionInput, request: Request):
+    # Each IRCA step is sent as soon as it is complete, with token deltas in between
+    event_stream = TraceEventStream(output_store=output_store)
+    inference_worker, job = submit_job(
+        model_id=input_data.model,
+        user_query=input_data.prompt,
+        on_step=event_stream.on_step,
+        on_delta=event_stream.on_delta,
+    )
+    return StreamingResponse(
+        event_stream.iter_sse(inference_worker, job, is_disconnected=request.is_disconnected),
+        media_type="text/event-stream",
+    )
 
 
 app.include_router(router=router)
@@ -0,0 +1,138 @@
+import threading
+import time
+
+
+class ModelLoader:
+    """
+    Builds the trace generator (and loads its model) lazily, off the import path.
+
+    The model is loaded either in the background as soon as `start` is called (so uvicorn
+    binds right away and the replica reports ready once loaded) or by the first `get`,
+    i.e. the first request handled by the inference worker. Loading happens once, later
+    calls return the same generator. A failed load is retried by the first `get` (or `start`)
+    called `retry_after` seconds after the failure; calls made meanwhile raise the load error
+    right away, so queued requests don't each reload the model.
+
+    Once loaded, `warmup(generator)` runs a few traces (CUDA kernels, grammar compilation) so that
+    the first requests aren't slow; the generator is only handed out, and reported ready, once
+    warmed up.
+
+    Args:
+        factory (callable): `factory() -> GuidedTraceGenerator`, importing the heavy
+            dependencies (guidance, torch) itself.
+        warmup (callable, optional): `warmup(generator) -> list` of the warm-up trace timings, in
+            seconds. A failing warm-up fails the load.
+        retry_after (float): Seconds after a failed load before it is attempted again.
+    """
+
+    def __init__(self, factory, warmup=None, retry_after=30.0):
+        self.factory = factory
+        self.warmup = warmup
+        self.retry_after = retry_after
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.warmup_timings = []
+        self.error = None
+        self._failed_at = None
+        self._generator = None
+        self._loading = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._generator is not None
+
+    def _retry_due(self):
+        return self.error is None or time.monotonic() - self._failed_at >= self.retry_after
+
+    def get(self):
+        """
+        Return the trace generator, loading it (or waiting for the background load) first.
+
+        Raises:
+            Exception: the error raised while loading the model, until the load is retried.
+        """
+        if self._generator is not None:
+            return self._generator
+        with self._lock:
+            if self._generator is None:
+                if not self._retry_due():
+                    raise self.error
+                self._loading = True
+                try:
+                    self._generator = self._load_and_warm_up()
+                    self.error = None
+                except Exception as e:
+                    self.error = e
+                    self._failed_at = time.monotonic()
+                    raise
+                finally:
+                    self._loading = False
+        return self._generator
+
+    def _load_and_warm_up(self):
+        self.load_seconds = None
+        self.warmup_seconds = None
+        start = time.perf_counter()
+        generator = self.factory()
+        self.load_seconds = time.perf_counter() - start
+        print(f"Model loaded in {self.load_seconds:.1f}s")
+        if self.warmup is not None:
+            start = time.perf_counter()
+            self.warmup_timings = list(self.warmup(generator))
+            self.warmup_seconds = time.perf_counter() - start
+            timings = ", ".join(f"{seconds:.1f}s" for seconds in self.warmup_timings)
+            print(f"Model warmed up in {self.warmup_seconds:.1f}s (traces: {timings})")
+        return generator
+
+    def start(self):
+        """
+        Load the model on a background thread (again if the previous load failed, see `retry_after`).
+        """
+        if self.ready or (self._thread is not None and self._thread.is_alive()) or not self._retry_due():
+            return
+        self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        try:
+            self.get()
+        except Exception as e:
+            print(f"Model loading failed: {e!r}, retrying in {self.retry_after:.0f}s at the earliest")
+
+    def wait(self, timeout=None):
+        """
+        Wait for the background load, return whether the model is ready.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        return self.ready
+
+    def unload(self):
+        """
+        Drop the generator (and its model), the next `get` loads it again.
+        """
+        with self._lock:
+            self._generator = None
+            self.load_seconds = None
+            self.warmup_seconds = None
+            self.warmup_timings = []
+            self._thread = None
+
+    def status(self):
+        if self.ready:
+            state = "ready"
+        elif self._loading:
+            state = "warming_up" if self.load_seconds is not None else "loading"
+        elif self.error is not None:
+            state = "failed"
+        else:
+            state = "not_loaded"
+        return {
+            "state": state,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "warmup_timings": self.warmup_timings,
+            "error": repr(self.error) if self.error is not None else None,
+        }
@@ -0,0 +1,171 @@
+import gc
+import sys
+import threading
+import time
+
+from api.model_loader import ModelLoader
+
+
+class ModelNotFoundError(Exception):
+    """No model is registered under this id."""
+
+
+class ModelNotReadyError(Exception):
+    """The model is still loading (or failed to load) and can't be promoted."""
+
+
+class ModelEntry:
+    """
+    A model served by the API: its loader, its inference worker and the number of requests in flight.
+    """
+
+    def __init__(self, model_id, model_name_or_path, model_loader, worker):
+        self.model_id = model_id
+        self.model_name_or_path = model_name_or_path
+        self.model_loader = model_loader
+        self.worker = worker
+        self.registered_at = time.time()
+        self.in_flight = 0
+        # retired models are unloaded once their last in-flight request is over
+        self.retired = False
+
+    def status(self):
+        return {
+            "model_id": self.model_id,
+            "model_name_or_path": self.model_name_or_path,
+            "in_flight": self.in_flight,
+            "retired": self.retired,
+            **self.model_loader.status(),
+        }
+
+
+class ModelRegistry:
+    """
+    Models served by the API, with hot swap of the default model.
+
+    Each model has its own `ModelLoader` and inference worker. A new checkpoint is loaded (and
+    warmed up) in the background with `register`, then `promote` switches the requests without
+    a model id to it atomically. The previous default model keeps serving its in-flight requests
+    and is unloaded after the last one completes. Requests can also target a model by id.
+
+    Args:
+        factory (callable): `factory(model_name_or_path) -> GuidedTraceGenerator`.
+        worker_factory (callable): `worker_factory(model_loader) -> InferenceWorker`, e.g. a
+            `BatchScheduler` built from the loader.
+        warmup (callable, optional): Warm-up of each loaded model, see `ModelLoader`.
+    """
+
+    def __init__(self, factory, worker_factory, warmup=None):
+        self.factory = factory
+        self.worker_factory = worker_factory
+        self.warmup = warmup
+        self.default_model_id = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, model_id, model_name_or_path, load=True):
+        """
+        Register a model and start its inference worker. With `load`, the model is loaded in the
+        background right away, otherwise by its first request.
+
+        Returns:
+            ModelEntry: the new model, also the default one if it is the first registered.
+        """
+        model_loader = ModelLoader(lambda: self.factory(model_name_or_path), warmup=self.warmup)
+        entry = ModelEntry(model_id, model_name_or_path, model_loader, self.worker_factory(model_loader))
+        with self._lock:
+            if model_id in self._entries:
+                raise ValueError(f"Model {model_id!r} is already registered.")
+            self._entries[model_id] = entry
+            if self.default_model_id is None:
+                self.default_model_id = model_id
+        entry.worker.start()
+        if load:
+            model_loader.start()
+        return entry
+
+    def get(self, model_id=None):
+        with self._lock:
+            return self._get(model_id)
+
+    def _get(self, model_id):
+        model_id = self.default_model_id if model_id is None else model_id
+        entry = self._entries.get(model_id)
+        if entry is None:
+            raise ModelNotFoundError(f"Unknown model: {model_id!r}.")
+        return entry
+
+    def acquire(self, model_id=None):
+        """
+        Return the model serving a request (the default one if `model_id` is None) and count the
+        request in flight until `release`.
+        """
+        with self._lock:
+            entry = self._get(model_id)
+            entry.in_flight += 1
+            return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.in_flight -= 1
+            unload = entry.retired and entry.in_flight == 0
+        if unload:
+            self._unload_in_background(entry)
+
+    def promote(self, model_id, retire_previous=True):
+        """
+        Make `model_id` the default model. The requests already routed to the previous default
+        model complete on it, and it is then unloaded when `retire_previous` is set.
+
+        Raises:
+            ModelNotReadyError: if the model isn't loaded and warmed up yet.
+        """
+        with self._lock:
+            entry = self._get(model_id)
+            if not entry.model_loader.ready:
+                raise ModelNotReadyError(f"Model {model_id!r} is not ready: {entry.model_loader.status()['state']}.")
+            previous_model_id = self.default_model_id
+            self.default_model_id = model_id
+        if retire_previous and previous_model_id not in (None, model_id):
+            self.unload(previous_model_id)
+        return entry
+
+    def unload(self, model_id):
+        """
+        Remove a model from the registry, it is unloaded once its in-flight requests are over.
+        """
+        with self._lock:
+            if model_id == self.default_model_id:
+                raise ValueError(f"Model {model_id!r} is the default model, promote another one first.")
+            entry = self._get(model_id)
+            del self._entries[model_id]
+            entry.retired = True
+            unload = entry.in_flight == 0
+        if unload:
+            self._unload_in_background(entry)
+        return entry
+
+    def _unload_in_background(self, entry):
+        # stopping a worker joins its thread, keep it off the event loop
+        threading.Thread(target=self._unload, args=(entry,), name=f"unload-{entry.model_id}", daemon=True).start()
+
+    def _unload(self, entry):
+        entry.worker.stop(timeout=30)
+        entry.model_loader.unload()
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"Model {entry.model_id} unloaded")
+
+    def models(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            default_model_id = self.default_model_id
+        return [{**entry.status(), "default": entry.model_id == default_model_id} for entry in entries]
+
+    def stop(self, timeout=None):
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            entry.worker.stop(timeout=timeout)
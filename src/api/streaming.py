@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+from api.inference_worker import RequestCancelledError
+from core.step_factory import step_to_dict
+
+
+def format_sse(event, data):
+    """
+    Format a Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class TraceEventStream:
+    """
+    Collects the steps and token deltas of an inference job and replays them as Server-Sent Events.
+
+    `on_step` and `on_delta` are given to the inference worker and called from its thread.
+
+    Events:
+        - `delta`: {"step_type", "text"} chunk of text generated for the step in progress,
+        - `step`: a complete step (`ThoughtStep`, `ActionChoiceStep`, `FunctionCallStep`, ...),
+        - `error`: {"detail"} if generation failed or timed out,
+        - `done`: end of the trace, with {"outputs"}: the full payloads of the `Output[shortuuid]`
+          cited by the agent when an output store is given.
+    """
+
+    def __init__(self, output_store=None):
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.output_store = output_store
+
+    def _put(self, event, data):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (event, data))
+
+    def on_step(self, step):
+        self._put("step", step_to_dict(step))
+
+    def on_delta(self, step_type, text):
+        self._put("delta", {"step_type": step_type.value, "text": text})
+
+    async def iter_sse(self, worker, job, timeout=None, is_disconnected=None):
+        result = asyncio.ensure_future(worker.wait(job, timeout=timeout, is_disconnected=is_disconnected))
+        try:
+            while True:
+                next_event = asyncio.ensure_future(self.events.get())
+                done, _ = await asyncio.wait({next_event, result}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event in done:
+                    yield format_sse(*next_event.result())
+                    continue
+                next_event.cancel()
+
+                # Job is over, flush the events queued before its completion
+                while not self.events.empty():
+                    yield format_sse(*self.events.get_nowait())
+                try:
+                    trace = result.result()
+                except RequestCancelledError:
+                    return
+                except asyncio.TimeoutError as e:
+                    yield format_sse("error", {"detail": str(e)})
+                except Exception as e:
+                    yield format_sse("error", {"detail": str(e)})
+                else:
+                    outputs = self.output_store.resolve_trace(trace) if self.output_store is not None else {}
+                    yield format_sse("done", {"outputs": outputs})
+                return
+        finally:
+            # Client went away or stream ended: stop the generation if it's still running
+            job.cancel()
+            result.cancel()
@@ -0,0 +1,154 @@
+import collections
+import itertools
+import math
+import random
+
+from core.prompt_builder import (
+    TAGGED_MARKERS,
+    build_full_prompt,
+    format_system_instructions,
+    parse_corrected_agent_trace,
+)
+from dataset_generation.function_catalog import FunctionCatalog
+
+MARKER_STYLES = (1, 2)
+MARKER_NEWLINES = ("", "\n", "\n\n")
+NEWLINES = ("\n", "\r\n")
+INDENTS = (None, 3, 4)
+
+# Formatting of a training sample. `order_seed` seeds the shuffle of the functions, None keeps their order.
+Augmentation = collections.namedtuple(
+    "Augmentation", ["marker_style", "marker_newlines", "newline", "indent", "order_seed"]
+)
+IDENTITY = Augmentation(
+    marker_style=1, marker_newlines=("",) * len(TAGGED_MARKERS), newline="\n", indent=None, order_seed=None
+)
+
+
+def sample_rng(record_id, epoch, seed=0):
+    """
+    Random state of a sample, derived from the record id and the epoch only, so that a sample gets
+    the same augmentation whatever the process or the order it is formatted in.
+    """
+    return random.Random(f"{seed}-{record_id}-{epoch}")
+
+
+def sample_augmentation(rng):
+    """
+    Draw an augmentation with the distribution of `prompt_builder.format_instruction`.
+    """
+    marker_style = rng.choice(MARKER_STYLES)
+    marker_newlines = IDENTITY.marker_newlines
+    if marker_style == 2:
+        marker_newlines = tuple(rng.choice(MARKER_NEWLINES) for _ in TAGGED_MARKERS)
+    return Augmentation(
+        marker_style=marker_style,
+        marker_newlines=marker_newlines,
+        newline=rng.choice(NEWLINES),
+        indent=rng.choice(INDENTS),
+        order_seed=rng.getrandbits(32),
+    )
+
+
+def enumerate_augmentations(order_seeds=(None,)):
+    """
+    Enumerate the augmentation space: marker style (and newlines before the tagged markers) x newline
+    characters x functions indentation x function orders (`order_seeds`).
+    """
+    marker_options = [(1, IDENTITY.marker_newlines)]
+    marker_options += [(2, newlines) for newlines in itertools.product(MARKER_NEWLINES, repeat=len(TAGGED_MARKERS))]
+    for (marker_style, marker_newlines), newline, indent, order_seed in itertools.product(
+        marker_options, NEWLINES, INDENTS, order_seeds
+    ):
+        yield Augmentation(marker_style, marker_newlines, newline, indent, order_seed)
+
+
+def augmentation_space_size(n_functions):
+    """
+    Number of distinct formattings of a sample with `n_functions` functions.
+    """
+    marker_options = 1 + len(MARKER_NEWLINES) ** len(TAGGED_MARKERS)
+    return marker_options * len(NEWLINES) * len(INDENTS) * math.factorial(n_functions)
+
+
+def apply_augmentation(parsed_data, augmentation, catalog=None):
+    """
+    Format a parsed sample (see `parse_corrected_agent_trace`) with `augmentation`.
+    """
+    parsed_data = dict(parsed_data)
+    parsed_data["system_instructions"] = format_system_instructions(
+        parsed_data["system_instructions"],
+        marker_style=augmentation.marker_style,
+        marker_newlines=augmentation.marker_newlines,
+        newline=augmentation.newline,
+    )
+    available_functions_json = parsed_data.get("available_functions_json", [])
+    if available_functions_json:
+        catalog = catalog if catalog is not None else FunctionCatalog.load(version="v1")
+        shuffle = augmentation.order_seed is not None
+        parsed_data["available_functions_json"] = [
+            catalog.reformat(
+                available_functions_json,
+                shuffle=shuffle,
+                rng=random.Random(augmentation.order_seed) if shuffle else None,
+                indent=augmentation.indent,
+            )
+        ]
+    return build_full_prompt(parsed_data)
+
+
+class AugmentationEngine:
+    """
+    Reproducible augmentation of the training samples.
+
+    The augmentation of a sample only depends on `seed`, its record id and the epoch, so epochs can be
+    precomputed in any order by parallel workers (e.g. `datasets.map(num_proc=N)`) and a run can be
+    reproduced exactly.
+
+    Args:
+        seed (int): Augmentation seed.
+        catalog (FunctionCatalog, optional): Used to reformat the functions, defaults to the v1 catalog
+            (loaded by each worker).
+        augment_first_epoch (bool): When False, epoch 0 keeps the original formatting. Every epoch is
+            augmented by default, as every sample is by `prompt_builder.format_instruction`.
+    """
+
+    def __init__(self, seed=0, catalog=None, augment_first_epoch=True):
+        self.seed = seed
+        # loaded lazily, the engine is pickled to the datasets.map workers
+        self._catalog = catalog
+        self.augment_first_epoch = augment_first_epoch
+
+    @property
+    def catalog(self):
+        return self._catalog if self._catalog is not None else FunctionCatalog.load(version="v1")
+
+    def augmentation(self, record_id, epoch):
+        if epoch == 0 and not self.augment_first_epoch:
+            return IDENTITY
+        return sample_augmentation(sample_rng(record_id, epoch, seed=self.seed))
+
+    def augment(self, sample, record_id, epoch):
+        """
+        Format `sample` (a record with a `corrected_agent_trace` column) for `epoch`.
+        """
+        parsed_data = parse_corrected_agent_trace(sample["corrected_agent_trace"][0]["value"].replace("\r\n", "\n"))
+        return apply_augmentation(parsed_data, self.augmentation(record_id, epoch), catalog=self.catalog)
+
+    def augment_batch(self, batch, record_ids, epochs):
+        """
+        `datasets.map(batched=True, with_indices=True)` function formatting each record of the batch for
+        each of `epochs`. Records are parsed once for all their epochs.
+
+        Returns:
+            dict: `text`, `record_index` and `epoch` columns, `len(epochs)` rows per record.
+        """
+        samples = {"text": [], "record_index": [], "epoch": []}
+        for corrected_agent_trace, record_id in zip(batch["corrected_agent_trace"], record_ids):
+            parsed_data = parse_corrected_agent_trace(corrected_agent_trace[0]["value"].replace("\r\n", "\n"))
+            for epoch in epochs:
+                augmentation = self.augmentation(record_id, epoch)
+                samples["text"].append(apply_augmentation(parsed_data, augmentation, catalog=self.catalog))
+                samples["record_index"].append(record_id)
+                samples["epoch"].append(epoch)
+        return samples
@@ -0,0 +1,128 @@
+import glob
+import os
+
+
+class TransformersBackend:
+    """
+    Local transformers model, bfloat16 weights on the first GPU by default.
+
+    Args:
+        model_name_or_path (str): Path or hub id of the model.
+        model_kwargs (dict, optional): Keyword arguments of `models.Transformers`. Use e.g.
+            `{"device_map": {"": "cpu"}}` to run on CPU.
+    """
+
+    name = "transformers"
+    # local engines run the guidance grammars token by token
+    supports_grammars = True
+
+    def __init__(self, model_name_or_path, model_kwargs=None):
+        self.model_name_or_path = model_name_or_path
+        self.model_kwargs = model_kwargs
+
+    def load(self):
+        import torch
+        from guidance import models
+
+        model_kwargs = self.model_kwargs
+        if model_kwargs is None:
+            model_kwargs = {"torch_dtype": torch.bfloat16, "device_map": {"": 0}}
+        return models.Transformers(model=self.model_name_or_path, **model_kwargs)
+
+
+def find_gguf_file(model_name_or_path):
+    """
+    Return the GGUF file of `model_name_or_path`, either the file itself or the only `*.gguf`
+    file of a directory (quantized exports are written next to the checkpoint).
+    """
+    if os.path.isfile(model_name_or_path):
+        return model_name_or_path
+    gguf_files = sorted(glob.glob(os.path.join(model_name_or_path, "*.gguf")))
+    if len(gguf_files) != 1:
+        raise ValueError(
+            f"Expected a GGUF file or a directory with a single *.gguf file, found {len(gguf_files)} "
+            f"in {model_name_or_path}."
+        )
+    return gguf_files[0]
+
+
+class LlamaCppBackend:
+    """
+    Quantized GGUF model run by llama.cpp, on CPU unless `n_gpu_layers` is set.
+
+    Args:
+        model_name_or_path (str): GGUF file, or a directory holding a single GGUF file.
+        n_ctx (int): Context size, must fit the prompt and the generated trace.
+        n_gpu_layers (int): Layers offloaded to the GPU, 0 runs fully on CPU.
+        n_threads (int, optional): CPU threads, defaults to llama.cpp's choice.
+        model_kwargs (dict, optional): Other keyword arguments of `models.LlamaCpp`.
+    """
+
+    name = "llamacpp"
+    supports_grammars = True
+
+    def __init__(self, model_name_or_path, n_ctx=8192, n_gpu_layers=0, n_threads=None, model_kwargs=None):
+        self.model_name_or_path = model_name_or_path
+        self.n_ctx = n_ctx
+        self.n_gpu_layers = n_gpu_layers
+        self.n_threads = n_threads
+        self.model_kwargs = model_kwargs or {}
+
+    def load(self):
+        from guidance import models
+
+        model_kwargs = {"n_ctx": self.n_ctx, "n_gpu_layers": self.n_gpu_layers, **self.model_kwargs}
+        if self.n_threads is not None:
+            model_kwargs["n_threads"] = self.n_threads
+        return models.LlamaCpp(model=find_gguf_file(self.model_name_or_path), echo=False, **model_kwargs)
+
+
+class OpenAIServerBackend:
+    """
+    Model served by an OpenAI-compatible completion server (vLLM, llama.cpp server, TGI...).
+
+    Remote models only support plain `gen`/`select`, so function calls can't be constrained
+    by the grammars of `core.grammars`.
+
+    Args:
+        model_name_or_path (str): Model name known by the server.
+        base_url (str): Server URL, e.g. `http://localhost:8000/v1`.
+        api_key (str, optional): Defaults to the `OPENAI_API_KEY` environment variable, local
+            servers usually accept any value.
+        model_kwargs (dict, optional): Other keyword arguments of `models.OpenAI`.
+    """
+
+    name = "openai"
+    supports_grammars = False
+
+    def __init__(self, model_name_or_path, base_url="http://localhost:8000/v1", api_key=None, model_kwargs=None):
+        self.model_name_or_path = model_name_or_path
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model_kwargs = model_kwargs or {}
+
+    def load(self):
+        from guidance import models
+
+        api_key = self.api_key or os.getenv("OPENAI_API_KEY", "EMPTY")
+        return models.OpenAI(
+            self.model_name_or_path, base_url=self.base_url, api_key=api_key, echo=False, **self.model_kwargs
+        )
+
+
+BACKENDS = {backend.name: backend for backend in (TransformersBackend, LlamaCppBackend, OpenAIServerBackend)}
+
+
+def create_backend(backend, model_name_or_path, **backend_kwargs):
+    """
+    Create an inference backend from its name (`transformers`, `llamacpp` or `openai`).
+
+    Args:
+        backend (str): Name of the backend.
+        model_name_or_path (str): Model of the backend, see each backend.
+        **backend_kwargs: Backend specific arguments, e.g. `n_ctx` for `llamacpp` or `base_url`
+            for `openai`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {sorted(BACKENDS)}.")
+    return BACKENDS[backend](model_name_or_path, **backend_kwargs)
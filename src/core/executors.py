@@ -0,0 +1,215 @@
+import json
+import re
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+OUTPUT_REFERENCE_PATTERN = re.compile(r"^\*\*Output\[([A-Za-z0-9]+)\]")
+
+
+class FunctionExecutionError(Exception):
+    """A function call could not be executed."""
+
+
+def parse_function_parameters(fct_parameters, outputs=None):
+    """
+    Parse the parameters generated for a `Call function:` step.
+
+    Supports a JSON object (trailing characters such as the closing brace of the call are
+    ignored), an empty string, and `**Output[shortuuid]` references to a previous output.
+
+    Args:
+        fct_parameters (str): Generated parameters text.
+        outputs (dict, optional): Previous function outputs, keyed by shortuuid.
+
+    Returns:
+        dict: Keyword arguments of the function.
+    """
+    text = fct_parameters.strip()
+    if not text or text == "}":
+        return {}
+
+    match = OUTPUT_REFERENCE_PATTERN.match(text)
+    if match:
+        shortuuid = match.group(1)
+        if outputs is None or shortuuid not in outputs:
+            raise FunctionExecutionError(f"Unknown output reference: Output[{shortuuid}]")
+        text = outputs[shortuuid]
+
+    try:
+        parameters, _ = json.JSONDecoder().raw_decode(text)
+    except json.JSONDecodeError as e:
+        raise FunctionExecutionError(f"Invalid function parameters: {e}")
+    if not isinstance(parameters, dict):
+        raise FunctionExecutionError("Function parameters must be a JSON object.")
+    return parameters
+
+
+def format_function_output(result):
+    """
+    Serialize a function result to the single line expected after `Output[shortuuid]: `.
+    """
+    if not isinstance(result, str):
+        return json.dumps(result, ensure_ascii=False, separators=(",", ":"), default=str)
+    try:
+        return json.dumps(json.loads(result), ensure_ascii=False, separators=(",", ":"))
+    except json.JSONDecodeError:
+        return " ".join(result.splitlines())
+
+
+class FunctionExecutor:
+    """
+    Executes a function call requested by the agent.
+    """
+
+    def execute(self, fct_name, parameters):
+        """
+        Args:
+            fct_name (str): Name of the called function.
+            parameters (dict): Parsed call parameters.
+
+        Returns:
+            The function result (a string or a JSON-serializable object).
+        """
+        raise NotImplementedError
+
+
+class CallableExecutor(FunctionExecutor):
+    """
+    Executes an in-process Python callable, called with the parameters as keyword arguments.
+    Also handy to stub actions with local fakes.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def execute(self, fct_name, parameters):
+        return self.function(**parameters)
+
+
+class HttpActionExecutor(FunctionExecutor):
+    """
+    Executes an action exposed by a robocorp action server
+    (`POST {base_url}/api/actions/{action_package}/{action-name}/run`).
+
+    Args:
+        base_url (str): Action server URL, e.g. `http://localhost:8082` for the
+            data-and-information-service of robocorp-action-server/irca-agent/docker-compose.yml.
+        action_package (str): Name of the action package served by that server.
+        action_name (str, optional): Action to run, defaults to the called function name.
+        api_key (str, optional): Bearer token, when the server is started with an API key.
+        timeout (float): HTTP timeout in seconds.
+    """
+
+    def __init__(self, base_url, action_package, action_name=None, api_key=None, timeout=30.0):
+        self.base_url = base_url.rstrip("/")
+        self.action_package = action_package
+        self.action_name = action_name
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def execute(self, fct_name, parameters):
+        action_name = (self.action_name or fct_name).replace("_", "-")
+        url = f"{self.base_url}/api/actions/{self.action_package}/{action_name}/run"
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(
+            url, data=json.dumps(parameters).encode("utf-8"), headers=headers, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = response.read().decode("utf-8")
+        except urllib.error.URLError as e:
+            raise FunctionExecutionError(f"Action {action_name} failed: {e}")
+        # actions return strings, which the server serializes as JSON
+        try:
+            return json.loads(body)
+        except json.JSONDecodeError:
+            return body
+
+
+class ExecutorRegistry:
+    """
+    Maps function names to executors and runs calls with a timeout.
+
+    Errors (unknown parameters, timeouts, action failures) are returned as a JSON error
+    payload so that the agent sees them as the function output.
+    """
+
+    def __init__(self, timeout=30.0, max_workers=8):
+        self.timeout = timeout
+        self._executors = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="function-executor")
+
+    @classmethod
+    def from_config(cls, config, timeout=30.0, max_workers=8):
+        """
+        Build a registry of `HttpActionExecutor` from a dict
+        `{fct_name: {"base_url": ..., "action_package": ..., ...}}`.
+        """
+        registry = cls(timeout=timeout, max_workers=max_workers)
+        for fct_name, executor_config in config.items():
+            registry.register(fct_name, HttpActionExecutor(**executor_config))
+        return registry
+
+    def register(self, fct_name, executor):
+        self._executors[fct_name] = executor
+
+    def register_callable(self, fct_name, function):
+        self.register(fct_name, CallableExecutor(function))
+
+    def __contains__(self, fct_name):
+        return fct_name in self._executors
+
+    def _submit(self, fct_name, fct_parameters, outputs=None):
+        executor = self._executors.get(fct_name)
+        if executor is None:
+            return {"error": f"Unknown function: {fct_name}"}
+        try:
+            parameters = parse_function_parameters(fct_parameters, outputs=outputs)
+        except FunctionExecutionError as e:
+            return {"error": f"Function {fct_name} failed: {e}"}
+        return self._pool.submit(executor.execute, fct_name, parameters)
+
+    def _collect(self, fct_name, submitted, deadline):
+        if not isinstance(submitted, Future):
+            return format_function_output(submitted)
+        try:
+            result = submitted.result(timeout=max(0.0, deadline - time.perf_counter()))
+        except TimeoutError:
+            # the call keeps running in its thread, its result is discarded
+            result = {"error": f"Function {fct_name} timed out after {self.timeout}s"}
+        except Exception as e:
+            result = {"error": f"Function {fct_name} failed: {e}"}
+        return format_function_output(result)
+
+    def execute(self, fct_name, fct_parameters, outputs=None):
+        """
+        Execute a generated call and return its output as a single line string.
+
+        Args:
+            fct_name (str): Name of the called function.
+            fct_parameters (str): Generated parameters text.
+            outputs (dict, optional): Previous function outputs, keyed by shortuuid.
+        """
+        return self.execute_many([(fct_name, fct_parameters)], outputs=outputs)[0]
+
+    def execute_many(self, calls, outputs=None):
+        """
+        Execute independent calls concurrently, all within the registry timeout.
+
+        Args:
+            calls (list): (fct_name, fct_parameters) tuples.
+            outputs (dict, optional): Previous function outputs, keyed by shortuuid.
+
+        Returns:
+            list: single line outputs, in the order of `calls`.
+        """
+        deadline = time.perf_counter() + self.timeout
+        submitted = [self._submit(fct_name, fct_parameters, outputs=outputs) for fct_name, fct_parameters in calls]
+        return [self._collect(fct_name, future, deadline) for (fct_name, _), future in zip(calls, submitted)]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
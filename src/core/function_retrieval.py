@@ -0,0 +1,180 @@
+import json
+import math
+import re
+from collections import Counter
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# splits camelCase parameter and function names
+CAMEL_CASE_PATTERN = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+STOP_WORDS = frozenset(
+    "a an and are as at be based by can do for from get give how i in is it its me my of on or please provide "
+    "some that the their them this to up use user using want what when which with would you your".split()
+)
+
+
+def _stem(token):
+    # crude suffix stripping, enough to match "reminders" with "reminder" or "planning" with "plan"
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 5 and token.endswith("ing"):
+        token = token[:-3]
+        return token[:-1] if len(token) > 3 and token[-1] == token[-2] else token
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    text = CAMEL_CASE_PATTERN.sub(" ", text).replace("_", " ").lower()
+    return [_stem(token) for token in TOKEN_PATTERN.findall(text) if token not in STOP_WORDS]
+
+
+def function_text(function):
+    """
+    Text indexed for a function: its name (split on underscores) and its description.
+    """
+    return function["name"].replace("_", " ") + ". " + function.get("description", "")
+
+
+class TfidfEmbedder:
+    """
+    Sparse TF-IDF embeddings, fitted on the function texts. No dependency, used by default.
+    """
+
+    def __init__(self):
+        self.idf = {}
+        self.default_idf = 1.0
+
+    def fit(self, texts):
+        document_frequency = Counter(token for text in texts for token in set(tokenize(text)))
+        n_documents = len(texts)
+        self.idf = {
+            token: math.log((1 + n_documents) / (1 + frequency)) + 1 for token, frequency in document_frequency.items()
+        }
+        # words unseen in the function texts can't match anything, their weight only affects the norm
+        self.default_idf = math.log(1 + n_documents) + 1
+        return self
+
+    def embed(self, text):
+        counts = Counter(tokenize(text))
+        vector = {
+            token: (1 + math.log(count)) * self.idf.get(token, self.default_idf) for token, count in counts.items()
+        }
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {token: weight / norm for token, weight in vector.items()} if norm else {}
+
+    @staticmethod
+    def similarity(query_vector, function_vector):
+        if len(query_vector) > len(function_vector):
+            query_vector, function_vector = function_vector, query_vector
+        return sum(weight * function_vector.get(token, 0.0) for token, weight in query_vector.items())
+
+
+class SentenceTransformerEmbedder:
+    """
+    Dense embeddings from a local sentence-transformers model (on CPU by default).
+
+    Args:
+        model_name_or_path (str): Model path or hub id.
+        device (str): Torch device of the model.
+    """
+
+    def __init__(self, model_name_or_path="sentence-transformers/all-MiniLM-L6-v2", device="cpu"):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name_or_path, device=device)
+
+    def fit(self, texts):
+        return self
+
+    def embed(self, text):
+        return self.model.encode(text, normalize_embeddings=True).tolist()
+
+    @staticmethod
+    def similarity(query_vector, function_vector):
+        return sum(q * f for q, f in zip(query_vector, function_vector))
+
+
+class FunctionRetriever:
+    """
+    Picks the functions relevant to a user query, to only put those in the FUNCTIONS AVAILABLE block.
+
+    Functions are indexed by the embedding of their name and description. The embedder is
+    fitted on `functions` (e.g. a whole function variant) and function embeddings are cached
+    by text, so any function list can then be filtered.
+
+    Args:
+        functions (list): Functions used to fit the embedder.
+        embedder (optional): `TfidfEmbedder` (default) or `SentenceTransformerEmbedder`.
+    """
+
+    def __init__(self, functions, embedder=None):
+        self.embedder = embedder if embedder is not None else TfidfEmbedder()
+        self.embedder.fit([function_text(function) for function in functions])
+        self._embeddings = {}
+        for function in functions:
+            self._embedding(function)
+
+    @classmethod
+    def from_config(cls, functions, backend="tfidf", **embedder_kwargs):
+        """
+        Args:
+            backend (str): "tfidf" or "sentence-transformers".
+        """
+        if backend == "tfidf":
+            embedder = TfidfEmbedder()
+        elif backend == "sentence-transformers":
+            embedder = SentenceTransformerEmbedder(**embedder_kwargs)
+        else:
+            raise ValueError(f"Unknown function retrieval backend: {backend}")
+        return cls(functions, embedder=embedder)
+
+    def _embedding(self, function):
+        text = function_text(function)
+        if text not in self._embeddings:
+            self._embeddings[text] = self.embedder.embed(text)
+        return self._embeddings[text]
+
+    def scores(self, user_query, functions):
+        query_vector = self.embedder.embed(user_query)
+        return [self.embedder.similarity(query_vector, self._embedding(function)) for function in functions]
+
+    def _ranked_indices(self, user_query, functions):
+        scores = self.scores(user_query, functions)
+        # ties keep the original order
+        return sorted(range(len(functions)), key=lambda i: (-scores[i], i))
+
+    def rank(self, user_query, functions):
+        """
+        Return the function names ordered by decreasing relevance.
+        """
+        return [functions[i]["name"] for i in self._ranked_indices(user_query, functions)]
+
+    def top_k(self, user_query, functions, k):
+        """
+        Return the `k` functions most relevant to `user_query`, in their original order.
+        """
+        if k is None or k >= len(functions):
+            return list(functions)
+        return [functions[i] for i in sorted(self._ranked_indices(user_query, functions)[:k])]
+
+    def retrieve_json(self, available_functions, user_query, k, catalog=None):
+        """
+        Filter a JSON function list down to the `k` functions most relevant to `user_query`.
+
+        Args:
+            available_functions (str): JSON list of functions.
+            user_query (str): The user query.
+            k (int): Number of functions kept.
+            catalog (FunctionCatalog, optional): Used to serialize the kept functions.
+
+        Returns:
+            str: JSON list of the kept functions, in their original order.
+        """
+        functions = json.loads(available_functions)
+        if k is None or k >= len(functions):
+            return available_functions
+        names = [function["name"] for function in self.top_k(user_query, functions, k)]
+        if catalog is not None:
+            return catalog.reformat(available_functions, include=names)
+        return json.dumps([function for function in functions if function["name"] in names])
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import re
+from collections import OrderedDict
+
+# `**Output[shortuuid]` references a previous function output instead of passing literal parameters
+OUTPUT_REFERENCE_REGEX = r"\*\*Output\[[A-Za-z0-9]+\]"
+
+# separators of the json.dumps default (", " and ": ") and compact (",", ":") formats
+ITEM_SEPARATOR = ",[ ]?"
+KEY_SEPARATOR = ":[ ]?"
+
+# JSON scalars
+STRING_REGEX = r'"([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"'
+INTEGER_REGEX = r"-?(0|[1-9][0-9]*)"
+NUMBER_REGEX = r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+BOOLEAN_REGEX = r"(true|false)"
+NULL_REGEX = r"null"
+PRIMITIVE_REGEX = f"({STRING_REGEX}|{NUMBER_REGEX}|{BOOLEAN_REGEX}|{NULL_REGEX})"
+
+
+def schema_hash(schema):
+    """
+    Stable hash of a JSON schema, independent of the key order.
+    """
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _alternatives(regexes):
+    return "(" + "|".join(regexes) + ")"
+
+
+def _object_regex(properties, required):
+    members = [
+        (re.escape(json.dumps(key, ensure_ascii=False)) + KEY_SEPARATOR + schema_to_regex(value), key in required)
+        for key, value in properties.items()
+    ]
+    if not members:
+        # free-form object, keys and primitive values only
+        member = STRING_REGEX + KEY_SEPARATOR + PRIMITIVE_REGEX
+        return r"\{(" + member + "(" + ITEM_SEPARATOR + member + ")*)?" + r"\}"
+
+    # Properties keep the schema order, optional ones can be omitted. Each alternative starts with
+    # the first emitted property, which requires every property before it to be optional.
+    heads = []
+    for first, (member, is_required) in enumerate(members):
+        tail = "".join(
+            ITEM_SEPARATOR + member if is_required else "(" + ITEM_SEPARATOR + member + ")?"
+            for member, is_required in members[first + 1 :]
+        )
+        heads.append(member + tail)
+        if is_required:
+            break
+    body = _alternatives(heads)
+    if not any(is_required for _, is_required in members):
+        body += "?"
+    return r"\{" + body + r"\}"
+
+
+def schema_to_regex(schema):
+    """
+    Compile a JSON schema into a regular expression matching the JSON values valid against it.
+
+    Supports the subset used by the function variants: `object` (`properties`, `required`),
+    `array` (`items`), `string`, `number`, `integer`, `boolean`, `null`, `enum`, type lists
+    and `anyOf`/`oneOf`. Objects are matched with their properties in schema order (the order
+    of the training traces), values written with other key orders never match. Items and keys
+    are separated as in the `json.dumps` default or compact formats (a single optional space
+    after `,` and `:`), other whitespace isn't allowed. Unsupported keywords (lengths, patterns,
+    ranges...) are ignored, so the regex may accept a few values the schema rejects.
+
+    Args:
+        schema (dict): JSON schema.
+
+    Returns:
+        str: regular expression.
+    """
+    if not isinstance(schema, dict):
+        return PRIMITIVE_REGEX
+    if "enum" in schema:
+        return _alternatives([re.escape(json.dumps(value, ensure_ascii=False)) for value in schema["enum"]])
+    if "const" in schema:
+        return re.escape(json.dumps(schema["const"], ensure_ascii=False))
+    for keyword in ("anyOf", "oneOf"):
+        if keyword in schema:
+            return _alternatives([schema_to_regex(sub_schema) for sub_schema in schema[keyword]])
+
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        return _alternatives([schema_to_regex({**schema, "type": sub_type}) for sub_type in schema_type])
+    if schema_type == "object" or (schema_type is None and "properties" in schema):
+        return _object_regex(schema.get("properties", {}), set(schema.get("required", [])))
+    if schema_type == "array":
+        item = schema_to_regex(schema.get("items", {}))
+        return r"\[(" + item + "(" + ITEM_SEPARATOR + item + ")*)?" + r"\]"
+    if schema_type == "string":
+        return STRING_REGEX
+    if schema_type == "integer":
+        return INTEGER_REGEX
+    if schema_type == "number":
+        return NUMBER_REGEX
+    if schema_type == "boolean":
+        return BOOLEAN_REGEX
+    if schema_type == "null":
+        return NULL_REGEX
+    return PRIMITIVE_REGEX
+
+
+def parameters_regex(schema):
+    """
+    Regular expression of the parameters of a function call. Parameters are always a JSON object,
+    including for the `{}` or untyped parameters schemas of functions without parameters.
+    """
+    if not isinstance(schema, dict):
+        schema = {}
+    if "type" not in schema and not any(keyword in schema for keyword in ("enum", "const", "anyOf", "oneOf")):
+        schema = {**schema, "type": "object"}
+    return schema_to_regex(schema)
+
+
+class GrammarCache:
+    """
+    Grammars constraining function calls to the available functions.
+
+    `fct_name` is a `select` over the available names and the parameters are forced to
+    match the parameters schema of the selected function (or to reference a previous
+    output). Compiled parameters grammars are cached per schema hash, and parsed function
+    lists per JSON string, so repeated function lists don't recompile anything.
+
+    Args:
+        max_function_lists (int): Number of parsed function lists kept (LRU).
+    """
+
+    def __init__(self, max_function_lists=32):
+        self.max_function_lists = max_function_lists
+        # (schema hash, capture name, temperature, max_tokens) -> guidance grammar
+        self._grammars = {}
+        # available_functions -> {fct_name: parameters schema}
+        self._function_lists = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def functions_by_name(self, available_functions):
+        """
+        Args:
+            available_functions (str): JSON list of the functions available to the agent.
+
+        Returns:
+            dict: parameters schema of each available function, keyed by name.
+        """
+        if available_functions in self._function_lists:
+            self._function_lists.move_to_end(available_functions)
+            return self._function_lists[available_functions]
+        functions = {function["name"]: function.get("parameters", {}) for function in json.loads(available_functions)}
+        self._function_lists[available_functions] = functions
+        if len(self._function_lists) > self.max_function_lists:
+            self._function_lists.popitem(last=False)
+        return functions
+
+    def name_grammar(self, fct_names, name="fct_name"):
+        from guidance import select
+
+        return select(options=list(fct_names), name=name)
+
+    def parameters_grammar(self, schema, name="fct_parameters", temperature=0.0, max_tokens=500):
+        """
+        Return a grammar generating parameters valid against `schema`, or an output reference.
+        """
+        from guidance import gen
+
+        key = (schema_hash(schema), name, temperature, max_tokens)
+        grammar = self._grammars.get(key)
+        if grammar is None:
+            self.misses += 1
+            regex = _alternatives([parameters_regex(schema), OUTPUT_REFERENCE_REGEX])
+            grammar = gen(regex=regex, name=name, temperature=temperature, max_tokens=max_tokens)
+            self._grammars[key] = grammar
+        else:
+            self.hits += 1
+        return grammar
+
+    def stats(self):
+        return {
+            "compiled_grammars": len(self._grammars),
+            "grammar_hits": self.hits,
+            "grammar_misses": self.misses,
+            "cached_function_lists": len(self._function_lists),
+        }
+
+    def clear(self):
+        self._grammars.clear()
+        self._function_lists.clear()
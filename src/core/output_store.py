@@ -0,0 +1,117 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from core.step_factory import StepType
+
+OUTPUT_LINK_PATTERN = re.compile(r"Output\[([A-Za-z0-9]+)\]")
+PREVIEW_MARKER = " [...]"
+
+
+class OutputStore:
+    """
+    Full function outputs, keyed by the shortuuid of their `Output[shortuuid]` step.
+
+    Only a preview of long outputs goes into the prompt, the model cites them as
+    `Output[shortuuid]` links and the links are resolved from the store afterwards.
+    Outputs are kept in an in-memory LRU; when `spill_dir` is set, evicted outputs are
+    written there (one JSON file per output) instead of being dropped. Thread-safe, as
+    outputs are stored by the inference worker and read by the API.
+
+    Args:
+        max_items (int): Outputs kept in memory.
+        preview_chars (int): Maximum length of the preview put into the prompt.
+        spill_dir (str, optional): Directory of the outputs evicted from memory.
+    """
+
+    def __init__(self, max_items=1024, preview_chars=512, spill_dir=None):
+        self.max_items = max_items
+        self.preview_chars = preview_chars
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self._outputs = OrderedDict()
+        self._lock = threading.Lock()
+        self.spilled = 0
+        self.dropped = 0
+
+    def _spill_path(self, shortuuid):
+        return os.path.join(self.spill_dir, f"{shortuuid}.json")
+
+    def put(self, shortuuid, function_output):
+        with self._lock:
+            self._outputs[shortuuid] = function_output
+            self._outputs.move_to_end(shortuuid)
+            while len(self._outputs) > self.max_items:
+                evicted_shortuuid, evicted_output = self._outputs.popitem(last=False)
+                if self.spill_dir is None:
+                    self.dropped += 1
+                    continue
+                with open(self._spill_path(evicted_shortuuid), "w", encoding="utf-8") as file:
+                    json.dump(evicted_output, file, ensure_ascii=False)
+                self.spilled += 1
+
+    def get(self, shortuuid, default=None):
+        with self._lock:
+            if shortuuid in self._outputs:
+                self._outputs.move_to_end(shortuuid)
+                return self._outputs[shortuuid]
+        # shortuuids are alphanumeric (see OUTPUT_LINK_PATTERN), safe to use as file names
+        if self.spill_dir is not None and shortuuid.isalnum():
+            try:
+                with open(self._spill_path(shortuuid), "r", encoding="utf-8") as file:
+                    return json.load(file)
+            except FileNotFoundError:
+                pass
+        return default
+
+    def __contains__(self, shortuuid):
+        return self.get(shortuuid) is not None
+
+    def __len__(self):
+        return len(self._outputs)
+
+    def preview(self, function_output):
+        """
+        Truncated version of `function_output` to put into the prompt.
+        """
+        if len(function_output) <= self.preview_chars:
+            return function_output
+        return function_output[: self.preview_chars] + PREVIEW_MARKER
+
+    def store(self, shortuuid, function_output):
+        """
+        Store the full output and return its preview.
+        """
+        self.put(shortuuid, function_output)
+        return self.preview(function_output)
+
+    def resolve(self, text):
+        """
+        Return the stored outputs referenced by the `Output[shortuuid]` links of `text`.
+
+        Returns:
+            dict: full output of each referenced shortuuid found in the store.
+        """
+        outputs = {}
+        for shortuuid in OUTPUT_LINK_PATTERN.findall(text):
+            function_output = self.get(shortuuid)
+            if function_output is not None:
+                outputs[shortuuid] = function_output
+        return outputs
+
+    def resolve_trace(self, trace):
+        """
+        Return the stored outputs cited by the agent in `trace` (function call parameters,
+        thoughts and final answer).
+        """
+        return self.resolve(
+            "".join(
+                step.diff for step in trace if step.type not in (StepType.INITIAL_PROMPT, StepType.FUNCTION_OUTPUT)
+            )
+        )
+
+    def stats(self):
+        return {"stored_outputs": len(self), "spilled_outputs": self.spilled, "dropped_outputs": self.dropped}
@@ -0,0 +1,266 @@
+from collections import OrderedDict
+
+import guidance
+from guidance import gen
+
+from core.prompt.function_calling_oneshot import prompt_template as agent_prompt_template
+
+
+def split_prompt_template(prompt_template=agent_prompt_template):
+    """
+    Split an agent prompt template at its two reuse boundaries.
+
+    The static part (instructions + worked example, up to and including the
+    `### FUNCTIONS AVAILABLE` header) does not depend on the record. The
+    functions part only depends on the function list, and the query part holds
+    the user query and the agent scratchpad.
+
+    Args:
+        prompt_template (str): Template with `{available_functions}`, `{user_query}`
+            and `{agent_scratchpad}` placeholders.
+
+    Returns:
+        tuple: (static_prefix, functions_template, query_template). Concatenating the
+            formatted parts gives the same string as `prompt_template.format(...)`.
+    """
+    head, tail = prompt_template.split("{available_functions}", 1)
+    functions_tail, query_tail = tail.split("{user_query}", 1)
+    # the static prefix has no placeholder left, format() only unescapes the double braces
+    static_prefix = head.format()
+    return static_prefix, "{available_functions}" + functions_tail, "{user_query}" + query_tail
+
+
+def count_tokens(lm, text):
+    """
+    Count the tokens of `text` with the tokenizer of a guidance model.
+
+    Falls back to a rough 4-characters-per-token estimate when the model does not
+    expose a tokenizer.
+    """
+    engine = getattr(lm, "engine", lm)
+    tokenizer = getattr(engine, "tokenizer", None)
+    if tokenizer is not None and hasattr(tokenizer, "encode"):
+        try:
+            return len(tokenizer.encode(text.encode("utf-8")))
+        except TypeError:
+            return len(tokenizer.encode(text))
+    return max(1, len(text) // 4) if text else 0
+
+
+# guidance releases whose Transformers engine keeps its KV cache in `_past_key_values` and `_cached_token_ids`,
+# the private fields read and written by the snapshots
+SNAPSHOT_GUIDANCE_VERSIONS = ("0.1.",)
+
+
+def engine_snapshots_supported(lm):
+    """
+    Whether the KV cache of the engine of `lm` can be snapshotted: a tested guidance version with an
+    engine exposing the cache fields.
+    """
+    engine = getattr(lm, "engine", lm)
+    return (
+        getattr(guidance, "__version__", "").startswith(SNAPSHOT_GUIDANCE_VERSIONS)
+        and hasattr(engine, "_past_key_values")
+        and hasattr(engine, "_cached_token_ids")
+    )
+
+
+def snapshot_engine_state(lm):
+    """
+    Best-effort snapshot of the KV cache held by a guidance model engine.
+
+    guidance engines keep the key/value cache of the last forward pass together with
+    the token ids it was computed for, and reuse the longest common token prefix on
+    the next call. Legacy tuple caches are immutable, so keeping a reference to them
+    is enough to restore the prefix state later. Returns None when the engine does not
+    expose such a cache.
+    """
+    if not engine_snapshots_supported(lm):
+        return None
+    engine = getattr(lm, "engine", lm)
+    past_key_values = getattr(engine, "_past_key_values", None)
+    cached_token_ids = getattr(engine, "_cached_token_ids", None)
+    if not isinstance(past_key_values, tuple) or cached_token_ids is None:
+        return None
+    return past_key_values, list(cached_token_ids)
+
+
+def restore_engine_state(lm, snapshot):
+    """
+    Restore a snapshot taken with `snapshot_engine_state`, unless the engine cache
+    already starts with the snapshot tokens (in which case it is at least as warm).
+
+    Returns:
+        bool: whether the engine cache holds the snapshot tokens, False without snapshot.
+    """
+    if snapshot is None:
+        return False
+    engine = getattr(lm, "engine", lm)
+    past_key_values, token_ids = snapshot
+    cached_token_ids = getattr(engine, "_cached_token_ids", None)
+    if cached_token_ids is not None and cached_token_ids[: len(token_ids)] == token_ids:
+        return True
+    engine._past_key_values = past_key_values
+    engine._cached_token_ids = list(token_ids)
+    if hasattr(engine, "_cached_logits"):
+        engine._cached_logits = None
+    return True
+
+
+def snapshot_nbytes(snapshot):
+    """
+    Memory held by the key/value tensors of a snapshot taken with `snapshot_engine_state`.
+    """
+    if snapshot is None:
+        return 0
+    nbytes = 0
+    stack = [snapshot[0]]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (tuple, list)):
+            stack.extend(value)
+        elif hasattr(value, "numel") and hasattr(value, "element_size"):
+            nbytes += value.numel() * value.element_size()
+    return nbytes
+
+
+class PromptPrefixCache:
+    """
+    Shared-prefix cache for the agent prompt.
+
+    The instructions/example prefix is prefilled once per model load and snapshotted.
+    Each new trace is forked from that snapshot. A second snapshot, taken at the end of
+    the `### FUNCTIONS AVAILABLE` block, is only taken once a function list is seen a
+    second time, so runs where every record has its own (shuffled) function list don't
+    pay an extra prefill per record. These snapshots are kept in an LRU of
+    `max_function_lists` lists, also capped by the memory of their KV caches.
+    `reused_tokens` and `fresh_tokens` count prompt tokens served from a restored snapshot
+    vs. tokens that had to be processed for the trace.
+
+    When the engine cache can't be snapshotted (see `engine_snapshots_supported`), forks
+    still share the prompt text but every prompt is processed again.
+
+    Args:
+        base_lm (guidance model): Model the prompts are forked from.
+        prompt_template (str): Agent prompt template, see `split_prompt_template`.
+        max_function_lists (int): Function lists kept, the default only keeps the last one,
+            e.g. the fixed function list of the API.
+        max_snapshot_bytes (int): Memory of the function list snapshots (a 7B model takes
+            several hundred MB per snapshot), the least recently used are dropped beyond it.
+    """
+
+    def __init__(
+        self, base_lm, prompt_template=agent_prompt_template, max_function_lists=1, max_snapshot_bytes=1024**3
+    ):
+        self.base_lm = base_lm
+        self.static_prefix, self.functions_template, self.query_template = split_prompt_template(prompt_template)
+        self.max_function_lists = max_function_lists
+        self.max_snapshot_bytes = max_snapshot_bytes
+
+        self._prefix_lm = None
+        self._prefix_tokens = 0
+        self._prefix_snapshot = None
+        # available_functions -> (lm, number of tokens of the functions block, engine snapshot or None)
+        self._function_lists = OrderedDict()
+        self._snapshot_bytes = 0
+
+        self.reused_tokens = 0
+        self.fresh_tokens = 0
+        self.fallback_reported = False
+
+    def _prefill(self, lm):
+        # Without snapshots (e.g. a remote OpenAI-compatible server), a prefill would be a wasted request
+        if engine_snapshots_supported(lm):
+            # Force a forward pass over the prompt so far, the generated token is discarded
+            (lm + gen(max_tokens=1, name="_prefill")).get("_prefill")
+        snapshot = snapshot_engine_state(lm)
+        if snapshot is None and not self.fallback_reported:
+            print(
+                f"Prompt prefix cache: the KV cache of the engine can't be snapshotted (guidance "
+                f"{getattr(guidance, '__version__', 'unknown')}), prompt prefixes are processed for each trace."
+            )
+            self.fallback_reported = True
+        return snapshot
+
+    def _count(self, restored, tokens):
+        if restored:
+            self.reused_tokens += tokens
+        else:
+            self.fresh_tokens += tokens
+
+    def _get_prefix_lm(self):
+        if self._prefix_lm is None:
+            self._prefix_lm = self.base_lm + self.static_prefix
+            self._prefix_tokens = count_tokens(self.base_lm, self.static_prefix)
+            self._prefix_snapshot = self._prefill(self._prefix_lm)
+            self.fresh_tokens += self._prefix_tokens
+        else:
+            self._count(restore_engine_state(self.base_lm, self._prefix_snapshot), self._prefix_tokens)
+        return self._prefix_lm
+
+    def _evict(self):
+        while self._function_lists and (
+            len(self._function_lists) > self.max_function_lists or self._snapshot_bytes > self.max_snapshot_bytes
+        ):
+            _, (_, _, snapshot) = self._function_lists.popitem(last=False)
+            self._snapshot_bytes -= snapshot_nbytes(snapshot)
+
+    def _get_function_list_lm(self, available_functions):
+        entry = self._function_lists.get(available_functions)
+        if entry is not None and entry[2] is not None:
+            self._function_lists.move_to_end(available_functions)
+            lm, functions_tokens, snapshot = entry
+            self._count(restore_engine_state(self.base_lm, snapshot), self._prefix_tokens + functions_tokens)
+            return lm
+
+        prefix_lm = self._get_prefix_lm()
+        functions_block = self.functions_template.format(available_functions=available_functions)
+        functions_tokens = count_tokens(self.base_lm, functions_block)
+        lm = prefix_lm + functions_block
+        self.fresh_tokens += functions_tokens
+
+        # Only pay for the second prefill (and keep its KV cache) once the function list is shared
+        snapshot = self._prefill(lm) if entry is not None else None
+        if snapshot_nbytes(snapshot) > self.max_snapshot_bytes:
+            snapshot = None
+        self._function_lists[available_functions] = (lm, functions_tokens, snapshot)
+        self._function_lists.move_to_end(available_functions)
+        self._snapshot_bytes += snapshot_nbytes(snapshot)
+        self._evict()
+        return lm
+
+    def fork(self, available_functions, user_query, agent_scratchpad=""):
+        """
+        Return a model state holding the full agent prompt for a new trace.
+
+        Args:
+            available_functions (str): JSON list of the functions available to the agent.
+            user_query (str): The user query.
+            agent_scratchpad (str): Optional scratchpad appended after the ITERATIVE
+                RESOLUTION CYCLE header.
+
+        Returns:
+            guidance model: forked model state, equivalent to
+                `base_lm + prompt_template.format(...)`.
+        """
+        lm = self._get_function_list_lm(available_functions)
+        query_block = self.query_template.format(user_query=user_query, agent_scratchpad=agent_scratchpad)
+        self.fresh_tokens += count_tokens(self.base_lm, query_block)
+        return lm + query_block
+
+    def stats(self):
+        total = self.reused_tokens + self.fresh_tokens
+        return {
+            "reused_tokens": self.reused_tokens,
+            "fresh_tokens": self.fresh_tokens,
+            "reuse_ratio": self.reused_tokens / total if total else 0.0,
+            "cached_function_lists": sum(entry[2] is not None for entry in self._function_lists.values()),
+            "snapshot_bytes": self._snapshot_bytes,
+        }
+
+    def clear(self):
+        self._prefix_lm = None
+        self._prefix_tokens = 0
+        self._prefix_snapshot = None
+        self._function_lists.clear()
+        self._snapshot_bytes = 0
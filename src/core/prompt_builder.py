@@ -1,8 +1,8 @@
-import json
 import random
 
 
 from core.utils import extract_and_remove
+from dataset_generation.function_catalog import FunctionCatalog
 
 # CHAT TEMPLATE EXAMPLE:
 # <|system|>
@@ -45,6 +45,10 @@ Note: ensure you only use information provided in the context above or below. Do
     return full_prompt
 
 
+# start of the assistant completion in a full agent trace
+RESOLUTION_CYCLE_MARKER = "### ITERATIVE RESOLUTION CYCLE"
+
+
 def parse_corrected_agent_trace(full_prompt):
     # Extracting and removing parts from the full_prompt
     system_instructions, full_prompt = extract_and_remove(
@@ -94,40 +98,62 @@ def parse_corrected_agent_trace(full_prompt):
     return parsed_data
 
 
-iteration_nbr = 0
+def randomize_newline_characters(text, rng=random):
+    newline_choice = rng.choice(["\n", "\r\n"])
+    return text.replace("\n", newline_choice)
+
 
+# replaced by the "tagged" marker style of the system instructions
+TAGGED_MARKERS = {
+    "### INSTRUCTIONS": "",
+    "### FUNCTIONS AVAILABLE": "<|FUNCTIONS AVAILABLE|>",
+    "### USER QUERY": "<|USER QUERY|>",
+}
 
-def randomize_newline_characters(text):
-    newline_choice = random.choice(["\n", "\r\n"])
-    return text.replace("\n", newline_choice)
 
+def format_system_instructions(system_instructions, marker_style=1, marker_newlines=("", "", ""), newline="\n"):
+    """
+    Format the system instructions.
 
-def randomize_system_instructions_formatting(system_instructions):
+    Args:
+        marker_style (int): 1 keeps the markdown markers, 2 uses the `TAGGED_MARKERS`.
+        marker_newlines (tuple): Newlines inserted before each of the `TAGGED_MARKERS` (style 2 only).
+        newline (str): Newline characters, "\n" or "\r\n".
+    """
+    if marker_style == 2:
+        for (old, new), newline_count in zip(TAGGED_MARKERS.items(), marker_newlines):
+            system_instructions = system_instructions.replace(old, newline_count + new)
+    return system_instructions.replace("\n", newline)
+
+
+def randomize_system_instructions_formatting(system_instructions, rng=random):
     # Randomly choose a formatting style
-    format_style = random.choice([1, 2])
+    format_style = rng.choice([1, 2])
 
+    marker_newlines = ("", "", "")
     if format_style == 2:
         # Replace markers and add random newlines
-        replacements = {
-            "### INSTRUCTIONS": "",
-            "### FUNCTIONS AVAILABLE": "<|FUNCTIONS AVAILABLE|>",
-            "### USER QUERY": "<|USER QUERY|>",
-        }
-        for old, new in replacements.items():
-            newline_count = random.choice(["", "\n", "\n\n"])
-            system_instructions = system_instructions.replace(old, newline_count + new)
+        marker_newlines = tuple(rng.choice(["", "\n", "\n\n"]) for _ in TAGGED_MARKERS)
 
     # Randomize the newline characters in the system instructions
-    system_instructions = randomize_newline_characters(system_instructions)
-
-    return system_instructions
+    newline_choice = rng.choice(["\n", "\r\n"])
+    return format_system_instructions(
+        system_instructions, marker_style=format_style, marker_newlines=marker_newlines, newline=newline_choice
+    )
 
 
-def format_instruction(sample, random_augmentation=True):
-    global iteration_nbr
-    print(f"format {iteration_nbr}")
-    iteration_nbr += 1
+def format_instruction(sample, random_augmentation=True, rng=None):
+    """
+    Format a training sample, randomizing its formatting when `random_augmentation` is set.
 
+    Args:
+        sample (dict): Record with a `corrected_agent_trace` column.
+        random_augmentation (bool): Randomize the instructions markers and newlines, the function
+            order and the functions JSON indentation.
+        rng (random.Random, optional): Random state of the augmentation, defaults to the `random`
+            module. See `core.augmentation` for reproducible per-sample random states.
+    """
+    rng = random if rng is None else rng
     full_prompt = sample["corrected_agent_trace"][0]["value"]
     full_prompt = full_prompt.replace("\r\n", "\n")
 
@@ -143,16 +169,18 @@ def format_instruction(sample, random_augmentation=True):
     if random_augmentation:
         # Randomize the system_instructions formatting
         parsed_data["system_instructions"] = randomize_system_instructions_formatting(
-            parsed_data["system_instructions"]
+            parsed_data["system_instructions"], rng=rng
         )
 
     available_functions_json = parsed_data.get("available_functions_json", [])
     if available_functions_json:
-        available_functions = json.loads(available_functions_json)
         indent = None
         if random_augmentation:
-            random.shuffle(available_functions)
-            indent = random.choice([None, 3, 4])
-        parsed_data["available_functions_json"] = [json.dumps(available_functions, indent=indent)]
+            indent = rng.choice([None, 3, 4])
+        parsed_data["available_functions_json"] = [
+            FunctionCatalog.load(version="v1").reformat(
+                available_functions_json, shuffle=random_augmentation, rng=rng, indent=indent
+            )
+        ]
     formatted_sample = build_full_prompt(parsed_data)
     return formatted_sample
@@ -0,0 +1,151 @@
+import json
+
+from core.output_store import OutputStore
+from core.step_factory import StepType
+from core.token_budget import make_token_counter
+
+COMPACTED_MARKER = " [...]"
+
+
+def _digest_value(value, max_chars):
+    if isinstance(value, dict):
+        return "{" + f"{len(value)} keys" + "}"
+    if isinstance(value, list):
+        return f"[{len(value)} items]"
+    text = json.dumps(value, ensure_ascii=False)
+    return text if len(text) <= max_chars else text[:max_chars] + '..."'
+
+
+def digest_function_output(function_output, max_chars=160):
+    """
+    Compact single line digest of a function output.
+
+    JSON objects keep their keys with short scalar values (nested objects and lists are
+    summarized by their size), JSON lists keep their length and the digest of their first
+    item, other outputs are truncated.
+
+    Args:
+        function_output (str): Function output, as written after `Output[shortuuid]: `.
+        max_chars (int): Approximate maximum length of the digest.
+
+    Returns:
+        str: the output itself if it is already short enough, its digest otherwise.
+    """
+    if len(function_output) <= max_chars:
+        return function_output
+    try:
+        value = json.loads(function_output)
+    except json.JSONDecodeError:
+        return function_output[:max_chars] + COMPACTED_MARKER
+
+    if isinstance(value, dict):
+        items = []
+        length = 2
+        for key, item in value.items():
+            item_text = json.dumps(key, ensure_ascii=False) + ": " + _digest_value(item, max_chars=40)
+            length += len(item_text) + 2
+            if items and length > max_chars:
+                items.append("...")
+                break
+            items.append(item_text)
+        return "{" + ", ".join(items) + "}" + COMPACTED_MARKER
+    if isinstance(value, list):
+        first_item = digest_function_output(json.dumps(value[0], ensure_ascii=False), max_chars // 2) if value else ""
+        return f"[{len(value)} items, first: {first_item}]" + COMPACTED_MARKER
+    return function_output[:max_chars] + COMPACTED_MARKER
+
+
+class ScratchpadCompactor:
+    """
+    Keeps the iterative resolution cycle short by replacing older function outputs with digests.
+
+    Once the scratchpad (the steps after the prompt) exceeds `max_scratchpad_tokens`, all the
+    outputs but the `keep_recent_outputs` last ones are replaced by `digest_function_output`.
+    The `Output[shortuuid]` handles are kept, so the model can still reference them, and the full
+    outputs stay in `side_store` for final-answer linking.
+
+    Args:
+        max_scratchpad_tokens (int): Scratchpad size triggering a compaction.
+        keep_recent_outputs (int): Number of most recent outputs kept verbatim.
+        digest_chars (int): Approximate maximum length of a digest.
+        count_tokens (callable, optional): `count(text) -> int`, see `make_token_counter`. Defaults to
+            the tokenizer of the model of the `GuidedTraceGenerator` using this compactor.
+        side_store (OutputStore, optional): Store of the full outputs, usually the output store of
+            the `GuidedTraceGenerator`.
+    """
+
+    def __init__(
+        self, max_scratchpad_tokens=1024, keep_recent_outputs=1, digest_chars=160, count_tokens=None, side_store=None
+    ):
+        self.max_scratchpad_tokens = max_scratchpad_tokens
+        self.keep_recent_outputs = keep_recent_outputs
+        self.digest_chars = digest_chars
+        self.has_tokenizer = count_tokens is not None
+        self.count_tokens = count_tokens if count_tokens is not None else make_token_counter()
+        self.side_store = side_store if side_store is not None else OutputStore()
+        self.compactions = 0
+        self.saved_tokens = 0
+
+    def use_tokenizer(self, tokenizer):
+        """
+        Count tokens with `tokenizer` (see `make_token_counter`), unless a counter was given.
+        """
+        if not self.has_tokenizer:
+            self.count_tokens = make_token_counter(tokenizer)
+            self.has_tokenizer = True
+
+    def render(self, trace, compacted_outputs=()):
+        """
+        Scratchpad of `trace` (initial prompt excluded), with the outputs `compacted_outputs`
+        (shortuuids) replaced by their digest.
+        """
+        parts = []
+        for step in trace:
+            if step.type == StepType.INITIAL_PROMPT:
+                continue
+            if step.type == StepType.FUNCTION_OUTPUT and step.shortuuid in compacted_outputs:
+                # digest the full output, the step may only hold its preview
+                full_output = self.side_store.get(step.shortuuid, step.function_output)
+                digest = digest_function_output(full_output, max_chars=self.digest_chars)
+                if len(digest) < len(step.function_output):
+                    parts.append(step.diff.replace(step.function_output, digest, 1))
+                    continue
+            parts.append(step.diff)
+        return "".join(parts)
+
+    def compact(self, trace, compacted_outputs=frozenset()):
+        """
+        Return the outputs to compact when the scratchpad is over the threshold, None otherwise
+        (or when nothing more can be compacted).
+
+        Args:
+            trace (list): Steps of the trace.
+            compacted_outputs (frozenset): Shortuuids of the outputs already compacted.
+
+        Returns:
+            frozenset: shortuuids of the outputs to replace by their digest, or None.
+        """
+        scratchpad_tokens = self.count_tokens(self.render(trace, compacted_outputs))
+        if scratchpad_tokens <= self.max_scratchpad_tokens:
+            return None
+
+        output_steps = [step for step in trace if step.type == StepType.FUNCTION_OUTPUT]
+        older_steps = output_steps[: max(0, len(output_steps) - self.keep_recent_outputs)]
+        new_compacted_outputs = frozenset(compacted_outputs) | {step.shortuuid for step in older_steps}
+        if new_compacted_outputs == compacted_outputs:
+            return None
+
+        for step in older_steps:
+            # the store may already hold the full output of a previewed one
+            if step.shortuuid not in self.side_store:
+                self.side_store.put(step.shortuuid, step.function_output)
+        self.compactions += 1
+        self.saved_tokens += scratchpad_tokens - self.count_tokens(self.render(trace, new_compacted_outputs))
+        return new_compacted_outputs
+
+    def stats(self):
+        return {
+            "compactions": self.compactions,
+            "saved_tokens": self.saved_tokens,
+            "stored_outputs": len(self.side_store),
+        }
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Type, Dict
+from typing import Type, Dict, List
 from pydantic import BaseModel
 
 
@@ -80,3 +80,39 @@ def create_step_model(step_type: StepType, **kwargs) -> BaseModel:
     if not model:
         raise ValueError(f"Unknown step type: {step_type}")
     return model(**kwargs)
+
+
+def step_to_dict(step: BaseModel) -> dict:
+    """
+    Serialize a step model to a JSON-compatible dict.
+    """
+    return step.model_dump(mode="json")
+
+
+def step_from_dict(data: dict) -> BaseModel:
+    """
+    Rebuild a step model from a dict produced by `step_to_dict`.
+    """
+    data = dict(data)
+    step_type = StepType(data.pop("type"))
+    return create_step_model(step_type, **data)
+
+
+def steps_before_function(steps: List[BaseModel], fct_name: str) -> List[BaseModel]:
+    """
+    Keep the steps preceding the first iteration (from its thought on) that calls `fct_name`.
+
+    Args:
+        steps (List[BaseModel]): Steps of the iterative resolution cycle.
+        fct_name (str): Name of the function.
+
+    Returns:
+        List[BaseModel]: all the steps when `fct_name` is never called.
+    """
+    iteration_start = 0
+    for i, step in enumerate(steps):
+        if step.type == StepType.THOUGHT:
+            iteration_start = i
+        elif step.type == StepType.FUNCTION_CALL and step.fct_name == fct_name:
+            return list(steps[:iteration_start])
+    return list(steps)
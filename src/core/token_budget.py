@@ -0,0 +1,237 @@
+import math
+
+from core.prompt.function_calling_oneshot import prompt_template as agent_prompt_template
+from core.prompt_builder import parse_corrected_agent_trace
+from dataset_generation.function_catalog import FunctionCatalog
+
+SECTIONS = ("instructions", "example", "functions", "query", "scratchpad")
+TRUNCATION_MARKER = " [...]"
+
+
+def make_token_counter(tokenizer=None):
+    """
+    Return a `count(text) -> int` function.
+
+    Args:
+        tokenizer (optional): A transformers tokenizer, or a guidance model (its engine tokenizer
+            is used). Without tokenizer, tokens are estimated at 4 characters per token.
+    """
+    if tokenizer is None:
+        return lambda text: max(1, len(text) // 4) if text else 0
+    if hasattr(tokenizer, "engine") or not hasattr(tokenizer, "encode"):
+        from core.prefix_cache import count_tokens
+
+        return lambda text: count_tokens(tokenizer, text)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False)) if text else 0
+
+
+def prompt_sections(available_functions, user_query, agent_scratchpad="", prompt_template=agent_prompt_template):
+    """
+    Split the agent prompt into its sections. Concatenating the sections gives the prompt.
+
+    Returns:
+        dict: text of each section of `SECTIONS`.
+    """
+    # prefix_cache depends on guidance, which isn't needed to measure training samples
+    from core.prefix_cache import split_prompt_template
+
+    static_prefix, functions_template, query_template = split_prompt_template(prompt_template)
+    example_start = static_prefix.find("EXAMPLE:")
+    if example_start == -1:
+        example_start = len(static_prefix)
+    query_block = query_template.format(user_query=user_query, agent_scratchpad="")
+    return {
+        "instructions": static_prefix[:example_start],
+        "example": static_prefix[example_start:],
+        "functions": functions_template.format(available_functions=available_functions),
+        "query": query_block,
+        "scratchpad": agent_scratchpad,
+    }
+
+
+def sample_sections(full_prompt):
+    """
+    Split a training sample (a full agent trace, see `parse_corrected_agent_trace`) into `SECTIONS`.
+    """
+    parsed_data = parse_corrected_agent_trace(full_prompt.replace("\r\n", "\n"))
+    return {
+        "instructions": parsed_data["system_instructions"],
+        "example": parsed_data["example"],
+        "functions": parsed_data["available_functions_json"],
+        "query": parsed_data["user_query"],
+        "scratchpad": parsed_data["assistant_completion"],
+    }
+
+
+def truncate_to_tokens(text, max_tokens, count_tokens, marker=TRUNCATION_MARKER):
+    """
+    Truncate `text` to at most `max_tokens` tokens (marker included), cutting on characters.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    # binary search on the kept length, token counts grow with the text length
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle] + marker) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + marker
+
+
+class TokenBudget:
+    """
+    Token budget of the agent prompt.
+
+    The prompt (instructions, example, functions, query and scratchpad) must leave
+    `reserve_tokens` for the next steps within `max_prompt_tokens`. The budget is enforced by
+    dropping the lowest-ranked functions, by truncating long function outputs to
+    `max_output_tokens` and by forcing a final answer once the scratchpad uses the budget up.
+
+    Args:
+        max_prompt_tokens (int): Context size available to the prompt and the generated trace.
+        count_tokens (callable, optional): `count(text) -> int`, see `make_token_counter`. Defaults to
+            the tokenizer of the model of the `GuidedTraceGenerator` using this budget.
+        reserve_tokens (int): Tokens kept for the generation of the next steps.
+        max_output_tokens (int): Maximum tokens of a single function output.
+        min_functions (int): Number of functions never dropped.
+    """
+
+    def __init__(
+        self, max_prompt_tokens, count_tokens=None, reserve_tokens=512, max_output_tokens=256, min_functions=1
+    ):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.has_tokenizer = count_tokens is not None
+        self.count_tokens = count_tokens if count_tokens is not None else make_token_counter()
+        self.reserve_tokens = reserve_tokens
+        self.max_output_tokens = max_output_tokens
+        self.min_functions = min_functions
+        self.dropped_functions = 0
+        self.truncated_outputs = 0
+        self.forced_final_answers = 0
+
+    def use_tokenizer(self, tokenizer):
+        """
+        Count tokens with `tokenizer` (see `make_token_counter`), unless a counter was given.
+        """
+        if not self.has_tokenizer:
+            self.count_tokens = make_token_counter(tokenizer)
+            self.has_tokenizer = True
+
+    @property
+    def limit(self):
+        return self.max_prompt_tokens - self.reserve_tokens
+
+    def measure(self, sections):
+        return {section: self.count_tokens(text) for section, text in sections.items()}
+
+    def fit_functions(self, available_functions, user_query, ranked_names=None, catalog=None):
+        """
+        Drop functions until the prompt fits in the budget.
+
+        Args:
+            available_functions (str): JSON list of functions.
+            user_query (str): The user query.
+            ranked_names (list, optional): Function names by decreasing relevance, the last ones are
+                dropped first. Defaults to the list order.
+            catalog (FunctionCatalog, optional): Used to serialize the kept functions.
+
+        Returns:
+            str: JSON list of the kept functions, in their original order.
+        """
+        sections = prompt_sections(available_functions, user_query)
+        fixed_tokens = sum(self.measure({**sections, "functions": ""}).values())
+        if fixed_tokens + self.count_tokens(sections["functions"]) <= self.limit:
+            return available_functions
+
+        catalog = catalog if catalog is not None else FunctionCatalog.load(version="v1")
+        names = catalog.names_of(available_functions)
+        ranked_names = list(ranked_names) if ranked_names is not None else names
+        kept = [name for name in ranked_names if name in names]
+        while len(kept) > self.min_functions:
+            kept.pop()
+            subset = catalog.reformat(available_functions, include=kept)
+            functions_tokens = self.count_tokens(prompt_sections(subset, user_query)["functions"])
+            if fixed_tokens + functions_tokens <= self.limit:
+                break
+        self.dropped_functions += len(names) - len(kept)
+        return catalog.reformat(available_functions, include=kept)
+
+    def truncate_output(self, function_output):
+        truncated = truncate_to_tokens(function_output, self.max_output_tokens, self.count_tokens)
+        if truncated != function_output:
+            self.truncated_outputs += 1
+        return truncated
+
+    def exhausted(self, prompt):
+        """
+        Whether the prompt so far leaves less than `reserve_tokens` within `max_prompt_tokens`.
+        """
+        return self.count_tokens(prompt) > self.limit
+
+    def stats(self):
+        return {
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "dropped_functions": self.dropped_functions,
+            "truncated_outputs": self.truncated_outputs,
+            "forced_final_answers": self.forced_final_answers,
+        }
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(q / 100 * len(ordered))) - 1] if ordered else 0
+
+
+def section_histograms(samples, count_tokens, bin_size=256):
+    """
+    Token count statistics of each prompt section over a dataset.
+
+    Args:
+        samples (iterable): Full agent traces.
+        count_tokens (callable): `count(text) -> int`, see `make_token_counter`.
+        bin_size (int): Histogram bin width, in tokens.
+
+    Returns:
+        dict: per section (and "total"), the token counts `mean`, `p50`, `p95`, `max` and a
+            `histogram` mapping each bin start to its number of samples.
+    """
+    counts = {section: [] for section in SECTIONS + ("total",)}
+    for sample in samples:
+        tokens = {section: count_tokens(text) for section, text in sample_sections(sample).items()}
+        for section, n_tokens in tokens.items():
+            counts[section].append(n_tokens)
+        counts["total"].append(count_tokens(sample))
+
+    histograms = {}
+    for section, values in counts.items():
+        histogram = {}
+        for value in values:
+            bin_start = value // bin_size * bin_size
+            histogram[bin_start] = histogram.get(bin_start, 0) + 1
+        histograms[section] = {
+            "mean": sum(values) / len(values) if values else 0.0,
+            "p50": _percentile(values, 50),
+            "p95": _percentile(values, 95),
+            "max": max(values, default=0),
+            "histogram": dict(sorted(histogram.items())),
+        }
+    return histograms
+
+
+def format_histograms(histograms, max_tokens=None, width=40):
+    """
+    Render `section_histograms` as text, flagging the bins above `max_tokens`.
+    """
+    lines = []
+    for section, stats in histograms.items():
+        lines.append(
+            f"{section}: mean {stats['mean']:.0f}, p50 {stats['p50']}, p95 {stats['p95']}, max {stats['max']} tokens"
+        )
+        largest_bin = max(stats["histogram"].values(), default=0)
+        for bin_start, n_samples in stats["histogram"].items():
+            bar = "#" * max(1, round(n_samples / largest_bin * width))
+            flag = " > max" if max_tokens is not None and bin_start >= max_tokens else ""
+            lines.append(f"  {bin_start:>6} {n_samples:>6} {bar}{flag}")
+    return "\n".join(lines)
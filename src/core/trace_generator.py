@@ -1,48 +1,228 @@
+import functools
 import json
 
 import shortuuid
-from guidance import models, gen, select
-import torch
+from guidance import gen, select
 
-from dataset_generation.functions_factory import FunctionsFactory
+from dataset_generation.function_catalog import FunctionCatalog
 from core.prompt.function_calling_oneshot import prompt_template as agent_prompt_template
-from core.step_factory import create_step_model, StepType
+from core.backends import create_backend
+from core.prefix_cache import PromptPrefixCache
+from core.grammars import GrammarCache
+from core.step_factory import create_step_model, steps_before_function, StepType
 
-all_available_functions = FunctionsFactory.load_function_variants(version="v1")
-MAX_FUNCS = len(all_available_functions)
 DEFAULT_WORKSPACE = "function_calling"
 DEFAULT_DATASET = "user_query_ds"
+MAX_RESOLUTION_STEPS = 10
+
+
+class TraceState:
+    """
+    Progress of a single trace generated step by step.
+
+    Holds the model state (`lm`), the steps generated so far and the number of
+    function calls made in the iterative resolution cycle.
+    """
+
+    def __init__(
+        self,
+        lm,
+        trace,
+        max_steps=MAX_RESOLUTION_STEPS,
+        key=None,
+        on_delta=None,
+        available_functions=None,
+        user_query=None,
+        execute_functions=True,
+    ):
+        self.lm = lm
+        self.trace = trace
+        self.max_steps = max_steps
+        self.curr_step = 0
+        self.key = key
+        # optional callback called with (step type, text chunk) while a step is generated
+        self.on_delta = on_delta
+        # JSON list of the functions available to the agent
+        self.available_functions = available_functions
+        self.user_query = user_query
+        # run the function executors, otherwise every function output is generated by the model
+        self.execute_functions = execute_functions
+        # shortuuids of the function outputs replaced by a digest in `lm`
+        self.compacted_outputs = frozenset()
+
+    def fork(self):
+        """
+        Return an independent copy of this state. guidance model states are immutable, so the
+        fork shares every token already processed and only diverges from this point on.
+        """
+        state = TraceState(
+            lm=self.lm,
+            trace=list(self.trace),
+            max_steps=self.max_steps,
+            key=self.key,
+            available_functions=self.available_functions,
+            user_query=self.user_query,
+            execute_functions=self.execute_functions,
+        )
+        state.curr_step = self.curr_step
+        state.compacted_outputs = self.compacted_outputs
+        return state
+
+    @property
+    def done(self):
+        return bool(self.trace) and self.trace[-1].type == StepType.FINAL_ANSWER
+
+    @property
+    def next_step_type(self):
+        if not self.trace or self.trace[-1].type in (StepType.INITIAL_PROMPT, StepType.FUNCTION_OUTPUT):
+            return StepType.THOUGHT
+        last_step = self.trace[-1]
+        if last_step.type == StepType.THOUGHT:
+            return StepType.ACTION_CHOICE
+        if last_step.type == StepType.ACTION_CHOICE:
+            if self.curr_step < self.max_steps and "call" in last_step.action_choice.lower():
+                return StepType.FUNCTION_CALL
+            return StepType.FINAL_ANSWER
+        if last_step.type == StepType.FUNCTION_CALL:
+            # several calls can be written before <|wait|>, their outputs are then injected in order
+            if last_step.diff.endswith("<|wait|>"):
+                return StepType.FUNCTION_OUTPUT
+            return StepType.FUNCTION_CALL
+        return None
+
+
+def pending_function_calls(trace):
+    """
+    Return the function calls at the end of `trace` that are waiting for their outputs.
+    """
+    calls = []
+    for step in reversed(trace):
+        if step.type != StepType.FUNCTION_CALL:
+            break
+        calls.append(step)
+    return calls[::-1]
 
 
 class GuidedTraceGenerator:
-    def __init__(self, model_name_or_path, llama2_model=None):
+    def __init__(
+        self,
+        model_name_or_path,
+        llama2_model=None,
+        use_prefix_cache=True,
+        model_kwargs=None,
+        backend="transformers",
+        backend_kwargs=None,
+        executors=None,
+        max_parallel_calls=1,
+        constrained_calls=False,
+        function_retriever=None,
+        max_available_functions=None,
+        token_budget=None,
+        compactor=None,
+        output_store=None,
+    ):
         """
         Initialize the TraceGenerator with specified configuration parameters.
 
         Args:
-            config (dict): Configuration parameters including min_funcs, max_funcs, etc.
+            model_name_or_path (str): Path or hub id of the model used to generate traces.
+            llama2_model (guidance model, optional): Already loaded model instance to use instead.
+            use_prefix_cache (bool): Fork each trace from a cached instructions/example prefix
+                instead of re-feeding the whole prompt.
+            model_kwargs (dict, optional): Keyword arguments used to load the model, defaults to
+                bfloat16 weights on the first GPU. Use e.g. `{"device_map": {"": "cpu"}}` to run on CPU.
+            backend (str or backend): Inference backend, `transformers`, `llamacpp` (quantized GGUF,
+                CPU by default) or `openai` (OpenAI-compatible server), see `core.backends`.
+            backend_kwargs (dict, optional): Backend specific arguments, e.g. `n_ctx` for `llamacpp` or
+                `base_url` for `openai`.
+            executors (ExecutorRegistry, optional): Executors of the functions that are really called.
+                Outputs of the other functions are generated by the model.
+            max_parallel_calls (int): Maximum number of independent `Call function:` lines the model
+                can write before `<|wait|>`. Their executors run concurrently.
+            constrained_calls (bool): Restrict called function names to the available functions and
+                constrain their parameters to the function JSON schema.
+            function_retriever (FunctionRetriever, optional): Only put the `max_available_functions`
+                functions most relevant to the user query in the prompt.
+            max_available_functions (int, optional): Number of functions kept by `function_retriever`.
+            token_budget (TokenBudget, optional): Prompt token budget, enforced by dropping the least
+                relevant functions, truncating function outputs and forcing a final answer.
+            compactor (ScratchpadCompactor, optional): Replaces older function outputs by digests once
+                the iterative resolution cycle gets too long.
+            output_store (OutputStore, optional): Stores the full function outputs, only their preview
+                goes into the prompt.
         """
         self.model_name_or_path = model_name_or_path
 
+        if isinstance(backend, str):
+            backend_kwargs = dict(backend_kwargs or {})
+            if model_kwargs is not None:
+                backend_kwargs["model_kwargs"] = model_kwargs
+            backend = create_backend(backend, self.model_name_or_path, **backend_kwargs)
+        self.backend = backend
         if llama2_model is None:
-            llama2_model = models.Transformers(
-                model=self.model_name_or_path,
-                torch_dtype=torch.bfloat16,
-                device_map={"": 0},
-            )
+            llama2_model = backend.load()
         self.llama2_model = llama2_model
+        self.prefix_cache = PromptPrefixCache(self.llama2_model) if use_prefix_cache else None
+        self.executors = executors
+        self.max_parallel_calls = max_parallel_calls
+        if constrained_calls and not backend.supports_grammars:
+            print(f"The {backend.name} backend doesn't support grammars, function calls are not constrained.")
+            constrained_calls = False
+        self.grammars = GrammarCache() if constrained_calls else None
+        self.function_catalog = FunctionCatalog.load(version="v1")
+        self.function_retriever = function_retriever
+        self.max_available_functions = max_available_functions
+        self.token_budget = token_budget
+        if token_budget is not None:
+            token_budget.use_tokenizer(self.llama2_model)
+        self.output_store = output_store
+        self.compactor = compactor
+        if compactor is not None:
+            compactor.use_tokenizer(self.llama2_model)
+            if output_store is not None:
+                compactor.side_store = output_store
+
+    def _extend(self, lm, grammar, on_delta=None):
+        """
+        Append `grammar` to the model state, calling `on_delta(text)` with each new chunk of
+        generated text when a callback is given.
 
-    def _generate_thought(self, lm, trace, prefix="", suffix="", temperature=0.25):
-        lm += (
-            prefix
-            + "Thought: "
-            + gen(
-                max_tokens=500,
-                name="thought",
-                stop="\n",
-                temperature=temperature,
-            )
-            + suffix
+        The stream is generated by guidance on its own thread: if `on_delta` raises, the stream
+        is still consumed to its end before the exception is re-raised, so that the engine isn't
+        in use anymore once this returns.
+        """
+        if on_delta is None:
+            return lm + grammar
+        prompt_length = len(str(lm))
+        emitted = 0
+        stream = iter(lm.stream() + grammar)
+        try:
+            for lm_partial in stream:
+                text = str(lm_partial)[prompt_length:]
+                if len(text) > emitted:
+                    on_delta(text[emitted:])
+                    emitted = len(text)
+        except BaseException:
+            for _ in stream:
+                pass
+            raise
+        return lm_partial
+
+    def _generate_thought(self, lm, trace, prefix="", suffix="", temperature=0.25, on_delta=None):
+        lm = self._extend(
+            lm,
+            (
+                prefix
+                + "Thought: "
+                + gen(
+                    max_tokens=500,
+                    name="thought",
+                    stop="\n",
+                    temperature=temperature,
+                )
+                + suffix
+            ),
+            on_delta=on_delta,
         )
         step = create_step_model(
             step_type=StepType.THOUGHT,
@@ -54,7 +234,7 @@ class GuidedTraceGenerator:
 
     def _generate_thought_missing_function(self, lm, trace, prefix="", suffix=""):
         forced_thought = "I can't find any function that could be helpful to answer user query. I need to abort the Iterative Resolution Cycle and return a final answer."
-        lm += prefix + forced_thought + suffix
+        lm += prefix + "Thought: " + forced_thought + suffix
         step = create_step_model(
             step_type=StepType.THOUGHT,
             thought=forced_thought,
@@ -63,18 +243,22 @@ class GuidedTraceGenerator:
         trace.append(step)
         return lm
 
-    def _generate_action_choice(self, lm, trace, prefix="", suffix=""):
-        lm += (
-            prefix
-            + "Action choice: "
-            + select(
-                options=[
-                    "call function",
-                    "final answer",
-                ],
-                name="action_choice",
-            )
-            + suffix
+    def _generate_action_choice(self, lm, trace, prefix="", suffix="", on_delta=None):
+        lm = self._extend(
+            lm,
+            (
+                prefix
+                + "Action choice: "
+                + select(
+                    options=[
+                        "call function",
+                        "final answer",
+                    ],
+                    name="action_choice",
+                )
+                + suffix
+            ),
+            on_delta=on_delta,
         )
         step = create_step_model(
             step_type=StepType.ACTION_CHOICE,
@@ -84,20 +268,69 @@ class GuidedTraceGenerator:
         trace.append(step)
         return lm
 
-    def _generate_function_call(self, lm, trace, prefix="", suffix="<|wait|>", temperature=0.0):
-        lm += (
-            prefix
-            + 'Call function: {"name": "'
-            + gen("fct_name", stop='"')
-            + '"}, "parameters": '
-            + gen(
-                max_tokens=500,
-                name="fct_parameters",
-                stop=["\n", "<|wait|>"],
-                temperature=temperature,
-            )
-            + suffix
+    def _generate_forced_action_choice(self, lm, trace, action_choice, prefix="", suffix="", on_delta=None):
+        lm += prefix + "Action choice: " + action_choice + suffix
+        if on_delta is not None:
+            on_delta(prefix + "Action choice: " + action_choice + suffix)
+        step = create_step_model(
+            step_type=StepType.ACTION_CHOICE,
+            action_choice=action_choice,
+            diff=prefix + "Action choice: " + action_choice + suffix,
         )
+        trace.append(step)
+        return lm
+
+    def _generate_function_call(
+        self,
+        lm,
+        trace,
+        prefix="",
+        suffix="<|wait|>",
+        temperature=0.0,
+        allow_more_calls=False,
+        functions=None,
+        on_delta=None,
+    ):
+        """
+        Generate a `Call function:` step. When `functions` (parameters schema of each available
+        function, keyed by name) is given, the name is selected among the available functions and
+        the parameters are constrained to the schema of the selected function.
+        """
+        if allow_more_calls:
+            # either wait for the output, or write another independent call on the next line
+            suffix = select(options=["<|wait|>", "\n"], name="call_suffix")
+        if functions is None:
+            lm = self._extend(
+                lm,
+                (
+                    prefix
+                    + 'Call function: {"name": "'
+                    + gen("fct_name", stop='"')
+                    + '"}, "parameters": '
+                    + gen(
+                        max_tokens=500,
+                        name="fct_parameters",
+                        stop=["\n", "<|wait|>"],
+                        temperature=temperature,
+                    )
+                    + suffix
+                ),
+                on_delta=on_delta,
+            )
+        else:
+            # the parameters grammar depends on the selected function
+            lm = self._extend(
+                lm,
+                prefix + 'Call function: {"name": "' + self.grammars.name_grammar(functions) + '"}, "parameters": ',
+                on_delta=on_delta,
+            )
+            lm = self._extend(
+                lm,
+                self.grammars.parameters_grammar(functions[lm["fct_name"]], temperature=temperature) + suffix,
+                on_delta=on_delta,
+            )
+        if allow_more_calls:
+            suffix = lm["call_suffix"]
         step = create_step_model(
             step_type=StepType.FUNCTION_CALL,
             fct_name=lm["fct_name"],
@@ -112,18 +345,74 @@ class GuidedTraceGenerator:
         trace.append(step)
         return lm
 
-    def _generate_function_output(self, lm, trace, prefix="", suffix="", temperature=1):
+    def _inject_function_output(self, lm, trace, function_output, prefix="", suffix="", on_delta=None):
+        # Append the real result of a function call, generation resumes from there
         shortuuid_output = shortuuid.uuid()
-        lm += (
-            prefix
-            + f"Output[{shortuuid_output}]: "
-            + gen(
-                max_tokens=500,
-                name="function_output",
-                stop="\n",
-                temperature=temperature,
+        if self.output_store is not None:
+            function_output = self.output_store.store(shortuuid_output, function_output)
+        if self.token_budget is not None:
+            function_output = self.token_budget.truncate_output(function_output)
+        diff = prefix + f"Output[{shortuuid_output}]: " + function_output + suffix
+        lm += diff
+        if on_delta is not None:
+            on_delta(diff)
+        step = create_step_model(
+            step_type=StepType.FUNCTION_OUTPUT,
+            shortuuid=shortuuid_output,
+            function_output=function_output,
+            diff=diff,
+        )
+        trace.append(step)
+        return lm
+
+    def _full_output(self, step):
+        # the prompt may only hold a preview of the output
+        if self.output_store is None:
+            return step.function_output
+        return self.output_store.get(step.shortuuid, step.function_output)
+
+    def _generate_function_outputs(self, lm, trace, prefix="", on_delta=None, execute_functions=True):
+        """
+        Add the outputs of all the calls written before `<|wait|>`, in call order.
+
+        Calls having an executor are executed concurrently (unless `execute_functions` is False),
+        the outputs of the other calls are generated by the model.
+        """
+        call_steps = pending_function_calls(trace)
+        executed_outputs = {}
+        if self.executors is not None and execute_functions:
+            outputs = {
+                step.shortuuid: self._full_output(step) for step in trace if step.type == StepType.FUNCTION_OUTPUT
+            }
+            executable = [(i, step) for i, step in enumerate(call_steps) if step.fct_name in self.executors]
+            results = self.executors.execute_many(
+                [(step.fct_name, step.fct_parameters) for _, step in executable], outputs=outputs
             )
-            + suffix
+            executed_outputs = {i: result for (i, _), result in zip(executable, results)}
+
+        for i in range(len(call_steps)):
+            if i in executed_outputs:
+                lm = self._inject_function_output(lm, trace, executed_outputs[i], prefix=prefix, on_delta=on_delta)
+            else:
+                lm = self._generate_function_output(lm, trace, prefix=prefix, on_delta=on_delta)
+        return lm
+
+    def _generate_function_output(self, lm, trace, prefix="", suffix="", temperature=1, on_delta=None):
+        shortuuid_output = shortuuid.uuid()
+        lm = self._extend(
+            lm,
+            (
+                prefix
+                + f"Output[{shortuuid_output}]: "
+                + gen(
+                    max_tokens=self.token_budget.max_output_tokens if self.token_budget is not None else 500,
+                    name="function_output",
+                    stop="\n",
+                    temperature=temperature,
+                )
+                + suffix
+            ),
+            on_delta=on_delta,
         )
         step = create_step_model(
             step_type=StepType.FUNCTION_OUTPUT,
@@ -131,19 +420,27 @@ class GuidedTraceGenerator:
             function_output=lm["function_output"],
             diff=prefix + f"Output[{shortuuid_output}]: " + lm["function_output"] + suffix,
         )
+        if self.output_store is not None:
+            self.output_store.put(shortuuid_output, lm["function_output"])
         trace.append(step)
         return lm
 
-    def _generate_final_answer(self, lm, trace, prefix="\n\n### FINAL ANSWER\n", suffix="<|wait|>", temperature=0.5):
-        lm += (
-            prefix
-            + gen(
-                max_tokens=500,
-                name="final_answer",
-                temperature=temperature,
-                stop=["### INSTRUCTIONS", "### USER QUERY", "<|wait|>"],
-            )
-            + suffix
+    def _generate_final_answer(
+        self, lm, trace, prefix="\n\n### FINAL ANSWER\n", suffix="<|wait|>", temperature=0.5, on_delta=None
+    ):
+        lm = self._extend(
+            lm,
+            (
+                prefix
+                + gen(
+                    max_tokens=500,
+                    name="final_answer",
+                    temperature=temperature,
+                    stop=["### INSTRUCTIONS", "### USER QUERY", "<|wait|>"],
+                )
+                + suffix
+            ),
+            on_delta=on_delta,
         )
         step = create_step_model(
             step_type=StepType.FINAL_ANSWER,
@@ -156,49 +453,103 @@ class GuidedTraceGenerator:
     def _generate_agent_prompt(
         self, lm, trace, available_functions, user_query, agent_scratchpad="", prefix="", suffix=""
     ):
-        lm += (
-            prefix
-            + agent_prompt_template.format(
-                available_functions=available_functions,
-                user_query=user_query,
-                agent_scratchpad=agent_scratchpad,
-            )
-            + suffix
+        agent_prompt = agent_prompt_template.format(
+            available_functions=available_functions,
+            user_query=user_query,
+            agent_scratchpad=agent_scratchpad,
         )
+        if self.prefix_cache is not None and lm is self.llama2_model and not prefix:
+            # Fork from the cached instructions/example (and function list) prefix
+            lm = (
+                self.prefix_cache.fork(
+                    available_functions=available_functions,
+                    user_query=user_query,
+                    agent_scratchpad=agent_scratchpad,
+                )
+                + suffix
+            )
+        else:
+            lm += prefix + agent_prompt + suffix
         step = create_step_model(
             step_type=StepType.INITIAL_PROMPT,
-            diff=prefix
-            + agent_prompt_template.format(
-                available_functions=available_functions,
-                user_query=user_query,
-                agent_scratchpad=agent_scratchpad,
-            )
-            + suffix,
+            diff=prefix + agent_prompt + suffix,
         )
         trace.append(step)
         return lm
 
-    def generate_trace_missing_function(self, trace, available_functions, user_query, next_thought_prefix):
+    def generate_trace_missing_function(
+        self, trace, available_functions, user_query, next_thought_prefix=None, removed_function=None
+    ):
+        """
+        Build the counterfactual trace where the agent can't find a helpful function.
+
+        This is not a fork of the nominal model state: the function list differs, so a new prompt
+        is built (only the cached instructions/example prefix is reused) and the steps of `trace`
+        (initial prompt excluded) are replayed as text, which processes them again. Only the final
+        answer is generated.
+
+        Args:
+            trace (list): Steps to keep, starting with the initial prompt.
+            available_functions (str): Function list of the counterfactual prompt.
+            user_query (str): The user query.
+            next_thought_prefix (str, optional): Prefix of the forced thought, inferred from `trace` by default.
+            removed_function (str, optional): Function missing from `available_functions`, the replayed
+                steps stop before the first iteration calling it.
+        """
+        alt_trace = []
         # Instantiate agent prompt
         lm = self._generate_agent_prompt(
             lm=self.llama2_model,
-            trace=trace,
+            trace=alt_trace,
             available_functions=available_functions,
             user_query=user_query,
         )
 
-        # Generate synthetic thought
-        lm = self._generate_thought_missing_function(lm=lm, trace=trace, prefix=next_thought_prefix)
+        # Replay the steps already generated
+        replayed_steps = [step for step in trace if step.type != StepType.INITIAL_PROMPT]
+        if removed_function is not None:
+            # the counterfactual agent can't have called the missing function before
+            replayed_steps = steps_before_function(replayed_steps, removed_function)
+        lm += "".join(step.diff for step in replayed_steps)
+        alt_trace.extend(replayed_steps)
 
-        # Final answer
-        lm = self._generate_final_answer(lm=lm, trace=trace)
+        if next_thought_prefix is None:
+            next_thought_prefix = "\n" if replayed_steps else ""
 
-        return trace
+        # Generate synthetic thought
+        lm = self._generate_thought_missing_function(lm=lm, trace=alt_trace, prefix=next_thought_prefix)
+        lm = self._generate_forced_action_choice(lm=lm, trace=alt_trace, action_choice="final answer", prefix="\n")
 
-    def generate_single_trace(self, available_functions, user_query, lm=None, start_step=0, case="nominal"):
+        # Final answer
+        lm = self._generate_final_answer(lm=lm, trace=alt_trace)
+
+        return alt_trace
+
+    def _init_state(
+        self,
+        available_functions,
+        user_query,
+        lm=None,
+        start_step=0,
+        max_steps=MAX_RESOLUTION_STEPS,
+        key=None,
+        on_delta=None,
+        execute_functions=True,
+    ):
         trace = []
 
         if lm is None:
+            if self.function_retriever is not None:
+                available_functions = self.function_retriever.retrieve_json(
+                    available_functions, user_query, k=self.max_available_functions, catalog=self.function_catalog
+                )
+            if self.token_budget is not None:
+                ranked_names = None
+                if self.function_retriever is not None:
+                    ranked_names = self.function_retriever.rank(user_query, json.loads(available_functions))
+                available_functions = self.token_budget.fit_functions(
+                    available_functions, user_query, ranked_names=ranked_names, catalog=self.function_catalog
+                )
             # Instantiate agent prompt
             lm = self._generate_agent_prompt(
                 lm=self.llama2_model, trace=trace, available_functions=available_functions, user_query=user_query
@@ -207,86 +558,251 @@ class GuidedTraceGenerator:
                 print("Warning: argument `start_step=0` ignored as agent has been reinitialized")
             start_step = 0
 
-        # Iterative resolution cycle, with at most 10 steps
-        max_steps = 10
-        curr_step = 0  # track number of steps
+        return TraceState(
+            lm=lm,
+            trace=trace,
+            max_steps=max_steps,
+            key=key,
+            on_delta=on_delta,
+            available_functions=available_functions,
+            user_query=user_query,
+            execute_functions=execute_functions,
+        )
 
-        # because prompt starts with a new line, we use prefix="" here
-        lm = self._generate_thought(lm=lm, trace=trace, prefix="")
-        lm = self._generate_action_choice(lm=lm, trace=trace, prefix="\n")
-        while (curr_step < max_steps) and ("call" in trace[-1].action_choice.lower()):
-            curr_step += 1
-            lm = self._generate_function_call(lm=lm, trace=trace, prefix="\n")
-            lm = self._generate_function_output(lm=lm, trace=trace, prefix="\n")
-            lm = self._generate_thought(lm=lm, trace=trace, prefix="\n")
-            lm = self._generate_action_choice(lm=lm, trace=trace, prefix="\n")
+    def _call_functions(self, state):
+        # parameters schema of each available function, when function calls are constrained
+        if self.grammars is None or state.available_functions is None:
+            return None
+        return self.grammars.functions_by_name(state.available_functions)
 
-        # Final answer
-        lm = self._generate_final_answer(lm=lm, trace=trace)
+    def _compact(self, state):
+        """
+        Rebuild the model state of a trace with its older function outputs replaced by digests, when
+        its scratchpad is over the compactor threshold. The prompt is forked from the prefix cache.
+        """
+        compacted_outputs = self.compactor.compact(state.trace, state.compacted_outputs)
+        if compacted_outputs is None or state.user_query is None:
+            return
+        lm = self._generate_agent_prompt(
+            lm=self.llama2_model,
+            trace=[],
+            available_functions=state.available_functions,
+            user_query=state.user_query,
+        )
+        state.lm = lm + self.compactor.render(state.trace, compacted_outputs)
+        state.compacted_outputs = compacted_outputs
+
+    def _advance(self, state):
+        """
+        Generate the next step of a trace and return the new steps (several function
+        outputs are added at once when several calls were written before `<|wait|>`).
+        """
+        step_type = state.next_step_type
+        trace_length = len(state.trace)
+        last_step_type = state.trace[-1].type if state.trace else StepType.INITIAL_PROMPT
+        # first thought directly follows the prompt, which ends with a new line, and a call following
+        # another call starts on the line opened by the previous one
+        prefix = (
+            ""
+            if (step_type == StepType.THOUGHT and last_step_type == StepType.INITIAL_PROMPT)
+            or (step_type == StepType.FUNCTION_CALL and last_step_type == StepType.FUNCTION_CALL)
+            else "\n"
+        )
+        on_delta = None
+        if state.on_delta is not None:
+            on_delta = functools.partial(state.on_delta, step_type)
+
+        if step_type == StepType.THOUGHT:
+            if self.compactor is not None and last_step_type == StepType.FUNCTION_OUTPUT:
+                self._compact(state)
+            state.lm = self._generate_thought(lm=state.lm, trace=state.trace, prefix=prefix, on_delta=on_delta)
+        elif step_type == StepType.ACTION_CHOICE:
+            if self.token_budget is not None and self.token_budget.exhausted(str(state.lm)):
+                # no room left for another call and its output
+                self.token_budget.forced_final_answers += 1
+                state.lm = self._generate_forced_action_choice(
+                    lm=state.lm, trace=state.trace, action_choice="final answer", prefix=prefix, on_delta=on_delta
+                )
+            else:
+                state.lm = self._generate_action_choice(
+                    lm=state.lm, trace=state.trace, prefix=prefix, on_delta=on_delta
+                )
+        elif step_type == StepType.FUNCTION_CALL:
+            if last_step_type != StepType.FUNCTION_CALL:
+                state.curr_step += 1
+            state.lm = self._generate_function_call(
+                lm=state.lm,
+                trace=state.trace,
+                prefix=prefix,
+                allow_more_calls=len(pending_function_calls(state.trace)) + 1 < self.max_parallel_calls,
+                functions=self._call_functions(state),
+                on_delta=on_delta,
+            )
+        elif step_type == StepType.FUNCTION_OUTPUT:
+            state.lm = self._generate_function_outputs(
+                lm=state.lm,
+                trace=state.trace,
+                prefix=prefix,
+                on_delta=on_delta,
+                execute_functions=state.execute_functions,
+            )
+        elif step_type == StepType.FINAL_ANSWER:
+            state.lm = self._generate_final_answer(lm=state.lm, trace=state.trace, on_delta=on_delta)
+        else:
+            raise ValueError("Trace is already complete.")
+        return state.trace[trace_length:]
+
+    def generate_single_trace(
+        self, available_functions, user_query, lm=None, start_step=0, case="nominal", execute_functions=True
+    ):
+        """
+        Generate a single trace. With `execute_functions=False`, no executor is called and every
+        function output is generated by the model (e.g. for warm-up traces, without side effects).
+        """
+        state = self._init_state(
+            available_functions=available_functions,
+            user_query=user_query,
+            lm=lm,
+            start_step=start_step,
+            execute_functions=execute_functions,
+        )
 
-        return trace
+        # Iterative resolution cycle, with at most MAX_RESOLUTION_STEPS function calls
+        while not state.done:
+            self._advance(state)
 
-    def generate_traces(self, available_functions, user_query, lm=None, start_step=0, case="nominal"):
-        traces = []
-        trace = []
+        return state.trace
 
-        if lm is None:
-            # Instantiate agent prompt
-            lm = self._generate_agent_prompt(
-                lm=self.llama2_model,
-                trace=trace,
-                available_functions=available_functions,
-                user_query=user_query,
+    def iter_trace_steps(self, available_functions, user_query, on_delta=None):
+        """
+        Generate a single trace, yielding each step as soon as it is complete.
+
+        Args:
+            available_functions (str): JSON list of the functions available to the agent.
+            user_query (str): The user query.
+            on_delta (callable, optional): Called with (step type, text chunk) as tokens of
+                the current step are generated.
+
+        Yields:
+            BaseModel: step models, starting with the initial prompt.
+        """
+        state = self._init_state(available_functions=available_functions, user_query=user_query, on_delta=on_delta)
+        yield from state.trace
+
+        while not state.done:
+            yield from self._advance(state)
+
+    def generate_record_traces(self, records):
+        """
+        Generate a trace for each record, one after the other.
+
+        guidance engines process a single sequence and keep the KV cache of the last one,
+        so traces are generated in turn. Records are ordered by function list so that the
+        records sharing one follow each other and reuse its cached prompt prefix (see
+        `PromptPrefixCache`); `records` is read entirely before the first trace.
+
+        Args:
+            records (iterable): dicts with `available_functions` and `user_query` keys, and
+                optionally an `index` key (defaults to the position in `records`).
+
+        Yields:
+            tuple: (record index, trace), grouped by function list.
+        """
+        ordered = sorted(enumerate(records), key=lambda item: item[1]["available_functions"])
+        for position, record in ordered:
+            trace = self.generate_single_trace(
+                available_functions=record["available_functions"], user_query=record["user_query"]
             )
-            if start_step != 0:
-                print("Warning: argument `start_step=0` ignored as agent has been reinitialized")
-            start_step = 0
+            yield record.get("index", position), trace
+
+    def _generate_alternative_call(self, state, temperature):
+        # state is a fork taken right before a function call, possibly chained to the previous calls
+        pending_calls = pending_function_calls(state.trace)
+        if not pending_calls:
+            state.curr_step += 1
+        state.lm = self._generate_function_call(
+            lm=state.lm,
+            trace=state.trace,
+            prefix="" if pending_calls else "\n",
+            temperature=temperature,
+            allow_more_calls=len(pending_calls) + 1 < self.max_parallel_calls,
+            functions=self._call_functions(state),
+        )
+        while not state.done:
+            self._advance(state)
+        return state.trace
+
+    def generate_traces(
+        self,
+        available_functions,
+        user_query,
+        lm=None,
+        start_step=0,
+        case="nominal",
+        branches_per_call=1,
+        branch_temperature=0.7,
+        max_steps=5,
+    ):
+        """
+        Generate a nominal trace plus counterfactual branches at each function call.
 
-        # Iterative resolution cycle, with at most 10 steps
-        max_steps = 5
-        curr_step = 0  # track number of steps
+        At each call step, the model state is forked right before the call:
+        - a "missing function" branch where the chosen function is removed from the
+          available functions and the agent aborts with a final answer,
+        - `branches_per_call - 1` branches where the call is re-sampled with
+          `branch_temperature` and the cycle is continued from the fork.
 
-        next_thought_prefix = ""
-        lm = self._generate_thought(
+        Re-sampled branches are forks of the nominal state: they share all the tokens already
+        processed and only pay for the tokens they generate. The missing function branch has a
+        different prompt, it only reuses the cached instructions/example prefix and processes
+        the replayed steps again (see `generate_trace_missing_function`).
+
+        Returns:
+            list: branch traces in generation order, the nominal trace last.
+        """
+        traces = []
+        state = self._init_state(
+            available_functions=available_functions,
+            user_query=user_query,
             lm=lm,
-            trace=trace,
-            prefix="",  # because prompt starts with a new line
+            start_step=start_step,
+            max_steps=max_steps,
         )
-        lm = self._generate_action_choice(lm=lm, trace=trace, prefix="\n")
-        while (curr_step < max_steps) and ("call" in trace[-1].action_choice.lower()):
-            curr_step += 1
-            lm = self._generate_function_call(lm=lm, trace=trace, prefix="\n")
-
-            # Branch in another future instance where trace where chosen function is not available
-            chosen_function_name = trace[-1]["fct_name"]
-            alt_available_functions = json.dumps(
-                [
-                    function_dict
-                    for function_dict in json.loads(available_functions)
-                    if function_dict["name"] != chosen_function_name
-                ]
-            )
-            alt_generator = GuidedTraceGenerator(
-                self.config,
-                llama2_model=self.llama2_model,  # use same LLM instance
-            )
-            alt_trace = alt_generator.generate_trace_missing_function(
-                trace=trace[
-                    0:-3
-                ],  # generate a new trace where last Thought, Action Choice, and Function call are removed
-                available_functions=alt_available_functions,  # current functions with chosen function removed
-                user_query=user_query,
-                next_thought_prefix=next_thought_prefix,
+
+        while not state.done:
+            if state.next_step_type != StepType.FUNCTION_CALL:
+                self._advance(state)
+                continue
+
+            branch_point = state.fork()
+            # calls already written before <|wait|> in this iteration
+            pending_calls = len(pending_function_calls(branch_point.trace))
+            call_step = self._advance(state)[0]
+
+            # Branch in another future instance where the chosen function is not available
+            alt_available_functions = self.function_catalog.without(state.available_functions, call_step.fct_name)
+            traces.append(
+                self.generate_trace_missing_function(
+                    # last Thought, Action Choice and the calls of the pending call group are removed
+                    trace=branch_point.trace[: len(branch_point.trace) - pending_calls - 2],
+                    available_functions=alt_available_functions,
+                    user_query=user_query,
+                    removed_function=call_step.fct_name,
+                )
             )
-            traces.append(alt_trace)
-            lm = self._generate_function_output(lm=lm, trace=trace, prefix="\n")
-            lm = self._generate_thought(lm=lm, trace=trace, prefix="\n")
-            lm = self._generate_action_choice(lm=lm, trace=trace, prefix="\n")
 
-        # Final answer
-        lm = self._generate_final_answer(lm=lm, trace=trace)
+            # Branch in futures where another function call is sampled
+            sampled_calls = {call_step.diff}
+            for _ in range(branches_per_call - 1):
+                alt_state = branch_point.fork()
+                alt_trace = self._generate_alternative_call(alt_state, temperature=branch_temperature)
+                alt_call_step = alt_trace[len(branch_point.trace)]
+                if alt_call_step.diff in sampled_calls:
+                    continue
+                sampled_calls.add(alt_call_step.diff)
+                traces.append(alt_trace)
 
-        traces.append(trace)
+        traces.append(state.trace)
 
         return traces
 
@@ -294,7 +810,7 @@ class GuidedTraceGenerator:
         # Build agent trace
         trace_str = ""
         for step in trace:
-            trace_str += step["diff"]
+            trace_str += step.diff
         return trace_str
 
     def trace_to_argilla_record(self, available_functions, user_query, trace):
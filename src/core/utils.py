@@ -67,7 +67,11 @@ def format_generate_user_query(available_functions, user_query=None):
     return text
 
 
-def shuffle_json_functions(available_functions):
+def shuffle_json_functions(available_functions, catalog=None):
+    if catalog is not None:
+        # reuses the pre-serialized functions of a FunctionCatalog
+        return catalog.shuffle_json(available_functions)
+
     # Shuffle the list of functions
     functions = json.loads(available_functions)
     random.shuffle(functions)
@@ -0,0 +1,197 @@
+import json
+import random
+from collections import OrderedDict
+
+from jsonschema import Draft7Validator
+
+from dataset_generation.functions_factory import FunctionsFactory
+
+
+def _indent_json(function_json, indent):
+    # json.dumps(functions, indent=n) indents each function once more than json.dumps(function, indent=n)
+    padding = " " * indent
+    return "\n".join(padding + line for line in function_json.splitlines())
+
+
+def join_json(parts, indent=None):
+    """
+    Join pre-serialized list items exactly as `json.dumps(items, indent=indent)` would.
+    """
+    if not parts:
+        return "[]"
+    if indent is None:
+        return "[" + ", ".join(parts) + "]"
+    return "[\n" + ",\n".join(parts) + "\n]"
+
+
+class FunctionCatalog:
+    """
+    A function variant loaded once, with each function pre-serialized and its parameters
+    schema pre-compiled.
+
+    Serializing a subset, a shuffled list or a list without a given function joins the
+    pre-serialized functions instead of re-parsing and re-dumping JSON. The default form
+    matches `json.dumps(functions)` (what the prompts and datasets contain), the compact
+    form uses `(",", ":")` separators.
+
+    Args:
+        functions (list): Function definitions (`name`, `description`, `parameters`).
+        max_function_lists (int): Number of parsed JSON function lists kept (LRU).
+    """
+
+    _catalogs = {}
+
+    def __init__(self, functions, max_function_lists=1024):
+        self.functions = list(functions)
+        self.names = [function["name"] for function in self.functions]
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._json = [json.dumps(function) for function in self.functions]
+        self._compact_json = [
+            json.dumps(function, ensure_ascii=False, separators=(",", ":")) for function in self.functions
+        ]
+        # indent -> pre-serialized functions, filled on first use
+        self._indented_json = {}
+        self._validators = [Draft7Validator(function.get("parameters", {})) for function in self.functions]
+        self.max_function_lists = max_function_lists
+        # JSON function list -> [(name, catalog index or parsed function)]
+        self._function_lists = OrderedDict()
+
+    @classmethod
+    def load(cls, version="v1"):
+        """
+        Return the catalog of a function variant (see `FunctionsFactory.load_function_variants`),
+        built once per process.
+        """
+        if version not in cls._catalogs:
+            cls._catalogs[version] = cls(FunctionsFactory.load_function_variants(version=version))
+        return cls._catalogs[version]
+
+    def __len__(self):
+        return len(self.functions)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        return self.functions[self._index[name]]
+
+    def get(self, name, default=None):
+        i = self._index.get(name)
+        return default if i is None else self.functions[i]
+
+    def validator(self, name):
+        return self._validators[self._index[name]]
+
+    def validate(self, name, parameters):
+        """
+        Validate call parameters against the schema of function `name`.
+
+        Returns:
+            list: error messages, empty when the parameters are valid.
+        """
+        return [error.message for error in self.validator(name).iter_errors(parameters)]
+
+    def is_valid(self, name, parameters):
+        return self.validator(name).is_valid(parameters)
+
+    def function_json(self, name, compact=False, indent=None):
+        i = self._index[name]
+        if compact:
+            return self._compact_json[i]
+        if indent is None:
+            return self._json[i]
+        if indent not in self._indented_json:
+            self._indented_json[indent] = [
+                _indent_json(json.dumps(function, indent=indent), indent) for function in self.functions
+            ]
+        return self._indented_json[indent][i]
+
+    def to_json(self, names=None, shuffle=False, rng=None, compact=False, indent=None):
+        """
+        Serialize the functions `names` (all functions by default) to a JSON list.
+
+        Args:
+            names (list, optional): Names of the functions, in order.
+            shuffle (bool): Shuffle the functions, with `rng` (a `random.Random`) if given.
+            compact (bool): Use `(",", ":")` separators instead of the `json.dumps` defaults.
+            indent (int, optional): Same as the `indent` argument of `json.dumps`.
+
+        Returns:
+            str: JSON list of the functions.
+        """
+        names = list(self.names if names is None else names)
+        if shuffle:
+            (rng or random).shuffle(names)
+        if compact:
+            return "[" + ",".join(self.function_json(name, compact=True) for name in names) + "]"
+        return join_json([self.function_json(name, indent=indent) for name in names], indent=indent)
+
+    def sample_json(self, k, rng=None, compact=False):
+        """
+        Serialize `k` functions sampled without replacement.
+        """
+        return self.to_json((rng or random).sample(self.names, k), compact=compact)
+
+    def _parse(self, available_functions):
+        # functions of the catalog are referenced by index, unknown ones are kept as parsed
+        if available_functions in self._function_lists:
+            self._function_lists.move_to_end(available_functions)
+            return self._function_lists[available_functions]
+        parts = []
+        for function in json.loads(available_functions):
+            i = self._index.get(function.get("name"))
+            parts.append((function.get("name"), i if i is not None and self.functions[i] == function else function))
+        self._function_lists[available_functions] = parts
+        if len(self._function_lists) > self.max_function_lists:
+            self._function_lists.popitem(last=False)
+        return parts
+
+    def _part_json(self, part, indent=None):
+        name, function = part
+        if not isinstance(function, dict):
+            return self.function_json(name, indent=indent)
+        if indent is None:
+            return json.dumps(function)
+        return _indent_json(json.dumps(function, indent=indent), indent)
+
+    def names_of(self, available_functions):
+        """
+        Names of the functions of a JSON function list, in order.
+        """
+        return [name for name, _ in self._parse(available_functions)]
+
+    def reformat(self, available_functions, shuffle=False, rng=None, indent=None, exclude=None, include=None):
+        """
+        Re-serialize a JSON function list, e.g. read from a dataset record. Lists already seen
+        are not re-parsed, and functions of the catalog are not re-serialized.
+
+        Args:
+            available_functions (str): JSON list of functions.
+            shuffle (bool): Shuffle the functions, with `rng` (a `random.Random`) if given.
+            indent (int, optional): Same as the `indent` argument of `json.dumps`.
+            exclude (str, optional): Name of a function to leave out.
+            include (list, optional): Names of the functions to keep, all by default.
+
+        Returns:
+            str: same as `json.dumps(functions, indent=indent)` on the parsed, filtered and shuffled list.
+        """
+        parts = [
+            part
+            for part in self._parse(available_functions)
+            if (exclude is None or part[0] != exclude) and (include is None or part[0] in include)
+        ]
+        if shuffle:
+            (rng or random).shuffle(parts)
+        return join_json([self._part_json(part, indent=indent) for part in parts], indent=indent)
+
+    def shuffle_json(self, available_functions, rng=None):
+        """
+        Same as `core.utils.shuffle_json_functions`.
+        """
+        return self.reformat(available_functions, shuffle=True, rng=rng)
+
+    def without(self, available_functions, name):
+        """
+        Serialize a JSON function list without the function `name`.
+        """
+        return self.reformat(available_functions, exclude=name)
@@ -0,0 +1,53 @@
+from core.utils import shuffle_json_functions
+from dataset_generation.function_catalog import FunctionCatalog
+from dataset_generation.run_journal import RunJournal
+
+
+def read_dataset_record(record):
+    """
+    (available functions, user query) of a record of a Hugging Face dataset (hub or disk).
+    """
+    return record["available_functions"], record["corrected_user_query"][0]["value"]
+
+
+def read_argilla_record(record):
+    """
+    (available functions, user query) of an argilla FeedbackRecord.
+    """
+    return record.fields["available_functions"], record.responses[0].values["corrected_user_query"].value
+
+
+def iter_generation_records(records, start=0, end=None, journal=None, read_record=read_dataset_record):
+    """
+    Yield the generation records of `records[start:end]`, skipping the ones already in `journal`.
+
+    Args:
+        records: Indexable source records.
+        start (int): First index.
+        end (int, optional): Index after the last one, defaults to `len(records)`.
+        journal (RunJournal, optional): Journal of the run, its completed records are skipped.
+        read_record (callable): `read_record(record) -> (available_functions, user_query)`.
+
+    Yields:
+        dict: `index`, `content_hash`, `available_functions` (shuffled) and `user_query`.
+    """
+    catalog = FunctionCatalog.load(version="v1")
+    end = len(records) if end is None else end
+
+    for i in range(start, end):
+        try:
+            available_functions, user_query = read_record(records[i])
+        except IndexError:
+            print(f"Skipping generation n°{i}...")
+            continue
+
+        content_hash = RunJournal.content_hash(available_functions, user_query)
+        if journal is not None and journal.is_completed(i, content_hash):
+            continue
+
+        yield {
+            "index": i,
+            "content_hash": content_hash,
+            "available_functions": shuffle_json_functions(available_functions=available_functions, catalog=catalog),
+            "user_query": user_query,
+        }
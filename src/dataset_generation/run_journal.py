@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import time
+
+from core.step_factory import step_from_dict, step_to_dict
+
+
+class RunJournal:
+    """
+    Append-only JSONL journal of the traces produced by a generation run.
+
+    Each line stores one finished record, keyed by its index in the source dataset and
+    a hash of its content, so that a crashed or preempted run can be restarted and skip
+    the records that were already completed. Lines are flushed and fsync'ed as soon as
+    they are written; a truncated last line (crash during a write) is ignored on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._load()
+
+    @staticmethod
+    def content_hash(available_functions, user_query):
+        content = json.dumps([available_functions, user_query], ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line_nbr, line in enumerate(file):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Ignoring corrupted journal line {line_nbr} in {self.path}")
+                    continue
+                self._entries[entry["index"]] = entry
+        # Terminate a partially written last line so that the next entry starts on its own line
+        with open(self.path, "rb+") as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell() > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+
+    def is_completed(self, index, content_hash):
+        entry = self._entries.get(index)
+        return entry is not None and entry["content_hash"] == content_hash
+
+    def record(self, index, content_hash, available_functions, user_query, traces, **metadata):
+        """
+        Append a finished record to the journal.
+
+        Args:
+            index (int): Index of the record in the source dataset.
+            content_hash (str): Hash returned by `RunJournal.content_hash` for the source record.
+            available_functions (str): Functions given to the agent (as prompted).
+            user_query (str): The user query.
+            traces (list): Generated traces, each a list of step models.
+            **metadata: Additional JSON-serializable fields stored with the entry.
+        """
+        entry = {
+            "index": index,
+            "content_hash": content_hash,
+            "available_functions": available_functions,
+            "user_query": user_query,
+            "traces": [[step_to_dict(step) for step in trace] for trace in traces],
+            "created_at": time.time(),
+            **metadata,
+        }
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self._entries[index] = entry
+
+    def completed_indices(self):
+        return sorted(self._entries)
+
+    def entries(self):
+        """
+        Return the journal entries ordered by record index.
+        """
+        return [self._entries[index] for index in sorted(self._entries)]
+
+    @staticmethod
+    def load_traces(entry):
+        return [[step_from_dict(step) for step in trace] for trace in entry["traces"]]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, index):
+        return index in self._entries
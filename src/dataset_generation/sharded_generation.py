@@ -0,0 +1,288 @@
+# sharded_generation.py
+#
+# Example, on CPU with a tiny model to check sharding and merging:
+#   python src/dataset_generation/sharded_generation.py \
+#       --dataset_path /workspace/datasets/irca_user_query_dataset_v5-6 \
+#       --output_path /tmp/irca_agent_traces.jsonl \
+#       --model_name_or_path sshleifer/tiny-gpt2 --num_workers 2 --limit 8 --cpu
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dataset_generation.generation_records import iter_generation_records
+from dataset_generation.run_journal import RunJournal
+
+
+def shard_ranges(n_records, n_shards):
+    """
+    Split `range(n_records)` into `n_shards` contiguous index ranges of (almost) equal size.
+
+    Returns:
+        list: (start, end) tuples, `end` excluded. Empty shards are dropped.
+    """
+    shard_size, remainder = divmod(n_records, n_shards)
+    ranges = []
+    start = 0
+    for shard_id in range(n_shards):
+        end = start + shard_size + (1 if shard_id < remainder else 0)
+        if end > start:
+            ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def shard_device(shard_id, gpus):
+    """
+    GPU of a worker, shards are spread round-robin over `gpus`. None when running without GPU.
+    """
+    if not gpus:
+        return None
+    return gpus[shard_id % len(gpus)]
+
+
+def visible_gpus():
+    """
+    Ids of the GPUs visible to this process, from `CUDA_VISIBLE_DEVICES` or else from torch.
+    """
+    cuda_visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if cuda_visible_devices is not None:
+        return [device for device in cuda_visible_devices.split(",") if device.strip()]
+    try:
+        import torch
+    except ImportError:
+        return []
+    return [str(device) for device in range(torch.cuda.device_count())]
+
+
+def shard_journal_path(journal_dir, shard_id):
+    return os.path.join(journal_dir, f"shard-{shard_id:03d}.jsonl")
+
+
+def generate_shard(
+    shard_id,
+    start,
+    end,
+    dataset_path,
+    journal_dir,
+    model_name_or_path,
+    model_kwargs,
+    seed,
+    backend,
+    device=None,
+):
+    """
+    Worker entry point: generate the traces of records `[start, end)` into the shard journal.
+
+    Each worker loads its own copy of the dataset and of the model, on its own GPU (`device`) when given:
+    it is the only GPU visible to the worker, so the model loads on it as `cuda:0`.
+
+    Returns:
+        dict: per-worker statistics.
+    """
+    if device is not None:
+        # set before torch initializes CUDA in this process
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+
+    from datasets import load_from_disk
+
+    from core.trace_generator import GuidedTraceGenerator
+
+    random.seed(seed + shard_id)
+    records = load_from_disk(dataset_path)
+    journal = RunJournal(shard_journal_path(journal_dir, shard_id))
+
+    load_start = time.perf_counter()
+    trace_generator = GuidedTraceGenerator(
+        model_name_or_path=model_name_or_path, model_kwargs=model_kwargs, backend=backend
+    )
+    load_seconds = time.perf_counter() - load_start
+
+    in_flight = {}
+
+    def track(shard_records):
+        for record in shard_records:
+            in_flight[record["index"]] = record
+            yield record
+
+    generated = 0
+    generation_start = time.perf_counter()
+    for i, trace in trace_generator.generate_record_traces(
+        track(iter_generation_records(records, start, end, journal=journal))
+    ):
+        record = in_flight.pop(i)
+        journal.record(
+            index=i,
+            content_hash=record["content_hash"],
+            available_functions=record["available_functions"],
+            user_query=record["user_query"],
+            traces=[trace],
+            model_name_or_path=model_name_or_path,
+            shard_id=shard_id,
+        )
+        generated += 1
+    generation_seconds = time.perf_counter() - generation_start
+
+    return {
+        "shard_id": shard_id,
+        "start": start,
+        "end": end,
+        "device": device,
+        "generated": generated,
+        "completed": len(journal),
+        "load_seconds": load_seconds,
+        "generation_seconds": generation_seconds,
+        "traces_per_hour": generated * 3600 / generation_seconds if generation_seconds > 0 else 0.0,
+    }
+
+
+def merge_journals(journal_paths, output_path):
+    """
+    Merge shard journals into a single JSONL file ordered by record index.
+
+    Returns:
+        int: number of merged records.
+    """
+    entries = {}
+    for journal_path in journal_paths:
+        for entry in RunJournal(journal_path).entries():
+            entries[entry["index"]] = entry
+
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as file:
+        for index in sorted(entries):
+            file.write(json.dumps(entries[index], ensure_ascii=False) + "\n")
+    return len(entries)
+
+
+def run_sharded_generation(
+    dataset_path,
+    output_path,
+    model_name_or_path,
+    num_workers,
+    journal_dir=None,
+    model_kwargs=None,
+    limit=None,
+    seed=0,
+    backend="transformers",
+    gpus=None,
+):
+    """
+    Generate traces over a dataset saved on disk with `num_workers` processes.
+
+    The dataset is sharded by index range, each worker owns its model instance and
+    its journal (so interrupted runs resume per shard), and the shard journals are
+    merged into `output_path` ordered by record index.
+
+    Workers are spread round-robin over `gpus` (ids of the GPUs, defaults to the visible
+    ones), pass an empty list to run on CPU.
+
+    Returns:
+        list: per-worker statistics.
+    """
+    from datasets import load_from_disk
+
+    n_records = len(load_from_disk(dataset_path))
+    if limit is not None:
+        n_records = min(n_records, limit)
+    if journal_dir is None:
+        journal_dir = output_path + ".shards"
+    os.makedirs(journal_dir, exist_ok=True)
+
+    ranges = shard_ranges(n_records, num_workers)
+    if gpus is None:
+        gpus = visible_gpus()
+    print(f"Generating {n_records} records with {len(ranges)} workers on GPUs {gpus or 'none'}: {ranges}")
+
+    stats = []
+    # CUDA can't be re-initialized in forked processes
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=mp_context) as executor:
+        futures = [
+            executor.submit(
+                generate_shard,
+                shard_id,
+                start,
+                end,
+                dataset_path,
+                journal_dir,
+                model_name_or_path,
+                model_kwargs,
+                seed,
+                backend,
+                shard_device(shard_id, gpus),
+            )
+            for shard_id, (start, end) in enumerate(ranges)
+        ]
+        for future in as_completed(futures):
+            worker_stats = future.result()
+            print(
+                f"shard {worker_stats['shard_id']} [{worker_stats['start']}, {worker_stats['end']}) "
+                f"on GPU {worker_stats['device']}: {worker_stats['generated']} traces "
+                f"in {worker_stats['generation_seconds']:.1f}s "
+                f"({worker_stats['traces_per_hour']:.1f} traces/hour, model loaded in {worker_stats['load_seconds']:.1f}s)"
+            )
+            stats.append(worker_stats)
+
+    journal_paths = [shard_journal_path(journal_dir, shard_id) for shard_id in range(len(ranges))]
+    merged = merge_journals(journal_paths, output_path)
+    total_traces_per_hour = sum(worker_stats["traces_per_hour"] for worker_stats in stats)
+    print(f"{merged} records merged into {output_path} ({total_traces_per_hour:.1f} traces/hour overall)")
+
+    return sorted(stats, key=lambda worker_stats: worker_stats["shard_id"])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Sharded IRCA agent trace generation")
+    parser.add_argument("--dataset_path", type=str, required=True, help="Source dataset saved with save_to_disk.")
+    parser.add_argument("--output_path", type=str, required=True, help="Merged JSONL output.")
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--journal_dir", type=str, default=None)
+    parser.add_argument("--limit", type=int, default=None, help="Only generate the first N records.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cpu", action="store_true", help="Load the model on CPU (e.g. a tiny test model).")
+    parser.add_argument(
+        "--gpus",
+        type=str,
+        default=None,
+        help="Comma-separated GPU ids the workers are spread over, defaults to the visible GPUs.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="transformers",
+        choices=["transformers", "llamacpp", "openai"],
+        help="Inference backend, llamacpp runs a quantized GGUF model on CPU.",
+    )
+    return parser
+
+
+def main():
+    args = parse_arguments().parse_args()
+    model_kwargs = {"device_map": {"": "cpu"}} if args.cpu and args.backend == "transformers" else None
+    gpus = [] if args.cpu else None
+    if args.gpus is not None and not args.cpu:
+        gpus = [gpu for gpu in args.gpus.split(",") if gpu.strip()]
+    run_sharded_generation(
+        dataset_path=args.dataset_path,
+        output_path=args.output_path,
+        model_name_or_path=args.model_name_or_path,
+        num_workers=args.num_workers,
+        journal_dir=args.journal_dir,
+        model_kwargs=model_kwargs,
+        limit=args.limit,
+        seed=args.seed,
+        backend=args.backend,
+        gpus=gpus,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,26 @@ training_args = {
     "lora_alpha": 64,
     "num_train_epochs": 5,
     "learning_rate": 1e-3,
+    # longer samples are reported before training, see core/token_budget.py
+    "max_seq_length": 4096,
+    # augment and tokenize the dataset once (see finetuning/dataset_preprocessing.py) instead of formatting
+    # samples on the fly, each record gives `augmented_variants` samples, cached by tokenizer and seed. Every variant
+    # is augmented, none keeps the original formatting (as with on-the-fly formatting)
+    "pretokenized_dataset": True,
+    "augmented_variants": 5,
+    "augmentation_seed": 0,
+    "preprocessing_num_proc": 8,
+    "tokenized_dataset_cache_dir": "/workspace/datasets/tokenized",
+    # with the pretokenized dataset, only compute the loss on the resolution cycle written by the agent, not on
+    # the shared instructions, example and functions, and optionally not on the function outputs either
+    "completion_only_loss": True,
+    "mask_function_outputs": True,
+    # pack the tokenized samples into max_seq_length sequences with first-fit-decreasing bin packing (see
+    # finetuning/packing.py). With "flash_attention_2", samples are kept apart by position ids restarting at 0;
+    # other attention implementations (None is the transformers default) get a block-diagonal attention mask
+    # (memory in max_seq_length^2)
+    "bin_packing": True,
+    "attn_implementation": None,
     "model_settings": {
         "mistral": {
             "base_model": "mistralai/Mistral-7B-Instruct-v0.2",
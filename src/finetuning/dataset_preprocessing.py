@@ -0,0 +1,256 @@
+# dataset_preprocessing.py
+#
+# Materializes the augmented training samples and tokenizes them once, so that training steps
+# only read token ids from an Arrow cache instead of formatting and tokenizing samples on the fly.
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+from core.augmentation import AugmentationEngine
+from core.prompt_builder import RESOLUTION_CYCLE_MARKER
+
+logger = logging.getLogger(__name__)
+
+# bump when the augmentation or the tokenization changes, to invalidate the caches
+PREPROCESSING_VERSION = 3
+
+# function outputs in the resolution cycle, written by the environment and not by the agent
+OUTPUT_LINE = re.compile(r"^Output\[[^\]\n]*\]:[^\n]*\n?", re.MULTILINE)
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Identify a tokenizer by its name, vocabulary and special tokens.
+    """
+    description = {
+        "class": type(tokenizer).__name__,
+        "name_or_path": getattr(tokenizer, "name_or_path", None),
+        "vocab_size": len(tokenizer),
+        "special_tokens": {name: str(value) for name, value in sorted(tokenizer.special_tokens_map.items())},
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def cache_key(
+    dataset_fingerprint, tokenizer, num_variants, seed, max_seq_length, completion_only=False, mask_outputs=False
+):
+    """
+    Key of a tokenized dataset cache: the source dataset, the tokenizer, the augmentation
+    (number of variants and seed), the sequence length and the loss masking.
+    """
+    description = {
+        "dataset": dataset_fingerprint,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "num_variants": num_variants,
+        "seed": seed,
+        "max_seq_length": max_seq_length,
+        "completion_only": completion_only,
+        "mask_outputs": mask_outputs,
+        "version": PREPROCESSING_VERSION,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def completion_spans(text, mask_outputs=False):
+    """
+    Character spans of `text` written by the agent: what follows the last `### ITERATIVE RESOLUTION
+    CYCLE` marker, without the `Output[...]` lines when `mask_outputs` is set. The whole text is
+    returned when the marker is missing.
+
+    Returns:
+        list: sorted `(start, end)` spans.
+    """
+    start = text.rfind(RESOLUTION_CYCLE_MARKER)
+    start = 0 if start == -1 else start + len(RESOLUTION_CYCLE_MARKER)
+    if not mask_outputs:
+        return [(start, len(text))]
+    spans = []
+    for output in OUTPUT_LINE.finditer(text, start):
+        spans.append((start, output.start()))
+        start = output.end()
+    spans.append((start, len(text)))
+    return [(start, end) for start, end in spans if end > start]
+
+
+def mask_labels(input_ids, offsets, spans):
+    """
+    Labels of a tokenized sample, -100 (ignored by the loss) for the tokens outside `spans`.
+
+    Args:
+        input_ids (list): Token ids.
+        offsets (list): `(start, end)` character offsets of the tokens, `(0, 0)` for special tokens.
+        spans (list): Sorted `(start, end)` character spans to train on, see `completion_spans`.
+    """
+    labels = []
+    span_index = 0
+    for token_id, (start, end) in zip(input_ids, offsets):
+        while span_index < len(spans) and spans[span_index][1] <= start:
+            span_index += 1
+        in_span = span_index < len(spans) and end > start and end > spans[span_index][0]
+        labels.append(token_id if in_span else -100)
+    return labels
+
+
+def tokenize_batch(batch, tokenizer, max_seq_length, completion_only=False, mask_outputs=False):
+    """
+    `datasets.map(batched=True)` function tokenizing the samples, ending them with the EOS token and
+    truncating them to `max_seq_length` tokens.
+
+    With `completion_only`, the loss is only computed on the resolution cycle (and the EOS token),
+    the tokens of the instructions, example, functions and user query get a -100 label, as well as
+    the function outputs with `mask_outputs` (see `completion_spans`). Needs a fast tokenizer, for
+    the offsets of the tokens.
+    """
+    encodings = tokenizer(
+        batch["text"], add_special_tokens=True, truncation=False, return_offsets_mapping=completion_only
+    )
+    input_ids = []
+    labels = []
+    truncated = []
+    for index, ids in enumerate(encodings["input_ids"]):
+        sample_labels = list(ids)
+        if completion_only:
+            spans = completion_spans(batch["text"][index], mask_outputs=mask_outputs)
+            sample_labels = mask_labels(ids, encodings["offset_mapping"][index], spans)
+        ids = ids + [tokenizer.eos_token_id]
+        sample_labels = sample_labels + [tokenizer.eos_token_id]
+        truncated.append(len(ids) > max_seq_length)
+        input_ids.append(ids[:max_seq_length])
+        labels.append(sample_labels[:max_seq_length])
+    return {
+        "input_ids": input_ids,
+        "attention_mask": [[1] * len(ids) for ids in input_ids],
+        "labels": labels,
+        "length": [len(ids) for ids in input_ids],
+        "trained_tokens": [sum(label != -100 for label in sample_labels) for sample_labels in labels],
+        "truncated": truncated,
+    }
+
+
+def report_tokenized_dataset(tokenized, max_seq_length, completion_only=False):
+    """
+    Warn about the samples truncated to `max_seq_length` and report the share of trained tokens, from the
+    columns of the tokenized dataset (nothing is tokenized again).
+    """
+    n_truncated = sum(tokenized["truncated"])
+    if n_truncated:
+        logger.warning(f"{n_truncated}/{len(tokenized)} samples truncated to max_seq_length={max_seq_length}.")
+    if completion_only:
+        total_tokens = sum(tokenized["length"])
+        trained_tokens = sum(tokenized["trained_tokens"])
+        logger.info(f"Loss computed on {trained_tokens}/{total_tokens} tokens ({trained_tokens / total_tokens:.1%}).")
+
+
+def build_tokenized_dataset(
+    dataset,
+    tokenizer,
+    num_variants=4,
+    seed=0,
+    max_seq_length=4096,
+    completion_only=False,
+    mask_outputs=False,
+    num_proc=None,
+    cache_dir=None,
+):
+    """
+    Augment and tokenize a training dataset once, caching the result on disk.
+
+    Args:
+        dataset (datasets.Dataset): Records with a `corrected_agent_trace` column.
+        tokenizer: A transformers tokenizer.
+        num_variants (int): Samples generated per record, the augmentations of epochs 0 to
+            `num_variants - 1` of `AugmentationEngine` (all of them augmented).
+        seed (int): Augmentation seed.
+        max_seq_length (int): Samples are truncated to this number of tokens.
+        completion_only (bool): Only compute the loss on the resolution cycle, see `tokenize_batch`.
+        mask_outputs (bool): With `completion_only`, also leave the function outputs out of the loss.
+        num_proc (int, optional): Processes of `datasets.map`.
+        cache_dir (str, optional): Directory of the tokenized datasets, keyed by `cache_key`. Without
+            it, only the `datasets` cache files are reused.
+
+    Returns:
+        datasets.Dataset: `input_ids`, `attention_mask`, `labels`, `length`, `trained_tokens`, `truncated`,
+            `record_index` and `epoch` columns.
+    """
+    import datasets
+
+    cache_path = None
+    if cache_dir is not None:
+        key = cache_key(
+            dataset._fingerprint, tokenizer, num_variants, seed, max_seq_length, completion_only, mask_outputs
+        )
+        cache_path = os.path.join(cache_dir, key)
+        if os.path.isdir(cache_path):
+            logger.info(f"Loading the tokenized dataset from {cache_path}")
+            tokenized = datasets.load_from_disk(cache_path)
+            report_tokenized_dataset(tokenized, max_seq_length, completion_only)
+            return tokenized
+
+    # the augmentation of a sample only depends on its index and epoch, not on num_proc or batch boundaries
+    augmented = dataset.map(
+        AugmentationEngine(seed=seed).augment_batch,
+        batched=True,
+        with_indices=True,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc,
+        fn_kwargs={"epochs": list(range(num_variants))},
+        desc="Augmenting samples",
+    )
+    tokenized = augmented.map(
+        tokenize_batch,
+        batched=True,
+        remove_columns=["text"],
+        num_proc=num_proc,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "max_seq_length": max_seq_length,
+            "completion_only": completion_only,
+            "mask_outputs": mask_outputs,
+        },
+        desc="Tokenizing samples",
+    )
+
+    report_tokenized_dataset(tokenized, max_seq_length, completion_only)
+    if cache_path is not None:
+        tokenized.save_to_disk(cache_path)
+        logger.info(f"Tokenized dataset saved to {cache_path}")
+    return tokenized
+
+
+def main():
+    import argparse
+
+    import datasets
+    import transformers
+
+    from defaults.v1.training_args import training_args
+
+    parser = argparse.ArgumentParser(description="Build the tokenized training dataset cache ahead of training")
+    parser.add_argument("--model_type", type=str, default="mistral", help="Model whose tokenizer is used.")
+    parser.add_argument("--dataset", type=str, default=training_args["dataset"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        training_args["model_settings"][args.model_type]["base_model"]
+    )
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenized = build_tokenized_dataset(
+        datasets.load_dataset(args.dataset)["train"],
+        tokenizer,
+        num_variants=training_args["augmented_variants"],
+        seed=training_args["augmentation_seed"],
+        max_seq_length=training_args["max_seq_length"],
+        completion_only=training_args["completion_only_loss"],
+        mask_outputs=training_args["mask_function_outputs"],
+        num_proc=training_args["preprocessing_num_proc"],
+        cache_dir=training_args["tokenized_dataset_cache_dir"],
+    )
+    print(f"{len(tokenized)} samples, {sum(tokenized['length'])} tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,22 @@
 
 import os
 import argparse
+import math
 import torch
 import logging
 import sys
 import trl
 import datasets
 import transformers
+import packaging.version
 import peft
 import huggingface_hub
 import dotenv
 import core.utils as utils
 import core.prompt_builder as prompt_builder
+import core.token_budget as token_budget
+import finetuning.dataset_preprocessing as dataset_preprocessing
+import finetuning.packing as packing
 
 from defaults.v1.training_args import training_args
 
@@ -27,6 +32,10 @@ FINETUNED_MODELS_DIR = "finetuned_models"
 LOG_LEVEL = logging.DEBUG
 VERSION = "v1"
 SCHEMA_PATH = f"/workspace/src/core/schemas/{VERSION}/training_args.json"
+# training samples measured by section for the token count histograms (debug level)
+HISTOGRAM_SAMPLES = 1000
+# 4D custom attention masks and flash attention splitting the packed sequences on their position ids
+MIN_BIN_PACKING_TRANSFORMERS_VERSION = "4.44.0"
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -96,6 +105,7 @@ def load_and_prepare_model(config, peft_config):
         use_cache=False,
         device_map="auto",
         trust_remote_code=True,
+        attn_implementation=config["attn_implementation"],
     )
     model.config.pretraining_tp = 1
 
@@ -109,10 +119,61 @@ def load_and_prepare_model(config, peft_config):
     return model, tokenizer
 
 
+def log_section_histograms(train_dataset, tokenizer, max_seq_length, max_samples=HISTOGRAM_SAMPLES):
+    """
+    Report the per-section token counts of up to `max_samples` training samples, evenly spread over
+    the dataset, at debug level only.
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or not len(train_dataset):
+        return None
+    step = max(1, math.ceil(len(train_dataset) / max_samples))
+    samples = [
+        sample["corrected_agent_trace"][0]["value"]
+        for sample in train_dataset.select(range(0, len(train_dataset), step))
+    ]
+    histograms = token_budget.section_histograms(samples, token_budget.make_token_counter(tokenizer))
+    logger.debug(
+        f"Token counts of {len(samples)} training samples:\n"
+        + token_budget.format_histograms(histograms, max_seq_length)
+    )
+    return histograms
+
+
+def check_sample_lengths(train_dataset, tokenizer, max_seq_length):
+    """
+    Warn about the training samples longer than `max_seq_length`, which would otherwise be silently
+    split by packing. Only used when samples are formatted on the fly, the pretokenized dataset reports
+    its truncated samples from its own columns (see `dataset_preprocessing.report_tokenized_dataset`).
+    """
+    count_tokens = token_budget.make_token_counter(tokenizer)
+    lengths = [count_tokens(sample["corrected_agent_trace"][0]["value"]) for sample in train_dataset]
+    too_long = sum(length > max_seq_length for length in lengths)
+    if too_long:
+        logger.warning(
+            f"{too_long}/{len(lengths)} training samples are longer than max_seq_length={max_seq_length} "
+            f"(longest: {max(lengths)} tokens)."
+        )
+    return too_long
+
+
 def setup_training(model, tokenizer, dataset, training_args, peft_config=None):
+    num_train_epochs = training_args["num_train_epochs"]
+    if training_args["pretokenized_dataset"]:
+        # each record has `augmented_variants` samples, keep the number of samples seen per record
+        num_train_epochs = num_train_epochs / training_args["augmented_variants"]
+    bin_packing = training_args["pretokenized_dataset"] and training_args["bin_packing"]
+    if bin_packing and packaging.version.parse(transformers.__version__) < packaging.version.parse(
+        MIN_BIN_PACKING_TRANSFORMERS_VERSION
+    ):
+        # older versions would let the packed samples attend to each other without any error
+        raise RuntimeError(
+            f"bin_packing needs transformers>={MIN_BIN_PACKING_TRANSFORMERS_VERSION}, "
+            f"{transformers.__version__} is installed."
+        )
+
     model_args = transformers.TrainingArguments(
         output_dir=os.path.join(WORKSPACE_DIR, MODELS_DIR, FINETUNED_MODELS_DIR, training_args["model_name"]),
-        num_train_epochs=training_args["num_train_epochs"],
+        num_train_epochs=num_train_epochs,
         per_device_train_batch_size=1,
         gradient_accumulation_steps=10,
         gradient_checkpointing=False,
@@ -126,14 +187,62 @@ def setup_training(model, tokenizer, dataset, training_args, peft_config=None):
         warmup_ratio=0.03,
         lr_scheduler_type="constant",
         disable_tqdm=False,
+        # the packed samples' sequence_lengths column isn't a model input but builds the attention mask
+        remove_unused_columns=not bin_packing,
     )
 
     train_dataset = dataset["train"]
+    log_section_histograms(train_dataset, tokenizer, training_args["max_seq_length"])
+
+    if training_args["pretokenized_dataset"]:
+        # augmented and tokenized once, training steps only read token ids from the Arrow cache
+        tokenized_dataset = dataset_preprocessing.build_tokenized_dataset(
+            train_dataset,
+            tokenizer,
+            num_variants=training_args["augmented_variants"],
+            seed=training_args["augmentation_seed"],
+            max_seq_length=training_args["max_seq_length"],
+            completion_only=training_args["completion_only_loss"],
+            mask_outputs=training_args["mask_function_outputs"],
+            num_proc=training_args["preprocessing_num_proc"],
+            cache_dir=training_args["tokenized_dataset_cache_dir"],
+        )
+        train_dataset = tokenized_dataset.select_columns(["input_ids", "attention_mask", "labels"])
+        data_collator = transformers.DataCollatorForSeq2Seq(tokenizer, padding=True, label_pad_token_id=-100)
+        if bin_packing:
+            # whole samples packed into max_seq_length sequences, none is split across sequences
+            train_dataset, packing_stats = packing.pack_dataset(tokenized_dataset, training_args["max_seq_length"])
+            logger.info(f"Packing stats: {packing_stats}")
+            # flash attention keeps the samples apart with the position ids, other implementations need the 4D mask
+            data_collator = packing.PackedDataCollator(
+                tokenizer.pad_token_id,
+                block_diagonal_attention=training_args["attn_implementation"] != "flash_attention_2",
+            )
+        # num_train_epochs is divided by augmented_variants, still save a checkpoint after each original epoch
+        samples_per_step = model_args.train_batch_size * model_args.gradient_accumulation_steps * model_args.world_size
+        save_steps = math.ceil(len(train_dataset) / training_args["augmented_variants"] / samples_per_step)
+        model_args = model_args.set_save(strategy="steps", steps=max(save_steps, 1))
+        trainer = transformers.Trainer(
+            model=model,
+            args=model_args,
+            train_dataset=train_dataset,
+            data_collator=data_collator,
+            tokenizer=tokenizer,
+        )
+        return trainer
+
+    if training_args["completion_only_loss"]:
+        # trl's completion-only collator doesn't support packing=True, the loss masking needs the pretokenized dataset
+        logger.warning(
+            "completion_only_loss (and mask_function_outputs) only apply with pretokenized_dataset, the loss is "
+            "computed on the whole samples."
+        )
+    check_sample_lengths(train_dataset, tokenizer, training_args["max_seq_length"])
     trainer = trl.SFTTrainer(
         model=model,
         train_dataset=train_dataset,
         peft_config=peft_config,
-        max_seq_length=4096,
+        max_seq_length=training_args["max_seq_length"],
         tokenizer=tokenizer,
         packing=True,
         formatting_func=prompt_builder.format_instruction,
@@ -160,6 +269,16 @@ def load_config(model_type):
         "lora_alpha": training_args["lora_alpha"],
         "num_train_epochs": training_args["num_train_epochs"],
         "learning_rate": training_args["learning_rate"],
+        "max_seq_length": training_args["max_seq_length"],
+        "pretokenized_dataset": training_args["pretokenized_dataset"],
+        "augmented_variants": training_args["augmented_variants"],
+        "augmentation_seed": training_args["augmentation_seed"],
+        "preprocessing_num_proc": training_args["preprocessing_num_proc"],
+        "tokenized_dataset_cache_dir": training_args["tokenized_dataset_cache_dir"],
+        "completion_only_loss": training_args["completion_only_loss"],
+        "mask_function_outputs": training_args["mask_function_outputs"],
+        "bin_packing": training_args["bin_packing"],
+        "attn_implementation": training_args["attn_implementation"],
         "base_model": model_config["base_model"],
         "model_name": model_name,
     }
@@ -0,0 +1,198 @@
+# packing.py
+#
+# Length-aware packing of the tokenized training samples (see dataset_preprocessing.py) into
+# max_seq_length sequences, without splitting samples across sequences.
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _MaxTree:
+    """
+    Segment tree over the remaining capacity of `size` bins, to find the first bin with room
+    for an item in O(log size).
+    """
+
+    def __init__(self, size, capacity):
+        self.leaves = 1
+        while self.leaves < size:
+            self.leaves *= 2
+        self.values = [0] * (2 * self.leaves)
+        for leaf in range(size):
+            self.values[self.leaves + leaf] = capacity
+        for node in range(self.leaves - 1, 0, -1):
+            self.values[node] = max(self.values[2 * node], self.values[2 * node + 1])
+
+    def first_fit(self, length):
+        """
+        Index of the first bin with at least `length` remaining, -1 if none.
+        """
+        if self.values[1] < length:
+            return -1
+        node = 1
+        while node < self.leaves:
+            node = 2 * node if self.values[2 * node] >= length else 2 * node + 1
+        return node - self.leaves
+
+    def consume(self, leaf, length):
+        node = self.leaves + leaf
+        self.values[node] -= length
+        node //= 2
+        while node:
+            self.values[node] = max(self.values[2 * node], self.values[2 * node + 1])
+            node //= 2
+
+
+def first_fit_decreasing(lengths, capacity):
+    """
+    Pack items of `lengths` into bins of `capacity` with the first-fit-decreasing heuristic.
+
+    Args:
+        lengths (list): Item lengths, each at most `capacity`.
+        capacity (int): Bin capacity.
+
+    Returns:
+        list: bins, as lists of item indices (in decreasing length order within a bin).
+    """
+    if any(length > capacity for length in lengths):
+        raise ValueError(f"Items longer than the capacity ({capacity}) can't be packed, truncate them first.")
+    order = sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True)
+    tree = _MaxTree(len(lengths), capacity)
+    bins = []
+    for index in order:
+        bin_index = tree.first_fit(lengths[index])
+        if bin_index == len(bins):
+            bins.append([])
+        bins[bin_index].append(index)
+        tree.consume(bin_index, lengths[index])
+    return bins
+
+
+def packing_stats(lengths, bins, capacity):
+    """
+    Efficiency of a packing: share of the sequence tokens that are sample tokens, padding waste, and
+    the number of sequences compared to one sample per sequence.
+    """
+    total_tokens = sum(lengths)
+    sequence_tokens = len(bins) * capacity
+    return {
+        "samples": len(lengths),
+        "packed_sequences": len(bins),
+        "samples_per_sequence": len(lengths) / len(bins) if bins else 0.0,
+        "pack_efficiency": total_tokens / sequence_tokens if bins else 0.0,
+        "padding_tokens": sequence_tokens - total_tokens,
+        "unpacked_padding_tokens": len(lengths) * capacity - total_tokens,
+        "sequence_reduction": 1 - len(bins) / len(lengths) if lengths else 0.0,
+    }
+
+
+def pack_samples(samples):
+    """
+    Concatenate tokenized samples into one sequence. Position ids restart at 0 for each sample and
+    the label of the first token of each sample is masked, so no token is predicted from another
+    sample.
+
+    Args:
+        samples (list): dicts with `input_ids` and `labels`.
+
+    Returns:
+        dict: `input_ids`, `labels`, `position_ids` and `sequence_lengths` of the packed sequence.
+    """
+    packed = {"input_ids": [], "labels": [], "position_ids": [], "sequence_lengths": []}
+    for sample in samples:
+        length = len(sample["input_ids"])
+        packed["input_ids"].extend(sample["input_ids"])
+        packed["labels"].append(-100)
+        packed["labels"].extend(sample["labels"][1:])
+        packed["position_ids"].extend(range(length))
+        packed["sequence_lengths"].append(length)
+    return packed
+
+
+def _iter_packs(dataset, bins):
+    for bin_indices in bins:
+        yield pack_samples([dataset[index] for index in sorted(bin_indices)])
+
+
+def pack_dataset(dataset, max_seq_length):
+    """
+    Pack a tokenized dataset (with `input_ids`, `labels` and `length` columns) into sequences of at
+    most `max_seq_length` tokens with first-fit-decreasing bin packing.
+
+    Returns:
+        tuple: (packed datasets.Dataset, `packing_stats`).
+    """
+    import datasets
+
+    lengths = dataset["length"]
+    bins = first_fit_decreasing(lengths, max_seq_length)
+    stats = packing_stats(lengths, bins, max_seq_length)
+    logger.info(
+        f"Packed {stats['samples']} samples into {stats['packed_sequences']} sequences of {max_seq_length} tokens: "
+        f"{stats['pack_efficiency']:.1%} efficiency, {stats['padding_tokens']} padding tokens "
+        f"({stats['unpacked_padding_tokens']} without packing)"
+    )
+    packed = datasets.Dataset.from_generator(_iter_packs, gen_kwargs={"dataset": dataset, "bins": bins})
+    return packed, stats
+
+
+def block_diagonal_mask(sequence_lengths, padded_length):
+    """
+    Causal attention mask of a packed sequence where each token only attends to its own sample.
+
+    Returns:
+        torch.Tensor: `padded_length` x `padded_length` booleans (padding rows and columns are False).
+    """
+    import torch
+
+    mask = torch.zeros(padded_length, padded_length, dtype=torch.bool)
+    if sequence_lengths:
+        samples_length = sum(sequence_lengths)
+        blocks = [torch.ones(length, length, dtype=torch.bool).tril() for length in sequence_lengths]
+        mask[:samples_length, :samples_length] = torch.block_diag(*blocks)
+    return mask
+
+
+class PackedDataCollator:
+    """
+    Collate packed sequences (see `pack_dataset`), padding them to the longest one of the batch.
+
+    Samples must not attend to each other, which depends on the attention implementation:
+    - flash attention (`block_diagonal_attention=False`): no attention mask is returned, so the flash
+      attention implementations of transformers split the sequences on the `position_ids` that
+      restart for each sample. A padding mask would make them ignore the position ids.
+    - other implementations (eager, sdpa): a (batch, 1, length, length) additive block-diagonal causal
+      mask is returned (memory grows with the square of the sequence length).
+    Both need transformers>=4.44, older versions don't raise but let the packed samples attend to each other.
+
+    Args:
+        pad_token_id (int): Token id of the padding.
+        block_diagonal_attention (bool): Return the 4D block-diagonal attention mask.
+    """
+
+    def __init__(self, pad_token_id, block_diagonal_attention=True):
+        self.pad_token_id = pad_token_id
+        self.block_diagonal_attention = block_diagonal_attention
+
+    def __call__(self, features):
+        import torch
+
+        padded_length = max(len(feature["input_ids"]) for feature in features)
+        batch = {"input_ids": [], "labels": [], "position_ids": []}
+        for feature in features:
+            padding = padded_length - len(feature["input_ids"])
+            batch["input_ids"].append(feature["input_ids"] + [self.pad_token_id] * padding)
+            batch["labels"].append(feature["labels"] + [-100] * padding)
+            batch["position_ids"].append(feature["position_ids"] + [0] * padding)
+
+        batch = {key: torch.tensor(value) for key, value in batch.items()}
+        if self.block_diagonal_attention:
+            allowed = torch.stack(
+                [block_diagonal_mask(feature["sequence_lengths"], padded_length) for feature in features]
+            ).unsqueeze(1)
+            # additive mask: 0 where attention is allowed, the dtype minimum elsewhere
+            batch["attention_mask"] = torch.zeros(allowed.shape, dtype=torch.bfloat16).masked_fill(
+                ~allowed, torch.finfo(torch.bfloat16).min
+            )
+        return batch
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules are imported as `core.x`, `dataset_generation.x`... with src on the path, as in the scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
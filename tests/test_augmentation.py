@@ -0,0 +1,34 @@
+from core.augmentation import IDENTITY, AugmentationEngine, apply_augmentation
+from core.prompt_builder import build_full_prompt, parse_corrected_agent_trace
+
+SAMPLE = {
+    "system_instructions": "### INSTRUCTIONS\nAnswer the user query.\n### FUNCTIONS AVAILABLE\n### USER QUERY",
+    "example": "Thought: I can answer.\n<|wait|>",
+    "available_functions_json": "",
+    "user_query": "Hello?",
+    "assistant_completion": "Final Answer: Hello!",
+}
+
+
+def test_augmentation_depends_on_seed_record_and_epoch_only():
+    engine = AugmentationEngine(seed=1)
+    assert engine.augmentation(3, 2) == AugmentationEngine(seed=1).augmentation(3, 2)
+    augmentations = {engine.augmentation(record_id, epoch) for record_id in range(10) for epoch in range(3)}
+    assert len(augmentations) > 1
+
+
+def test_every_epoch_is_augmented_by_default():
+    engine = AugmentationEngine()
+    assert all(engine.augmentation(record_id, 0).order_seed is not None for record_id in range(10))
+    assert any(engine.augmentation(record_id, 0) != IDENTITY for record_id in range(10))
+
+
+def test_first_epoch_keeps_the_original_formatting_when_disabled():
+    engine = AugmentationEngine(augment_first_epoch=False)
+    assert engine.augmentation(0, 0) == IDENTITY
+    assert engine.augmentation(0, 1) != IDENTITY
+
+
+def test_identity_keeps_the_prompt():
+    full_prompt = build_full_prompt(SAMPLE)
+    assert apply_augmentation(parse_corrected_agent_trace(full_prompt), IDENTITY) == full_prompt
@@ -0,0 +1,72 @@
+from core.prompt_builder import RESOLUTION_CYCLE_MARKER
+from finetuning.dataset_preprocessing import completion_spans, mask_labels, report_tokenized_dataset, tokenize_batch
+
+TEXT = (
+    "### USER QUERY\nWeather?\n"
+    f"{RESOLUTION_CYCLE_MARKER}\n"
+    "Action: get_weather()\n"
+    "Output[abc]: sunny\n"
+    "Final Answer: sunny"
+)
+COMPLETION_START = TEXT.index(RESOLUTION_CYCLE_MARKER) + len(RESOLUTION_CYCLE_MARKER)
+
+
+class CharTokenizer:
+    """
+    One token per character, the token id being the character code.
+    """
+
+    eos_token_id = 0
+
+    def __call__(self, texts, add_special_tokens=True, truncation=False, return_offsets_mapping=False):
+        encodings = {"input_ids": [[ord(char) for char in text] for text in texts]}
+        if return_offsets_mapping:
+            encodings["offset_mapping"] = [[(i, i + 1) for i in range(len(text))] for text in texts]
+        return encodings
+
+
+def test_completion_spans_start_after_the_last_marker():
+    assert completion_spans(TEXT) == [(COMPLETION_START, len(TEXT))]
+    assert completion_spans("no marker") == [(0, len("no marker"))]
+
+
+def test_completion_spans_leave_out_the_function_outputs():
+    output_start = TEXT.index("Output[abc]")
+    output_end = TEXT.index("Final Answer")
+    assert completion_spans(TEXT, mask_outputs=True) == [(COMPLETION_START, output_start), (output_end, len(TEXT))]
+
+
+def test_mask_labels():
+    input_ids = [10, 11, 12, 13, 14]
+    offsets = [(0, 0), (0, 2), (2, 4), (4, 6), (6, 8)]
+    # special token and tokens outside the spans are masked, a token overlapping a span is kept
+    assert mask_labels(input_ids, offsets, [(3, 5), (7, 8)]) == [-100, -100, 12, 13, 14]
+
+
+def test_tokenize_batch_completion_only():
+    batch = tokenize_batch(
+        {"text": [TEXT]}, CharTokenizer(), max_seq_length=1000, completion_only=True, mask_outputs=True
+    )
+    labels = batch["labels"][0]
+    trained = "".join(chr(label) for label in labels[:-1] if label != -100)
+    assert trained == "\nAction: get_weather()\nFinal Answer: sunny"
+    assert labels[-1] == CharTokenizer.eos_token_id
+    assert batch["input_ids"][0][-1] == CharTokenizer.eos_token_id
+    assert batch["trained_tokens"] == [len(trained) + 1]
+    assert batch["truncated"] == [False]
+
+
+def test_tokenize_batch_truncates():
+    batch = tokenize_batch({"text": ["abcdef"]}, CharTokenizer(), max_seq_length=4)
+    assert batch["input_ids"] == [[97, 98, 99, 100]]
+    assert batch["labels"] == batch["input_ids"]
+    assert batch["length"] == [4]
+    assert batch["truncated"] == [True]
+
+
+def test_report_tokenized_dataset_counts_truncated_samples_from_the_columns(caplog):
+    tokenized = {"truncated": [True, False, True], "length": [4, 2, 4], "trained_tokens": [2, 1, 1]}
+    with caplog.at_level("INFO", logger="finetuning.dataset_preprocessing"):
+        report_tokenized_dataset(tokenized, max_seq_length=4, completion_only=True)
+    assert "2/3 samples truncated to max_seq_length=4" in caplog.text
+    assert "Loss computed on 4/10 tokens" in caplog.text
@@ -0,0 +1,93 @@
+import json
+import time
+
+import pytest
+
+from core.executors import ExecutorRegistry, FunctionExecutionError, format_function_output, parse_function_parameters
+
+
+@pytest.mark.parametrize(
+    "fct_parameters, expected",
+    [
+        ('{"city": "Paris"}', {"city": "Paris"}),
+        ('{"city": "Paris"}}', {"city": "Paris"}),
+        ("  ", {}),
+        ("}", {}),
+    ],
+)
+def test_parse_function_parameters(fct_parameters, expected):
+    assert parse_function_parameters(fct_parameters) == expected
+
+
+def test_parse_function_parameters_resolves_output_references():
+    outputs = {"abc123": '{"lat": 46.9, "long": 56.4}'}
+
+    assert parse_function_parameters("**Output[abc123])", outputs=outputs) == {"lat": 46.9, "long": 56.4}
+    with pytest.raises(FunctionExecutionError):
+        parse_function_parameters("**Output[unknown])", outputs=outputs)
+
+
+@pytest.mark.parametrize("fct_parameters", ["not json", "[1, 2]"])
+def test_parse_function_parameters_rejects_invalid_parameters(fct_parameters):
+    with pytest.raises(FunctionExecutionError):
+        parse_function_parameters(fct_parameters)
+
+
+def test_format_function_output_is_a_single_line():
+    assert format_function_output({"a": [1, 2]}) == '{"a":[1,2]}'
+    assert format_function_output('{\n  "a": 1\n}') == '{"a":1}'
+    assert format_function_output("first line\nsecond line") == "first line second line"
+
+
+def make_registry(timeout=1.0):
+    registry = ExecutorRegistry(timeout=timeout)
+
+    def slow(seconds, value):
+        time.sleep(seconds)
+        return {"value": value}
+
+    def fail():
+        raise ValueError("boom")
+
+    registry.register_callable("slow", slow)
+    registry.register_callable("fail", fail)
+    return registry
+
+
+def test_execute_many_runs_calls_concurrently_in_call_order():
+    registry = make_registry()
+    calls = [("slow", json.dumps({"seconds": 0.3, "value": i})) for i in range(3)]
+
+    start = time.perf_counter()
+    outputs = registry.execute_many(calls)
+    elapsed = time.perf_counter() - start
+
+    assert outputs == ['{"value":0}', '{"value":1}', '{"value":2}']
+    assert elapsed < 0.6
+    registry.shutdown()
+
+
+def test_execute_many_shares_one_deadline():
+    registry = make_registry(timeout=0.2)
+    calls = [("slow", '{"seconds": 0.05, "value": 1}'), ("slow", '{"seconds": 1.0, "value": 2}')] * 2
+
+    start = time.perf_counter()
+    outputs = registry.execute_many(calls)
+    elapsed = time.perf_counter() - start
+
+    assert outputs[0] == '{"value":1}'
+    assert json.loads(outputs[1]) == {"error": "Function slow timed out after 0.2s"}
+    assert json.loads(outputs[3]) == json.loads(outputs[1])
+    # the timed out calls don't wait for each other
+    assert elapsed < 0.5
+    registry.shutdown()
+
+
+def test_execution_errors_are_returned_as_outputs():
+    registry = make_registry()
+
+    assert json.loads(registry.execute("fail", "{}")) == {"error": "Function fail failed: boom"}
+    assert json.loads(registry.execute("unknown", "{}")) == {"error": "Unknown function: unknown"}
+    assert json.loads(registry.execute("slow", "not json"))["error"].startswith("Function slow failed")
+    assert "slow" in registry and "unknown" not in registry
+    registry.shutdown()
@@ -0,0 +1,74 @@
+import json
+import random
+
+import pytest
+
+from dataset_generation.function_catalog import FunctionCatalog
+
+FUNCTIONS = [
+    {
+        "name": "get_weather",
+        "description": "Current weather at a location.",
+        "parameters": {
+            "type": "object",
+            "properties": {"city": {"type": "string"}, "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]}},
+            "required": ["city"],
+        },
+    },
+    {"name": "get_location", "description": "Location of the user.", "parameters": {}},
+    {
+        "name": "search",
+        "description": "Search the web.",
+        "parameters": {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]},
+    },
+]
+
+
+@pytest.fixture
+def catalog():
+    return FunctionCatalog(FUNCTIONS)
+
+
+def test_serialization_matches_json_dumps(catalog):
+    assert catalog.to_json() == json.dumps(FUNCTIONS)
+    assert catalog.to_json(compact=True) == json.dumps(FUNCTIONS, separators=(",", ":"))
+    assert catalog.to_json(indent=2) == json.dumps(FUNCTIONS, indent=2)
+    assert catalog.to_json(["search", "get_weather"]) == json.dumps([FUNCTIONS[2], FUNCTIONS[0]])
+
+
+@pytest.mark.parametrize("indent", [None, 3, 4])
+def test_reformat_matches_json_dumps(catalog, indent):
+    unknown = {"name": "unknown", "description": "Not in the catalog.", "parameters": {}}
+    available_functions = json.dumps([FUNCTIONS[1], unknown, FUNCTIONS[0]])
+
+    assert catalog.reformat(available_functions, indent=indent) == json.dumps(
+        [FUNCTIONS[1], unknown, FUNCTIONS[0]], indent=indent
+    )
+    assert catalog.names_of(available_functions) == ["get_location", "unknown", "get_weather"]
+    assert catalog.without(available_functions, "unknown") == json.dumps([FUNCTIONS[1], FUNCTIONS[0]])
+    assert catalog.reformat(available_functions, include=["get_weather"]) == json.dumps([FUNCTIONS[0]])
+
+
+def test_shuffle_is_a_reproducible_permutation(catalog):
+    available_functions = catalog.to_json()
+
+    shuffled = catalog.shuffle_json(available_functions, rng=random.Random(0))
+
+    assert shuffled == catalog.shuffle_json(available_functions, rng=random.Random(0))
+    assert sorted(json.loads(shuffled), key=lambda function: function["name"]) == sorted(
+        FUNCTIONS, key=lambda function: function["name"]
+    )
+
+
+def test_validate_parameters(catalog):
+    assert catalog.is_valid("get_weather", {"city": "Paris"})
+    assert catalog.validate("get_weather", {"city": "Paris", "unit": "celsius"}) == []
+    assert catalog.validate("get_weather", {"unit": "kelvin"})
+    assert catalog.is_valid("get_location", {})
+
+
+def test_lookup(catalog):
+    assert len(catalog) == 3
+    assert "search" in catalog and "missing" not in catalog
+    assert catalog["search"] == FUNCTIONS[2]
+    assert catalog.get("missing") is None
@@ -0,0 +1,83 @@
+import json
+import re
+
+import pytest
+
+from core.grammars import OUTPUT_REFERENCE_REGEX, parameters_regex, schema_hash, schema_to_regex
+
+WEATHER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "city": {"type": "string"},
+        "days": {"type": "integer"},
+        "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+        "hourly": {"type": "boolean"},
+    },
+    "required": ["city"],
+}
+
+
+def matches(regex, value, separators=None):
+    return re.fullmatch(regex, json.dumps(value, ensure_ascii=False, separators=separators)) is not None
+
+
+@pytest.mark.parametrize("separators", [None, (",", ":")])
+@pytest.mark.parametrize(
+    "value",
+    [
+        {"city": "Paris"},
+        {"city": "Paris", "unit": "celsius"},
+        {"city": "Paris", "days": 3, "unit": "fahrenheit", "hourly": True},
+        {"city": 'Québec "city"\n'},
+    ],
+)
+def test_object_values_in_both_json_formats(value, separators):
+    assert matches(schema_to_regex(WEATHER_SCHEMA), value, separators)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        {},
+        {"unit": "celsius"},
+        {"city": "Paris", "unit": "kelvin"},
+        {"city": "Paris", "days": 1.5},
+        # properties are expected in schema order
+        {"unit": "celsius", "city": "Paris"},
+    ],
+)
+def test_invalid_object_values(value):
+    assert not matches(schema_to_regex(WEATHER_SCHEMA), value)
+
+
+@pytest.mark.parametrize("schema", [{}, {"properties": {}}, {"description": "no parameters"}, None])
+def test_empty_parameters_schemas_are_objects(schema):
+    regex = parameters_regex(schema)
+
+    assert matches(regex, {})
+    assert matches(regex, {"free": "form", "n": 1})
+    assert not matches(regex, "a string")
+
+
+def test_arrays_and_alternatives():
+    schema = {
+        "type": "object",
+        "properties": {
+            "ids": {"type": "array", "items": {"type": "integer"}},
+            "filter": {"anyOf": [{"type": "string"}, {"type": "null"}]},
+        },
+    }
+    regex = parameters_regex(schema)
+
+    assert matches(regex, {"ids": [1, 2, 3], "filter": None}, (",", ":"))
+    assert matches(regex, {"ids": [], "filter": "open"})
+    assert matches(regex, {})
+    assert not matches(regex, {"ids": ["1"]})
+
+
+def test_output_reference():
+    assert re.fullmatch(OUTPUT_REFERENCE_REGEX, "**Output[ryuzyRNy98ue2sQkfBgfJr]")
+
+
+def test_schema_hash_ignores_key_order():
+    assert schema_hash({"a": 1, "b": {"c": 2, "d": 3}}) == schema_hash({"b": {"d": 3, "c": 2}, "a": 1})
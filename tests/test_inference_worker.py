@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from api.inference_worker import InferenceWorker, RequestCancelledError, percentile
+from core.step_factory import StepType
+
+
+class StreamingTraceGenerator:
+    """
+    Generates each step on a producer thread, as guidance streams do, and records whether a
+    job started while the stream of the previous one was still producing.
+    """
+
+    def __init__(self, chunks=20, steps=2):
+        self.chunks = chunks
+        self.steps = steps
+        self.producing = threading.Event()
+        self.overlapped = False
+
+    def _stream(self, chunks):
+        def produce():
+            self.producing.set()
+            for chunk in range(self.chunks):
+                time.sleep(0.001)
+                chunks.append(str(chunk))
+            self.producing.clear()
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        emitted = 0
+        while producer.is_alive() or emitted < len(chunks):
+            if emitted < len(chunks):
+                emitted += 1
+                yield chunks[emitted - 1]
+            else:
+                time.sleep(0.0005)
+
+    def iter_trace_steps(self, available_functions, user_query, on_delta=None):
+        if self.producing.is_set():
+            self.overlapped = True
+        yield f"prompt {user_query}"
+        for step in range(self.steps):
+            for chunk in self._stream([]):
+                if on_delta is not None:
+                    on_delta(StepType.THOUGHT, chunk)
+            yield f"{user_query} step {step}"
+
+
+async def run_cancelled_then_next(worker):
+    worker.start()
+    try:
+        cancelled_job = None
+
+        def cancel_on_first_delta(step_type, text):
+            cancelled_job.cancel()
+
+        cancelled_job = worker.submit(available_functions="[]", user_query="a", on_delta=cancel_on_first_delta)
+        next_job = worker.submit(available_functions="[]", user_query="b")
+        return await asyncio.gather(cancelled_job.future, next_job.future, return_exceptions=True)
+    finally:
+        worker.stop(timeout=5)
+
+
+def test_cancelled_stream_is_finished_before_the_next_job():
+    trace_generator = StreamingTraceGenerator()
+    worker = InferenceWorker(trace_generator=trace_generator)
+
+    cancelled, trace = asyncio.run(run_cancelled_then_next(worker))
+
+    assert isinstance(cancelled, RequestCancelledError)
+    assert trace == ["prompt b", "b step 0", "b step 1"]
+    assert not trace_generator.overlapped
+
+
+def test_extend_drains_the_stream_when_on_delta_raises():
+    pytest.importorskip("guidance")
+    from core.trace_generator import GuidedTraceGenerator
+
+    consumed = []
+
+    class FakeStream:
+        def __add__(self, grammar):
+            return self
+
+        def __iter__(self):
+            for chunk in range(5):
+                consumed.append(chunk)
+                yield "prompt" + "x" * (chunk + 1)
+
+    class FakeLM:
+        def stream(self):
+            return FakeStream()
+
+        def __str__(self):
+            return "prompt"
+
+    def on_delta(text):
+        raise RequestCancelledError("cancelled")
+
+    trace_generator = object.__new__(GuidedTraceGenerator)
+    with pytest.raises(RequestCancelledError):
+        trace_generator._extend(FakeLM(), "grammar", on_delta=on_delta)
+    assert consumed == [0, 1, 2, 3, 4]
+
+
+class FailingTraceGenerator:
+    def iter_trace_steps(self, available_functions, user_query, on_delta=None):
+        yield "prompt"
+        if user_query == "fail":
+            raise RuntimeError("generation failed")
+        yield "final answer"
+
+
+async def run_jobs(worker, user_queries):
+    worker.start()
+    try:
+        jobs = [worker.submit(available_functions="[]", user_query=user_query) for user_query in user_queries]
+        return await asyncio.gather(*(job.future for job in jobs), return_exceptions=True)
+    finally:
+        worker.stop(timeout=5)
+
+
+def test_metrics_report_latencies_and_failures():
+    worker = InferenceWorker(trace_generator=FailingTraceGenerator())
+
+    results = asyncio.run(run_jobs(worker, ["a", "fail", "b"]))
+
+    assert results[0] == results[2] == ["prompt", "final answer"]
+    assert isinstance(results[1], RuntimeError)
+    metrics = worker.metrics()
+    assert metrics["completed"] == 2
+    assert metrics["failed"] == 1
+    assert metrics["in_flight"] == 0
+    assert metrics["latency_p50"] is not None and metrics["latency_p95"] >= metrics["latency_p50"]
+    assert metrics["queue_wait_p95"] is not None
+    assert 0.0 <= metrics["occupancy"] <= 1.0
+
+
+@pytest.mark.parametrize("q, expected", [(50, 2), (95, 4), (100, 4), (0, 1)])
+def test_percentile(q, expected):
+    assert percentile([4, 1, 3, 2], q) == expected
+    assert percentile([], q) is None
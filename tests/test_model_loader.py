@@ -0,0 +1,62 @@
+import pytest
+
+from api.model_loader import ModelLoader
+
+
+class FlakyFactory:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError(f"load n°{self.calls} failed")
+        return "generator"
+
+
+def test_failed_load_is_retried_after_retry_after():
+    factory = FlakyFactory(failures=1)
+    model_loader = ModelLoader(factory, retry_after=0)
+    with pytest.raises(RuntimeError):
+        model_loader.get()
+    assert model_loader.status()["state"] == "failed"
+
+    assert model_loader.get() == "generator"
+    assert factory.calls == 2
+    assert model_loader.status()["state"] == "ready"
+    assert model_loader.status()["error"] is None
+
+
+def test_failed_load_is_not_retried_before_retry_after():
+    factory = FlakyFactory(failures=1)
+    model_loader = ModelLoader(factory, retry_after=3600)
+    with pytest.raises(RuntimeError):
+        model_loader.get()
+    with pytest.raises(RuntimeError, match="load n°1 failed"):
+        model_loader.get()
+    model_loader.start()
+    assert not model_loader.wait(timeout=1)
+    assert factory.calls == 1
+
+
+def test_start_retries_a_failed_background_load():
+    factory = FlakyFactory(failures=1)
+    model_loader = ModelLoader(factory, retry_after=0)
+    model_loader.start()
+    assert not model_loader.wait(timeout=5)
+
+    model_loader.start()
+    assert model_loader.wait(timeout=5)
+    assert factory.calls == 2
+
+
+def test_failed_warmup_fails_the_load():
+    def warmup(generator):
+        raise RuntimeError("warm-up failed")
+
+    model_loader = ModelLoader(lambda: "generator", warmup=warmup, retry_after=3600)
+    with pytest.raises(RuntimeError, match="warm-up failed"):
+        model_loader.get()
+    assert not model_loader.ready
+    assert model_loader.status()["state"] == "failed"
@@ -0,0 +1,49 @@
+from core.output_store import PREVIEW_MARKER, OutputStore
+from core.step_factory import StepType, create_step_model
+
+
+def test_lru_eviction_drops_outputs_without_spill_dir():
+    store = OutputStore(max_items=2)
+    store.put("a", "output a")
+    store.put("b", "output b")
+    store.get("a")
+    store.put("c", "output c")
+
+    assert store.get("b") is None
+    assert store.get("a") == "output a"
+    assert store.stats() == {"stored_outputs": 2, "spilled_outputs": 0, "dropped_outputs": 1}
+
+
+def test_evicted_outputs_are_spilled_to_disk(tmp_path):
+    store = OutputStore(max_items=1, spill_dir=str(tmp_path))
+    store.put("a", "output a")
+    store.put("b", "output b")
+
+    assert len(store) == 1
+    assert store.get("a") == "output a"
+    assert "a" in store
+    assert store.spilled == 1
+
+
+def test_store_returns_a_preview():
+    store = OutputStore(preview_chars=5)
+
+    assert store.store("a", "0123456789") == "01234" + PREVIEW_MARKER
+    assert store.store("b", "short") == "short"
+    assert store.get("a") == "0123456789"
+
+
+def test_resolve_cited_outputs():
+    store = OutputStore()
+    store.put("abc", "full output abc")
+    store.put("def", "full output def")
+    trace = [
+        create_step_model(step_type=StepType.INITIAL_PROMPT, diff="Output[def] in the example"),
+        create_step_model(
+            step_type=StepType.FUNCTION_OUTPUT, shortuuid="abc", function_output="x", diff="Output[abc]"
+        ),
+        create_step_model(step_type=StepType.FINAL_ANSWER, final_answer="a", diff="See (Output[abc]) (Output[zzz])"),
+    ]
+
+    assert store.resolve("Output[abc] and Output[def]") == {"abc": "full output abc", "def": "full output def"}
+    assert store.resolve_trace(trace) == {"abc": "full output abc"}
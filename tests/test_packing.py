@@ -0,0 +1,73 @@
+import pytest
+
+from finetuning.packing import first_fit_decreasing, pack_samples, packing_stats
+
+
+def test_first_fit_decreasing_fills_bins_without_exceeding_capacity():
+    lengths = [6, 5, 4, 3, 2, 2, 1]
+    bins = first_fit_decreasing(lengths, 8)
+    assert sorted(index for bin_indices in bins for index in bin_indices) == list(range(len(lengths)))
+    assert all(sum(lengths[index] for index in bin_indices) <= 8 for bin_indices in bins)
+    assert bins == [[0, 4], [1, 3], [2, 5, 6]]
+
+
+def test_first_fit_decreasing_rejects_items_longer_than_the_capacity():
+    with pytest.raises(ValueError):
+        first_fit_decreasing([3, 9], 8)
+
+
+def test_packing_stats():
+    stats = packing_stats([6, 2, 4], [[0, 1], [2]], 8)
+    assert stats["packed_sequences"] == 2
+    assert stats["pack_efficiency"] == 12 / 16
+    assert stats["padding_tokens"] == 4
+    assert stats["unpacked_padding_tokens"] == 12
+    assert stats["sequence_reduction"] == 1 - 2 / 3
+
+
+def test_pack_samples_restarts_positions_and_masks_the_first_label_of_each_sample():
+    packed = pack_samples([{"input_ids": [1, 2, 3], "labels": [1, 2, 3]}, {"input_ids": [4, 5], "labels": [-100, 5]}])
+    assert packed["input_ids"] == [1, 2, 3, 4, 5]
+    assert packed["labels"] == [-100, 2, 3, -100, 5]
+    assert packed["position_ids"] == [0, 1, 2, 0, 1]
+    assert packed["sequence_lengths"] == [3, 2]
+
+
+def test_block_diagonal_mask():
+    torch = pytest.importorskip("torch")
+    from finetuning.packing import block_diagonal_mask
+
+    mask = block_diagonal_mask([2, 3], 6)
+    expected = torch.tensor(
+        [
+            [1, 0, 0, 0, 0, 0],
+            [1, 1, 0, 0, 0, 0],
+            [0, 0, 1, 0, 0, 0],
+            [0, 0, 1, 1, 0, 0],
+            [0, 0, 1, 1, 1, 0],
+            [0, 0, 0, 0, 0, 0],
+        ],
+        dtype=torch.bool,
+    )
+    assert torch.equal(mask, expected)
+
+
+def test_packed_data_collator():
+    torch = pytest.importorskip("torch")
+    from finetuning.packing import PackedDataCollator
+
+    features = [
+        pack_samples([{"input_ids": [1, 2], "labels": [1, 2]}, {"input_ids": [3], "labels": [3]}]),
+        pack_samples([{"input_ids": [4, 5, 6, 7], "labels": [4, 5, 6, 7]}]),
+    ]
+    batch = PackedDataCollator(pad_token_id=0)(features)
+    assert batch["input_ids"].tolist() == [[1, 2, 3, 0], [4, 5, 6, 7]]
+    assert batch["labels"].tolist() == [[-100, 2, -100, -100], [-100, 5, 6, 7]]
+    assert batch["attention_mask"].shape == (2, 1, 4, 4)
+    # the first token of the second sample only attends to itself
+    assert (batch["attention_mask"][0, 0, 2] == 0).tolist() == [False, False, True, False]
+    assert batch["attention_mask"][0, 0, 2, 0] == torch.finfo(torch.bfloat16).min
+
+    flash_batch = PackedDataCollator(pad_token_id=0, block_diagonal_attention=False)(features)
+    assert "attention_mask" not in flash_batch
+    assert flash_batch["position_ids"].tolist() == [[0, 1, 0, 0], [0, 1, 2, 3]]
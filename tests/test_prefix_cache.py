@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip("guidance")
+
+from core.prefix_cache import PromptPrefixCache, snapshot_nbytes  # noqa: E402
+
+TEMPLATE = "Instructions\n{available_functions}\nQuery: {user_query}\n{agent_scratchpad}"
+
+
+class FakeLM:
+    def __init__(self, text=""):
+        self.text = text
+        self._past_key_values = None
+        self._cached_token_ids = None
+
+    def __add__(self, text):
+        return FakeLM(self.text + text)
+
+
+class FakeTensor:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+    def numel(self):
+        return self.nbytes
+
+    def element_size(self):
+        return 1
+
+
+class CountingCache(PromptPrefixCache):
+    """
+    Prefix cache whose prefills return a snapshot of `snapshot_bytes` bytes instead of running the model.
+    """
+
+    def __init__(self, snapshot_bytes=100, **kwargs):
+        super().__init__(FakeLM(), prompt_template=TEMPLATE, **kwargs)
+        self.snapshot_bytes = snapshot_bytes
+        self.prefilled = []
+
+    def _prefill(self, lm):
+        self.prefilled.append(lm.text)
+        return ((FakeTensor(self.snapshot_bytes),), [len(self.prefilled)])
+
+
+def test_function_list_snapshot_only_taken_when_seen_again():
+    cache = CountingCache()
+    cache.fork("[a]", "q1")
+    cache.fork("[b]", "q2")
+    # the instructions prefix only
+    assert cache.prefilled == ["Instructions\n"]
+
+    cache.fork("[b]", "q3")
+    assert cache.prefilled[-1] == "Instructions\n[b]\nQuery: "
+    assert cache.stats()["cached_function_lists"] == 1
+
+    reused_tokens = cache.reused_tokens
+    cache.fork("[b]", "q4")
+    assert len(cache.prefilled) == 2
+    assert cache.reused_tokens > reused_tokens
+
+
+def test_function_lists_capped_by_snapshot_memory():
+    cache = CountingCache(snapshot_bytes=100, max_function_lists=8, max_snapshot_bytes=250)
+    for functions in ("[a]", "[b]", "[c]"):
+        cache.fork(functions, "q")
+        cache.fork(functions, "q")
+    assert cache.stats()["cached_function_lists"] == 2
+    assert cache.stats()["snapshot_bytes"] == 200
+    assert "[a]" not in cache._function_lists
+
+
+def test_snapshot_larger_than_the_cap_is_not_kept():
+    cache = CountingCache(snapshot_bytes=300, max_snapshot_bytes=250)
+    cache.fork("[a]", "q")
+    cache.fork("[a]", "q")
+    assert cache.stats()["cached_function_lists"] == 0
+    assert cache.stats()["snapshot_bytes"] == 0
+
+
+def test_snapshot_nbytes():
+    assert snapshot_nbytes(None) == 0
+    assert snapshot_nbytes((((FakeTensor(3), FakeTensor(4)), (FakeTensor(5),)), [1, 2])) == 12
+
+
+def test_no_prefill_request_when_snapshots_are_unsupported(monkeypatch):
+    import core.prefix_cache as prefix_cache
+
+    generated = []
+    monkeypatch.setattr(prefix_cache, "gen", lambda **kwargs: generated.append(kwargs))
+    # e.g. the openai backend, whose engine has no local KV cache
+    monkeypatch.setattr(prefix_cache, "engine_snapshots_supported", lambda lm: False)
+    cache = PromptPrefixCache(FakeLM(), prompt_template=TEMPLATE)
+    cache.fork("[a]", "q")
+    cache.fork("[a]", "q")
+    assert generated == []
+    assert cache.fallback_reported
@@ -0,0 +1,50 @@
+from core.step_factory import StepType, create_step_model
+from dataset_generation.run_journal import RunJournal
+
+
+def trace(answer):
+    return [
+        create_step_model(step_type=StepType.INITIAL_PROMPT, diff="prompt"),
+        create_step_model(step_type=StepType.FINAL_ANSWER, final_answer=answer, diff=answer),
+    ]
+
+
+def record(journal, index, user_query):
+    journal.record(
+        index=index,
+        content_hash=RunJournal.content_hash("[]", user_query),
+        available_functions="[]",
+        user_query=user_query,
+        traces=[trace(f"answer {index}")],
+    )
+
+
+def test_resume_skips_completed_records(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = RunJournal(path)
+    record(journal, 3, "query 3")
+    record(journal, 1, "query 1")
+
+    resumed = RunJournal(path)
+
+    assert len(resumed) == 2
+    assert resumed.completed_indices() == [1, 3]
+    assert resumed.is_completed(1, RunJournal.content_hash("[]", "query 1"))
+    # same index, different source record
+    assert not resumed.is_completed(1, RunJournal.content_hash("[]", "another query"))
+    assert not resumed.is_completed(2, RunJournal.content_hash("[]", "query 2"))
+    assert RunJournal.load_traces(resumed.entries()[1]) == [trace("answer 3")]
+
+
+def test_truncated_last_line_is_ignored(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = RunJournal(str(path))
+    record(journal, 0, "query 0")
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"index": 1, "content_ha')
+
+    resumed = RunJournal(str(path))
+    record(resumed, 2, "query 2")
+
+    assert resumed.completed_indices() == [0, 2]
+    assert RunJournal(str(path)).completed_indices() == [0, 2]
@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from core.step_factory import StepType, create_step_model
+from dataset_generation.function_catalog import FunctionCatalog
+from dataset_generation.generation_records import iter_generation_records
+from dataset_generation.run_journal import RunJournal
+from dataset_generation.sharded_generation import merge_journals, shard_device, shard_journal_path, shard_ranges
+
+
+def make_records(n):
+    catalog = FunctionCatalog.load(version="v1")
+    functions = json.dumps(catalog.functions[:3])
+    return [
+        {"available_functions": functions, "corrected_user_query": [{"value": f"user query {i}"}]} for i in range(n)
+    ]
+
+
+def record_shard(journal_dir, shard_id, indices):
+    journal = RunJournal(shard_journal_path(journal_dir, shard_id))
+    for index in indices:
+        trace = [create_step_model(step_type=StepType.FINAL_ANSWER, final_answer=f"answer {index}", diff="")]
+        journal.record(
+            index=index,
+            content_hash=f"hash {index}",
+            available_functions="[]",
+            user_query=f"user query {index}",
+            traces=[trace],
+            shard_id=shard_id,
+        )
+
+
+@pytest.mark.parametrize("n_records, n_shards", [(10, 3), (3, 3), (2, 4), (0, 2), (100, 1)])
+def test_shard_ranges_cover_the_records_once(n_records, n_shards):
+    ranges = shard_ranges(n_records, n_shards)
+
+    assert len(ranges) <= n_shards
+    assert [index for start, end in ranges for index in range(start, end)] == list(range(n_records))
+    sizes = [end - start for start, end in ranges]
+    assert not sizes or max(sizes) - min(sizes) <= 1
+
+
+def test_shard_device_round_robin():
+    assert [shard_device(shard_id, ["0", "1"]) for shard_id in range(4)] == ["0", "1", "0", "1"]
+    assert shard_device(3, []) is None
+
+
+def test_merge_journals_orders_records_by_index(tmp_path):
+    record_shard(tmp_path, 1, [5, 3, 4])
+    record_shard(tmp_path, 0, [2, 0, 1])
+    output_path = tmp_path / "merged" / "traces.jsonl"
+
+    merged = merge_journals([shard_journal_path(tmp_path, shard_id) for shard_id in range(2)], str(output_path))
+
+    entries = [json.loads(line) for line in output_path.read_text(encoding="utf-8").splitlines()]
+    assert merged == 6
+    assert [entry["index"] for entry in entries] == list(range(6))
+    assert [entry["shard_id"] for entry in entries] == [0, 0, 0, 1, 1, 1]
+    assert entries[4]["traces"][0][0]["final_answer"] == "answer 4"
+
+
+def test_generation_records_skip_journaled_records(tmp_path):
+    records = make_records(6)
+    journal = RunJournal(str(tmp_path / "journal.jsonl"))
+    first = next(iter_generation_records(records, 2, 4))
+    journal.record(
+        index=first["index"],
+        content_hash=first["content_hash"],
+        available_functions=first["available_functions"],
+        user_query=first["user_query"],
+        traces=[],
+    )
+
+    remaining = list(iter_generation_records(records, 2, 4, journal=RunJournal(journal.path)))
+
+    assert [record["index"] for record in remaining] == [3]
+    assert remaining[0]["user_query"] == "user query 3"
+    assert sorted(json.loads(remaining[0]["available_functions"]), key=json.dumps) == sorted(
+        json.loads(records[3]["available_functions"]), key=json.dumps
+    )
+
+
+def test_sharded_generation_with_a_tiny_model_on_cpu(tmp_path):
+    pytest.importorskip("guidance")
+    pytest.importorskip("transformers")
+    datasets = pytest.importorskip("datasets")
+    from dataset_generation.sharded_generation import run_sharded_generation
+
+    dataset_path = str(tmp_path / "dataset")
+    datasets.Dataset.from_list(make_records(4)).save_to_disk(dataset_path)
+    output_path = str(tmp_path / "traces.jsonl")
+
+    stats = run_sharded_generation(
+        dataset_path=dataset_path,
+        output_path=output_path,
+        model_name_or_path="sshleifer/tiny-gpt2",
+        num_workers=2,
+        model_kwargs={"device_map": {"": "cpu"}},
+        gpus=[],
+    )
+
+    with open(output_path, encoding="utf-8") as file:
+        entries = [json.loads(line) for line in file]
+    assert [worker_stats["generated"] for worker_stats in stats] == [2, 2]
+    assert [entry["index"] for entry in entries] == [0, 1, 2, 3]
@@ -0,0 +1,49 @@
+from core.step_factory import StepType, create_step_model, step_from_dict, step_to_dict, steps_before_function
+
+
+def thought(text):
+    return create_step_model(step_type=StepType.THOUGHT, thought=text, diff=f"Thought: {text}")
+
+
+def call(fct_name):
+    return create_step_model(
+        step_type=StepType.FUNCTION_CALL, fct_name=fct_name, fct_parameters="{}", diff=f"Call function: {fct_name}"
+    )
+
+
+def action_choice():
+    return create_step_model(
+        step_type=StepType.ACTION_CHOICE, action_choice="call function", diff="Action choice: call function"
+    )
+
+
+def output():
+    return create_step_model(step_type=StepType.FUNCTION_OUTPUT, shortuuid="abc", function_output="{}", diff="")
+
+
+def iteration(*fct_names):
+    return [thought(f"call {', '.join(fct_names)}"), action_choice(), *[call(name) for name in fct_names], output()]
+
+
+def test_steps_before_function_stops_before_the_iteration_calling_it():
+    steps = iteration("get_location") + iteration("get_weather") + iteration("get_location")
+
+    assert steps_before_function(steps, "get_weather") == steps[:4]
+    assert steps_before_function(steps, "get_location") == []
+
+
+def test_steps_before_function_with_parallel_calls():
+    steps = iteration("get_location") + iteration("get_time", "get_weather")
+
+    assert steps_before_function(steps, "get_weather") == steps[:4]
+
+
+def test_steps_before_function_keeps_steps_without_the_function():
+    steps = iteration("get_location") + [thought("done")]
+
+    assert steps_before_function(steps, "get_weather") == steps
+
+
+def test_step_dict_round_trip():
+    for step in iteration("get_weather"):
+        assert step_from_dict(step_to_dict(step)) == step
@@ -0,0 +1,84 @@
+import pytest
+
+from core.prompt_builder import build_full_prompt
+from core.token_budget import (
+    TRUNCATION_MARKER,
+    TokenBudget,
+    make_token_counter,
+    section_histograms,
+    truncate_to_tokens,
+)
+
+
+def count_characters(text):
+    return len(text)
+
+
+def test_default_counter_estimates_four_characters_per_token():
+    count = make_token_counter()
+
+    assert count("") == 0
+    assert count("abc") == 1
+    assert count("a" * 40) == 10
+
+
+@pytest.mark.parametrize("max_tokens", [10, 20, 100])
+def test_truncate_to_tokens(max_tokens):
+    text = "x" * 50
+
+    truncated = truncate_to_tokens(text, max_tokens, count_characters)
+
+    assert len(truncated) <= max_tokens
+    if max_tokens < len(text):
+        assert truncated == "x" * (max_tokens - len(TRUNCATION_MARKER)) + TRUNCATION_MARKER
+    else:
+        assert truncated == text
+
+
+def test_truncate_output_and_exhausted():
+    budget = TokenBudget(100, count_tokens=count_characters, reserve_tokens=20, max_output_tokens=30)
+
+    assert budget.truncate_output("short") == "short"
+    assert len(budget.truncate_output("y" * 100)) == 30
+    assert budget.truncated_outputs == 1
+    assert budget.limit == 80
+    assert not budget.exhausted("z" * 80)
+    assert budget.exhausted("z" * 81)
+
+
+def test_section_histograms():
+    sample = build_full_prompt(
+        {
+            "system_instructions": "instructions",
+            "example": "example<|wait|>",
+            "available_functions_json": "[]",
+            "user_query": "user query",
+            "assistant_completion": "Thought: done",
+        }
+    )
+
+    histograms = section_histograms([sample, sample], count_characters, bin_size=8)
+
+    assert histograms["query"]["max"] == len("user query")
+    assert histograms["scratchpad"]["p50"] == len("Thought: done")
+    assert histograms["total"]["histogram"] == {len(sample) // 8 * 8: 2}
+
+
+def test_fit_functions_drops_the_lowest_ranked_functions():
+    pytest.importorskip("guidance")
+    from core.token_budget import prompt_sections
+    from dataset_generation.function_catalog import FunctionCatalog
+
+    catalog = FunctionCatalog(
+        [{"name": f"function_{i}", "description": "d" * 200, "parameters": {}} for i in range(10)]
+    )
+    sections = prompt_sections("", "q")
+    # room for about 4 functions of ~250 characters
+    budget = TokenBudget(sum(map(len, sections.values())) + 1000, count_tokens=count_characters, reserve_tokens=0)
+    ranked_names = catalog.names[::-1]
+
+    kept = catalog.names_of(budget.fit_functions(catalog.to_json(), "q", ranked_names=ranked_names, catalog=catalog))
+
+    assert 1 < len(kept) < 10
+    assert sorted(kept) == sorted(ranked_names[: len(kept)])
+    assert budget.dropped_functions == 10 - len(kept)
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("guidance")
+
+from core.step_factory import StepType, create_step_model  # noqa: E402
+from core.trace_generator import GuidedTraceGenerator  # noqa: E402
+
+
+class RecordingExecutors:
+    def __init__(self):
+        self.executed = []
+
+    def __contains__(self, fct_name):
+        return True
+
+    def execute_many(self, calls, outputs=None):
+        self.executed.extend(calls)
+        return ['{"executed": true}' for _ in calls]
+
+
+def generator_with_executors(executors):
+    trace_generator = object.__new__(GuidedTraceGenerator)
+    trace_generator.executors = executors
+    trace_generator._generate_function_output = lambda lm, trace, prefix="", on_delta=None: lm + ["generated"]
+    trace_generator._inject_function_output = lambda lm, trace, output, prefix="", on_delta=None: lm + [output]
+    return trace_generator
+
+
+def pending_call():
+    return create_step_model(
+        step_type=StepType.FUNCTION_CALL,
+        fct_name="get_weather",
+        fct_parameters='{"city": "Paris"}',
+        diff='Call function: get_weather({"city": "Paris"})<|wait|>',
+    )
+
+
+def test_function_outputs_are_executed_by_default():
+    executors = RecordingExecutors()
+    lm = generator_with_executors(executors)._generate_function_outputs([], [pending_call()])
+    assert lm == ['{"executed": true}']
+    assert executors.executed == [("get_weather", '{"city": "Paris"}')]
+
+
+def test_function_outputs_are_generated_without_execution():
+    executors = RecordingExecutors()
+    lm = generator_with_executors(executors)._generate_function_outputs([], [pending_call()], execute_functions=False)
+    assert lm == ["generated"]
+    assert executors.executed == []